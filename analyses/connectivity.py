@@ -6,15 +6,14 @@ Prototype code for analyzing connectivity and synaptic properties between cell c
 
 from __future__ import print_function, division
 
-from collections import OrderedDict
 import numpy as np
 import pyqtgraph as pg
 from multipatch_analysis.database import database as db
-from multipatch_analysis.connectivity import query_pairs, measure_connectivity
-from multipatch_analysis.connection_strength import ConnectionStrength, get_amps, get_baseline_amps
+from multipatch_analysis.connectivity import measure_connectivity, MatrixCache
+from multipatch_analysis.connection_strength import get_amps, get_baseline_amps
 from multipatch_analysis.morphology import Morphology
 from multipatch_analysis import constants
-from multipatch_analysis.cell_class import CellClass, classify_cells, classify_pairs
+from multipatch_analysis.cell_class import CellClass
 from multipatch_analysis.ui.graphics import MatrixItem
 
 
@@ -146,6 +145,7 @@ class MatrixAnalyzer(object):
         self.session = session
         self.cell_classes = cell_classes
         self.analysis_func = analysis_func
+        self.cache = MatrixCache(analysis_func)
         self.display_func = display_func
         self.session = session
         self.win = MainWindow()
@@ -161,17 +161,11 @@ class MatrixAnalyzer(object):
     def update_matrix(self):
         project_names = self.win.filter_control_panel.selected_project_names()
 
-        # Select pairs (todo: age, acsf, internal, temp, etc.)
-        self.pairs = query_pairs(project_name=project_names, session=self.session).all()
-
-        # Group all cells by selected classes
-        cell_groups = classify_cells(self.cell_classes, pairs=self.pairs)
-
-        # Group pairs into (pre_class, post_class) groups
-        pair_groups = classify_pairs(self.pairs, cell_groups)
-
-        # analyze matrix elements
-        results = self.analysis_func(pair_groups)
+        # Select pairs (todo: age, acsf, internal, temp, etc.), group them by cell class,
+        # and analyze matrix elements. Results are reused from previous updates where possible.
+        filters = {'project_name': tuple(project_names)}
+        cell_groups, results = self.cache.get_results(self.cell_classes, filters, self.session)
+        self.pairs = self.cache.pairs
 
         shape = (len(cell_groups),) * 2
         text = np.empty(shape, dtype=object)
@@ -0,0 +1,73 @@
+"""
+Measure how long it takes to import pipeline modules in a fresh interpreter, and report whether
+importing them loaded GUI libraries or opened database connections.
+
+Each module is imported --repeat times in a new process (so nothing is already in sys.modules)
+and the median time is reported. Run this on a machine with the full analysis environment;
+modules that fail to import are reported with the error.
+"""
+from __future__ import print_function, division
+import os, sys, json, argparse, subprocess
+import numpy as np
+
+
+default_modules = [
+    'multipatch_analysis.config',
+    'multipatch_analysis.database.database',
+    'multipatch_analysis.experiment',
+    'multipatch_analysis.experiment_list',
+    'multipatch_analysis.pulse_response_strength',
+    'multipatch_analysis.connection_strength',
+    'multipatch_analysis.morphology',
+    'multipatch_analysis.fit_average_first_pulse',
+    'multipatch_analysis.dynamics',
+    'multipatch_analysis.detection_limit',
+]
+
+gui_modules = ['PyQt4', 'PyQt5', 'PySide', 'PySide2', 'pyqtgraph', 'matplotlib.pyplot']
+
+probe = """
+import sys, time, json
+start = time.time()
+try:
+    import %(module)s
+    error = None
+except Exception as exc:
+    error = '%%s: %%s' %% (type(exc).__name__, exc)
+elapsed = time.time() - start
+db = sys.modules.get('multipatch_analysis.database.database')
+result = {
+    'time': elapsed,
+    'error': error,
+    'gui': [m for m in %(gui)r if m in sys.modules],
+    'engine': db is not None and getattr(db, 'engine_ro', None) is not None,
+}
+print(json.dumps(result))
+"""
+
+
+def time_import(module, python=sys.executable):
+    """Import *module* in a new interpreter and return a dict with the import time, any
+    error message, the GUI modules that were loaded, and whether a DB engine was created.
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    code = probe % {'module': module, 'gui': gui_modules}
+    output = subprocess.check_output([python, '-c', code], cwd=root)
+    return json.loads(output.decode('utf8').strip().split('\n')[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark import times of pipeline modules.")
+    parser.add_argument('modules', nargs='*', default=default_modules, help="Modules to import (default is the pipeline modules)")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of times each module is imported")
+    args = parser.parse_args(sys.argv[1:])
+
+    print("%-50s  %10s  %8s  %s" % ('module', 'time (s)', 'DB', 'GUI modules loaded'))
+    for module in args.modules:
+        results = [time_import(module) for i in range(args.repeat)]
+        last = results[-1]
+        if last['error'] is not None:
+            print("%-50s  %10s  %8s  %s" % (module, '-', '-', last['error']))
+            continue
+        t = np.median([r['time'] for r in results])
+        print("%-50s  %10.3f  %8s  %s" % (module, t, 'engine' if last['engine'] else '-', ', '.join(last['gui'])))
@@ -336,15 +336,17 @@ if __name__ == '__main__':
         pair_cache = cache.setdefault(pair_key, {})
 
         for j,rtime in enumerate(rtimes):
-            new_results = False
-            for i,amp in enumerate(amps):
-                print("---------------------------------------    %d/%d  %d/%d      \r" % (i,len(amps),j,len(rtimes)),)
-                result = pair_cache.get((rtime, amp))
-                if result is None:
-                    result = strength_analysis.simulate_connection(fg_recs, bg_results, classifier, amp, rtime)
+            # simulate all uncached amplitudes for this rise time at once
+            new_amps = [amp for amp in amps if (rtime, amp) not in pair_cache]
+            new_results = len(new_amps) > 0
+            if new_results:
+                print("---------------------------------------    %d/%d      \r" % (j,len(rtimes)),)
+                sim_results = strength_analysis.simulate_detection(fg_recs, bg_results, classifier, new_amps, rtime)
+                for amp, result in zip(new_amps, sim_results):
                     pair_cache[rtime, amp] = result
-                    new_results = True
 
+            for i,amp in enumerate(amps):
+                result = pair_cache[rtime, amp]
                 for k,v in result.items():
                     results[i,j][k] = v
 
@@ -0,0 +1,99 @@
+"""
+Benchmark creating combined NWB files for packaging: a full copy of the site NWB versus a
+copy-on-write clone and an external-link companion file (see nwb_packaging.prepareOutputNWB),
+followed by appending many small metadata entries with the file reopened for each entry
+(as packaging used to) versus a single open handle.
+
+Synthetic HDF5 files laid out like MIES NWB exports are written to --path. Whether clones are
+possible depends on the file system, so use a path on the storage that packaging runs on.
+Note that the source file is likely to be in the OS page cache after it is written, which
+makes the copy faster than it would be for a file read from a network share.
+"""
+from __future__ import print_function, division
+import os, sys, time, shutil, tempfile, argparse
+import numpy as np
+import h5py
+from multipatch_analysis import nwb_packaging
+
+
+def make_site_nwb(filename, size, n_sweeps=200):
+    """Write a synthetic file of roughly *size* bytes with sweeps in /acquisition and /stimulus.
+    """
+    sweep_len = max(1, int(size / n_sweeps / 2 / 4))
+    data = np.random.normal(size=sweep_len).astype('float32')
+    with h5py.File(filename, 'w') as f:
+        f.attrs['nwb_version'] = 'NWB-1.0.5'
+        f['identifier'] = 'benchmark'
+        f['session_description'] = 'synthetic file for nwb_packaging_benchmark'
+        for i in range(n_sweeps):
+            f['acquisition/timeseries/data_%05d_AD0/data' % i] = data
+            f['stimulus/presentation/data_%05d_DA0/data' % i] = data
+        f['general/session_id'] = 'benchmark'
+        f.create_group('general/misc_files')
+
+
+def append_metadata(filename, n_entries, reopen):
+    """Append *n_entries* small text datasets to /general/misc_files, optionally reopening
+    the file for each one.
+    """
+    content = 'x' * 2000
+    if reopen:
+        for i in range(n_entries):
+            with h5py.File(filename, 'a') as f:
+                f['general/misc_files/entry_%05d' % i] = content
+    else:
+        with h5py.File(filename, 'a') as f:
+            for i in range(n_entries):
+                f['general/misc_files/entry_%05d' % i] = content
+
+
+def check_output(site_file, output_file):
+    """Make sure that sweep data read through the output file matches the site file.
+    """
+    with h5py.File(site_file, 'r') as src:
+        with h5py.File(output_file, 'r') as dst:
+            for name in ['acquisition/timeseries/data_00000_AD0/data', 'stimulus/presentation/data_00000_DA0/data']:
+                assert np.all(src[name][:] == dst[name][:])
+            assert len(dst['general/misc_files']) > 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark creating combined NWB files.")
+    parser.add_argument('--path', default=None, help="Folder for the synthetic files (default is a temporary folder)")
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.1, 1, 4], help="Site NWB file sizes (GB)")
+    parser.add_argument('--entries', type=int, default=500, help="Number of metadata entries appended to each file")
+    args = parser.parse_args(sys.argv[1:])
+
+    path = tempfile.mkdtemp(prefix='nwb-packaging-benchmark', dir=args.path)
+    try:
+        print("%8s  %6s  %12s  %12s  %14s  %14s" % ('size GB', 'mode', 'prepare (s)', 'output MB', 'reopen (s)', 'one handle (s)'))
+        for size in args.sizes:
+            site_file = os.path.join(path, 'site.nwb')
+            make_site_nwb(site_file, size * 1e9)
+
+            for mode in nwb_packaging.packagingModes:
+                times = []
+                for reopen in (True, False):
+                    output_file = os.path.join(path, 'combined_%s.nwb' % mode)
+                    start = time.time()
+                    if mode == 'clone':
+                        cloned = nwb_packaging.cloneFile(site_file, output_file)
+                    else:
+                        nwb_packaging.prepareOutputNWB(site_file, output_file, mode)
+                    prepare_time = time.time() - start
+                    output_size = os.path.getsize(output_file)
+
+                    start = time.time()
+                    append_metadata(output_file, args.entries, reopen=reopen)
+                    times.append(time.time() - start)
+
+                    check_output(site_file, output_file)
+                    os.remove(output_file)
+
+                label = mode if mode != 'clone' or cloned else 'clone*'
+                print("%8.1f  %6s  %12.2f  %12.2f  %14.2f  %14.2f" % (size, label, prepare_time, output_size / 1e6, times[0], times[1]))
+
+            os.remove(site_file)
+        print("(* clones are not supported on this file system; a full copy was made)")
+    finally:
+        shutil.rmtree(path)
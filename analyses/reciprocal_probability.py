@@ -37,10 +37,14 @@ sample size affects statistical confidence.
 
 """
 
+import multiprocessing
 import numpy as np
 
 
-def run_expt(Wab, n_cells=4, n_expts=100, n_trials=1000):
+result_dtype = [('conn', int), ('recip', int), ('probed', int)]
+
+
+def run_expt(Wab, n_cells=4, n_expts=100, n_trials=1000, workers=1, max_chunk_size=2**22):
     """Simulate many trials of a series of multipatch experiments.
     
     Parameters
@@ -63,6 +67,12 @@ def run_expt(Wab, n_cells=4, n_expts=100, n_trials=1000):
     n_trials : int
         The number of times to repeat the series of n_experiments. This allows
         us to evaluate the reproducibility of the results.
+    workers : int
+        Number of processes over which to spread the simulation (default is 1,
+        which runs in the current process).
+    max_chunk_size : int
+        Maximum number of simulated cell pairs to generate at once. Trials are
+        simulated in chunks no larger than this to bound memory usage.
         
     Returns
     -------
@@ -82,31 +92,26 @@ def run_expt(Wab, n_cells=4, n_expts=100, n_trials=1000):
     print("-----------")
     print("cells: %d   expts: %d   trials: %d" % (n_cells, n_expts, n_trials))
     print(Wab)
-    n_cell_types = Wab.shape[0]
-    results = np.empty((n_trials, n_expts), dtype=[('conn', int), ('recip', int), ('probed', int)])
+    results = np.empty((n_trials, n_expts), dtype=result_dtype)
     
-    # Run many trials so we can analyze the trial-to-trial variability in results
-    for i in range(n_trials):
-        # Run many experiments to recover the connection probability
-        # (this is like running many multipatch experiments on a single class of neuron)
-        for j in range(n_expts):
-            # Randomly choose N cells from available cell types
-            types = np.random.randint(n_cell_types, size=n_cells)
-            
-            # i,j connection probability matrix for this experiment
-            cpm = Wab[types][:, types]
-            
-            # i,j boolean connection matrix for this experiment
-            conn = cpm > np.random.random(size=(n_cells, n_cells))
-            
-            # clear diagonal
-            diag = np.eye(n_cells, dtype='bool')
-            conn[diag] = False
-            
-            # count total connections and reciprocal connections
-            results[i, j]['conn'] = conn.sum()
-            results[i, j]['recip'] = (conn & conn.T).sum()
-            results[i, j]['probed'] = n_cells * (n_cells-1)
+    # Split trials into chunks that each fit within max_chunk_size, and give each chunk its own
+    # random seed (drawn from the global RNG) so results do not depend on how chunks are distributed
+    trials_per_chunk = max(1, max_chunk_size // (n_expts * n_cells**2))
+    chunk_starts = list(range(0, n_trials, trials_per_chunk))
+    seeds = np.random.randint(2**31 - 1, size=len(chunk_starts))
+    chunks = [(Wab, n_cells, n_expts, min(trials_per_chunk, n_trials - start), seed) for start, seed in zip(chunk_starts, seeds)]
+
+    if workers > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            chunk_results = pool.map(simulate_trials, chunks)
+        finally:
+            pool.terminate()
+    else:
+        chunk_results = map(simulate_trials, chunks)
+
+    for start, chunk_result in zip(chunk_starts, chunk_results):
+        results[start:start + len(chunk_result)] = chunk_result
 
     cprobs = results['conn'].sum(axis=1) / results['probed'].sum(axis=1)
     rprobs = results['recip'].sum(axis=1) / results['probed'].sum(axis=1)
@@ -133,6 +138,38 @@ def run_expt(Wab, n_cells=4, n_expts=100, n_trials=1000):
     return results
 
 
+def simulate_trials(args):
+    """Simulate all experiments for a block of trials at once.
+
+    *args* is a tuple (Wab, n_cells, n_expts, n_trials, seed). Cell types and connections for all
+    experiments are drawn as stacked (trials, expts, cells, cells) arrays and counted with array
+    reductions. Returns a (n_trials, n_expts) array with the same dtype as run_expt().
+    """
+    Wab, n_cells, n_expts, n_trials, seed = args
+    rng = np.random.RandomState(seed)
+    n_cell_types = Wab.shape[0]
+
+    # Randomly choose N cells from available cell types for every experiment
+    types = rng.randint(n_cell_types, size=(n_trials, n_expts, n_cells))
+
+    # i,j connection probability matrix for each experiment
+    cpm = Wab[types[..., :, None], types[..., None, :]]
+
+    # i,j boolean connection matrix for each experiment
+    conn = cpm > rng.random_sample(size=cpm.shape)
+
+    # clear diagonal
+    diag = np.eye(n_cells, dtype='bool')
+    conn[..., diag] = False
+
+    # count total connections and reciprocal connections
+    results = np.empty((n_trials, n_expts), dtype=result_dtype)
+    results['conn'] = conn.sum(axis=(2, 3))
+    results['recip'] = (conn & conn.swapaxes(2, 3)).sum(axis=(2, 3))
+    results['probed'] = n_cells * (n_cells-1)
+    return results
+
+
 if __name__ == '__main__':
     import pyqtgraph as pg
 
@@ -0,0 +1,70 @@
+"""
+Benchmark joining structured arrays like those returned by query_all_pairs() with classifier
+predictions, comparing the old row-by-row join against record_array.join_struct_arrays.
+
+The row-by-row join is skipped for large inputs because it takes minutes to run.
+"""
+from __future__ import print_function, division
+import sys, time, argparse
+import numpy as np
+from multipatch_analysis.record_array import join_struct_arrays
+
+
+def join_struct_arrays_by_row(arrays):
+    """The previous implementation from strength_analysis, kept for comparison.
+    """
+    dtype = []
+    for arr in arrays:
+        for name in arr.dtype.names:
+            dtype.append((str(name), arr.dtype.fields[name][0].str))
+    arr = np.empty(len(arrays[0]), dtype=dtype)
+    for i in range(len(arr)):
+        v = ()
+        for a in arrays:
+            v = v + tuple(a[i])
+        arr[i] = v
+    return arr
+
+
+def make_records(n):
+    """Generate records with a mix of numeric and object fields, similar to query_all_pairs().
+    """
+    recs = np.empty(n, dtype=[('id', int), ('ic_deconv_amp_mean', float), ('ic_n_samples', int), ('synapse', object),
+                              ('pre_cre_type', object), ('post_cre_type', object), ('donor_age', float)])
+    recs['id'] = np.arange(n)
+    recs['ic_deconv_amp_mean'] = np.random.normal(size=n)
+    recs['ic_n_samples'] = np.random.randint(200, size=n)
+    recs['synapse'] = np.random.choice([True, False, None], size=n)
+    recs['pre_cre_type'] = np.random.choice(['sim1', 'tlx3', 'pvalb', 'sst'], size=n)
+    recs['post_cre_type'] = np.random.choice(['sim1', 'tlx3', 'pvalb', 'sst'], size=n)
+    recs['donor_age'] = np.random.uniform(20, 60, size=n)
+
+    pred = np.empty(n, dtype=[('prediction', float), ('confidence', float)])
+    pred['prediction'] = np.random.randint(2, size=n)
+    pred['confidence'] = np.random.uniform(size=n)
+    return recs, pred
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark structured array joins.")
+    parser.add_argument('--max-row-join', type=int, default=100000, dest='max_row_join', help="Largest input size to run with the row-by-row join")
+    args = parser.parse_args(sys.argv[1:])
+
+    print("%10s  %12s  %12s" % ('records', 'by row (s)', 'by field (s)'))
+    for n in [10000, 100000, 1000000]:
+        recs, pred = make_records(n)
+
+        start = time.time()
+        joined = join_struct_arrays([recs, pred])
+        field_time = time.time() - start
+
+        if n <= args.max_row_join:
+            start = time.time()
+            joined_by_row = join_struct_arrays_by_row([recs, pred])
+            row_time = "%12.3f" % (time.time() - start)
+            for name in joined.dtype.names:
+                assert np.all((joined[name] == joined_by_row[name]) | (joined[name] != joined[name]))
+        else:
+            row_time = "%12s" % "-"
+
+        print("%10d  %s  %12.3f" % (n, row_time, field_time))
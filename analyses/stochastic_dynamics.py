@@ -1,186 +1,69 @@
 # coding: utf8
 from __future__ import print_function, division
-import sys
+import sys, argparse
 from collections import OrderedDict
 import numpy as np
-import numba
 import pyqtgraph as pg
-import pyqtgraph.multiprocess
 from pyqtgraph.Qt import QtGui, QtCore
-import scipy.stats as stats
 from multipatch_analysis.database import database as db
 from multipatch_analysis.pulse_response_strength import PulseResponseStrength
 from multipatch_analysis.connection_strength import ConnectionStrength, get_amps, get_baseline_amps
 from multipatch_analysis.ui.ndslicer import NDSlicer
+from multipatch_analysis.stochastic_release import StochasticModelRunner
+from multipatch_analysis.parameter_space import ParameterSpace
 from neuroanalysis.synaptic_release import ReleaseModel
 
 
-class StochasticReleaseModel(object):
-    
-    result_dtype = [
-        ('spike_time', float),
-        ('amplitude', float),
-        ('expected_amplitude', float),
-        ('likelihood', float),
-    ]
-    
-    state_dtype = [
-        ('available_vesicle', float),
-    ]
-    
-    def __init__(self):
-        # model parameters
-        self.n_release_sites = 20
-        self.release_probability = 0.1
-        self.mini_amplitude = 50e-6
-        self.mini_amplitude_stdev = 20e-6
-        self.recovery_tau = 100e-3
-        self.measurement_stdev = 100e-6
-    
-    def measure_likelihood(self, spike_times, amplitudes):
-        """Compute a measure of the likelihood that *times* and *amplitudes* could be generated
-        by a synapse with the current dynamic parameters.
-        
-        Returns
-        -------
-        result : array
-            result contains fields: spike_time, amplitude, expected_amplitude, likelihood
-        pre_spike_state:
-            state variables immediately before each spike
-        post_spike_state:
-            state variables immediately after each spike
-        """
-        result = np.empty(len(spike_times), dtype=self.result_dtype)
-        pre_spike_state = np.empty(len(spike_times), dtype=self.state_dtype)
-        post_spike_state = np.empty(len(spike_times), dtype=self.state_dtype)
-        
-        # state parameters:
-        # available_vesicles is a float as a means of avoiding the need to model stochastic vesicle docking;
-        # we just assume that recovery is a continuous process. (maybe we should just call this "neurotransmitter"
-        # instead)
-        state = {
-            'available_vesicle': self.n_release_sites,
-        }
-        
-        previous_t = spike_times[0]
-        
-        for i,t in enumerate(spike_times):
-            amplitude = amplitudes[i]
-
-            # recover vesicles up to the current timepoint
-            dt = t - previous_t
-            previous_t = t
-            recovery = np.exp(-dt / self.recovery_tau)
-            state['available_vesicle'] = state['available_vesicle'] * recovery + self.n_release_sites * (1.0 - recovery)
-            
-            # record model state immediately before spike
-            for k in state:
-                pre_spike_state[i][k] = state[k]
-                
-            # measure likelihood of seeing this response amplitude
-            expected_amplitude = state['available_vesicle'] * self.release_probability * self.mini_amplitude
-            likelihood = self.likelihood([amplitude], state)[0]
-            
-            # release vesicles
-            # note: we allow available_vesicle to become negative because this help to ensure
-            # that the overall likelihood will be low for such models
-            depleted_vesicle = amplitude / self.mini_amplitude
-            state['available_vesicle'] -= depleted_vesicle
-
-            # record model state immediately after spike
-            for k in state:
-                post_spike_state[i][k] = state[k]
-            
-            # record results
-            result[i]['spike_time'] = t
-            result[i]['amplitude'] = amplitude
-            result[i]['expected_amplitude'] = expected_amplitude
-            result[i]['likelihood'] = likelihood
-            
-        return result, pre_spike_state, post_spike_state
-            
-    def likelihood(self, amplitudes, state):
-        """Estimate the probability density of seeing a particular *amplitude*
-        given a number of *available_vesicles*.
-        """
-        available_vesicles = int(np.clip(np.round(state['available_vesicle']), 0, self.n_release_sites))
-        return release_likelihood(amplitudes, available_vesicles, self.release_probability, self.mini_amplitude, self.mini_amplitude_stdev, self.measurement_stdev)
+def event_qc(events):
+    mask = events['ex_qc_pass'] == True
+    # need more stringent qc for dynamics:
+    mask &= np.abs(events['baseline_current']) < 500e-12
+    return mask   
 
 
-# @numba.jit
-def release_likelihood(amplitudes, available_vesicles, release_probability, mini_amplitude, mini_amplitude_stdev, measurement_stdev):
-    """Return a measure of the likelihood that a synaptic response will have certain amplitude(s),
-    given the state parameters for the synapse.
-    
-    Parameters
-    ----------
-    amplitudes : array
-        The amplitudes for which likelihood values will be returned
-    available_vesicles : int
-        Number of vesicles available for release
-    release_probability : float
-        Probability for each available vesicle to be released
-    mini_amplitude : float
-        Mean amplitude of response evoked by a single vesicle release
-    mini_amplitude_stdev : float
-        Standard deviation of response amplitudes evoked by a single vesicle release
-    measurement_stdev : float
-        Standard deviation of response amplitude measurement errors
-        
-        
-    For each value in *amplitudes*, we calculate the likelihood that a synapse would evoke a response
-    of that amplitude. Likelihood is calculated as follows:
-    
-    1. Given the number of vesicles available to be released (nV) and the release probability (pR), determine
-       the probability that each possible number of vesicles (nR) will be released using the binomial distribution
-       probability mass function. For example, if there are 3 vesicles available and the release probability is
-       0.1, then the possibilities are:
-           vesicles released (nR)    probability
-                                0    0.729
-                                1    0.243
-                                2    0.27
-                                3    0.001
-    2. For each possible number of released vesicles, calculate the likelihood that this possibility could
-       evoke a response of the tested amplitude. This is calculated using the Gaussian probability distribution 
-       function where µ = nR * mini_amplitude and σ = sqrt(mini_amplitude_stdev^2 * nR + measurement_stdev)
-    3. The total likelihood is the sum of likelihoods for all possible values of nR.
+def load_synapse_events(session, pair, amplitude_field='pos_dec_amp'):
+    """Return presynaptic spike times and background-subtracted postsynaptic response amplitudes
+    for all qc-passed current clamp pulse responses in *pair*, along with background event records.
     """
-    amplitudes = np.array(amplitudes)
-    
-    likelihood = np.zeros(len(amplitudes))
-    release_prob = stats.binom(available_vesicles, release_probability)
-    
-    n_vesicles = np.arange(available_vesicles + 1)
-    
-    # probability of releasing n_vesicles given available_vesicles and release_probability
-    p_n = release_prob.pmf(n_vesicles)
-    
-    # expected amplitude for n_vesicles
-    amp_mean = n_vesicles * mini_amplitude
-    
-    # amplitude stdev increases by sqrt(n) with number of released vesicles
-    amp_stdev = (mini_amplitude_stdev**2 * n_vesicles + measurement_stdev**2) ** 0.5
-    
-    # distributions of amplitudes expected for n_vesicles
-    amp_prob = p_n[None, :] * normal_pdf(amp_mean[None, :], amp_stdev[None, :], amplitudes[:, None])
-    
-    # sum all distributions across n_vesicles
-    likelihood = amp_prob.sum(axis=1)
-    
-    return likelihood
+    raw_events = get_amps(session, pair, clamp_mode='ic')
+    mask = event_qc(raw_events)
+    events = raw_events[mask]
+
+    rec_times = 1e-9 * (events['rec_start_time'].astype(float) - float(events['rec_start_time'][0]))
+    spike_times = events['max_dvdt_time'] + rec_times
 
+    raw_bg_events = get_baseline_amps(session, pair, clamp_mode='ic')
+    mask = event_qc(raw_bg_events)
+    bg_events = raw_bg_events[mask]
+    mean_bg_amp = bg_events[amplitude_field].mean()
+    amplitudes = events[amplitude_field] - mean_bg_amp
+
+    return events, spike_times, amplitudes, bg_events
 
-def normal_pdf(mu, sigma, x):
-    """Probability density function of normal distribution
+
+def log_space(start, stop, steps):
+    return start * (stop/start)**(np.arange(steps) / (steps-1))
+
+
+def default_params(measurement_stdev):
+    """Parameter space searched for each synapse (~2.3M points).
     """
-    return (1.0 / (2 * np.pi * sigma**2))**0.5 * np.exp(- (x-mu)**2 / (2 * sigma**2))
+    return {
+        'n_release_sites': np.array([1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64]),
+        'release_probability': log_space(0.01, 0.9, 21),
+        'mini_amplitude': log_space(0.001, 0.3, 21),
+        'mini_amplitude_stdev': log_space(0.0001, 0.1, 21),
+        'measurement_stdev': measurement_stdev,
+        'recovery_tau': log_space(2e-5, 20, 21),
+    }
 
 
-def event_qc(events):
-    mask = events['ex_qc_pass'] == True
-    # need more stringent qc for dynamics:
-    mask &= np.abs(events['baseline_current']) < 500e-12
-    return mask   
+# (expt_id, pre_cell_id, post_cell_id)
+example_synapses = OrderedDict([
+    ('strong ex, no failures, no depression', (1535402792.695, 8, 7)),
+    ('strong ex with failures', (1537820585.767, 1, 2)),
+    ('strong ex, depressing', (1536781898.381, 8, 2)),
+])
 
 
 class ModelResultWidget(QtGui.QWidget):
@@ -321,41 +204,14 @@ class PixelSelector(QtGui.QGraphicsRectItem):
         self.setPos(i, j)
 
         
-class ParameterSpace(object):
-    def __init__(self, params):
-        self.params = params
-        
-        static_params = {}
-        for param, val in params.items():
-            if np.isscalar(val):
-                static_params[param] = params.pop(param)
-        self.static_params = static_params
-        
-        self.param_order = list(params.keys())
-        shape = tuple([len(params[p]) for p in self.param_order])
-        
-        self.result = np.zeros(shape, dtype=object)
-        
-    def axes(self):
-        return OrderedDict([(ax, {'values': self.params[ax]}) for ax in self.param_order])
-        
-    def run(self, func):
-        all_inds = list(np.ndindex(self.result.shape))
-
-        with pg.multiprocess.Parallelize(enumerate(all_inds), results=self.result, progressDialog='synapticulating...', workers=8) as tasker:
-            for i, inds in tasker:
-                params = self[inds]
-                tasker.results[inds] = func(params)
-        
-    def __getitem__(self, inds):
-        params = self.static_params.copy()
-        for i,param in enumerate(self.param_order):
-            params[param] = self.params[param][inds[i]]
-        return params
-
-
 class ParameterSearchWidget(QtGui.QWidget):
-    def __init__(self, param_space):
+    """Browse the results of a parameter search.
+
+    *param_space* is a ParameterSpace whose result array (possibly memory-mapped) contains
+    summary records generated by *model_runner*; full model results are regenerated by
+    *model_runner* for whichever point in the space is selected.
+    """
+    def __init__(self, param_space, model_runner, field='likelihood'):
         QtGui.QWidget.__init__(self)
         self.layout = QtGui.QGridLayout()
         self.layout.setContentsMargins(0, 0, 0, 0)
@@ -371,14 +227,16 @@ class ParameterSearchWidget(QtGui.QWidget):
         self.splitter.addWidget(self.result_widget)
         
         self.param_space = param_space
+        self.model_runner = model_runner
         
-        result_img = np.zeros(param_space.result.shape)
-        for ind in np.ndindex(result_img.shape):
-            result_img[ind] = np.log(param_space.result[ind][1]['likelihood'] + 1).mean()
+        result_img = param_space.result[field]
+        if not param_space.evaluated.all():
+            # points skipped by an adaptive search are NaN; show them at the minimum value
+            result_img = np.where(param_space.evaluated, result_img, np.nanmin(result_img))
         self.slicer.set_data(result_img)
         self.results = result_img
         
-        best = np.unravel_index(np.argmax(result_img), result_img.shape)
+        best = np.unravel_index(param_space.best(field)[0], result_img.shape)
         self.select_result(best)
         
     def selection_changed(self, slicer):
@@ -386,34 +244,31 @@ class ParameterSearchWidget(QtGui.QWidget):
         self.select_result(index, update_slicer=False)
 
     def select_result(self, index, update_slicer=True):
-        result = self.param_space.result[index]
+        result = self.model_runner.run_model(self.param_space[index])
         self.result_widget.set_result(*result)
         if update_slicer:
             self.slicer.set_index(index)
 
 
 if __name__ == '__main__':
-    pg.mkQApp()
-    pg.dbg()
-    
-    # strong ex, no failures, no depression
-    expt_id = 1535402792.695
-    pre_cell_id = 8
-    post_cell_id = 7
-    
-    # strong ex with failures
-    expt_id = 1537820585.767
-    pre_cell_id = 1
-    post_cell_id = 2
+    parser = argparse.ArgumentParser(description="Search release model parameter space for a single synapse.")
+    parser.add_argument('synapse', type=float, nargs='*', help="Experiment ID, presynaptic cell ID, and postsynaptic cell ID (defaults to an example synapse)")
+    parser.add_argument('--cache', type=str, default=None, help="Memory-mapped file (.npy) in which to store / resume search results")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default is one per CPU)")
+    parser.add_argument('--adaptive', action='store_true', default=False, help="Refine around likelihood maxima rather than evaluating the entire grid")
+    parser.add_argument('--no-gui', action='store_true', default=False, dest='no_gui', help="Run the search without displaying results")
+    args = parser.parse_args(sys.argv[1:])
+
+    if not args.no_gui:
+        pg.mkQApp()
+        pg.dbg()
     
-    # strong ex, depressing
-    expt_id = 1536781898.381
-    pre_cell_id = 8
-    post_cell_id = 2
-
-    # expt_id = float(sys.argv[1])
-    # pre_cell_id = int(sys.argv[2])
-    # post_cell_id = int(sys.argv[3])
+    if len(args.synapse) == 3:
+        expt_id = args.synapse[0]
+        pre_cell_id = int(args.synapse[1])
+        post_cell_id = int(args.synapse[2])
+    else:
+        expt_id, pre_cell_id, post_cell_id = example_synapses['strong ex, depressing']
 
 
     session = db.Session()
@@ -427,13 +282,8 @@ if __name__ == '__main__':
 
     # 1. Get a list of all presynaptic spike times and the amplitudes of postsynaptic responses
 
-    raw_events = get_amps(session, pair, clamp_mode='ic')
-    mask = event_qc(raw_events)
-    events = raw_events[mask]
-
-    rec_times = 1e-9 * (events['rec_start_time'].astype(float) - float(events['rec_start_time'][0]))
-    spike_times = events['max_dvdt_time'] + rec_times
     amplitude_field = 'pos_dec_amp'    
+    events, spike_times, amplitudes, bg_events = load_synapse_events(session, pair, amplitude_field)
 
     # 2. Initialize model parameters:
     #    - release model with depression, facilitation
@@ -441,32 +291,15 @@ if __name__ == '__main__':
     #    - measured distribution of background noise
     #    - parameter space to be searched
 
-    raw_bg_events = get_baseline_amps(session, pair, clamp_mode='ic')
-    mask = event_qc(raw_bg_events)
-    bg_events = raw_bg_events[mask]
-    mean_bg_amp = bg_events[amplitude_field].mean()
-    amplitudes = events[amplitude_field] - mean_bg_amp
-
     first_pulse_mask = events['pulse_number'] == 1
     first_pulse_amps = amplitudes[first_pulse_mask]
     first_pulse_stdev = first_pulse_amps.std()
     
-
-    def log_space(start, stop, steps):
-        return start * (stop/start)**(np.arange(steps) / (steps-1))
-        
     n_release_sites = 20
     release_probability = 0.1
     max_events = -1
     mini_amp_estimate = first_pulse_amps.mean() / (n_release_sites * release_probability)
-    params = {
-        'n_release_sites': np.array([1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64]),
-        'release_probability': log_space(0.01, 0.9, 21),
-        'mini_amplitude': log_space(0.001, 0.3, 21),
-        'mini_amplitude_stdev': log_space(0.0001, 0.1, 21),
-        'measurement_stdev': bg_events[amplitude_field].std(),
-        'recovery_tau': log_space(2e-5, 20, 21),
-    }
+    params = default_params(bg_events[amplitude_field].std())
 
     # quick test
     # n_release_sites = 8
@@ -498,16 +331,21 @@ if __name__ == '__main__':
 
     # 3. For each point in the parameter space, simulate a synapse and estimate the joint probability of the set of measured amplitudes
     
-    def run_model(params):    
-        model = StochasticReleaseModel()
-        for k,v in params.items():
-            setattr(model, k, v)
-        return (model,) + model.measure_likelihood(spike_times[:max_events], amplitudes[:max_events])
-    
+    model_runner = StochasticModelRunner(spike_times[:max_events], amplitudes[:max_events])
     
+    cache_file = args.cache
+    if cache_file is None:
+        mode = 'adaptive' if args.adaptive else 'grid'
+        cache_file = 'stochastic_dynamics_%0.3f_%d_%d_%s.npy' % (expt_id, pre_cell_id, post_cell_id, mode)
+    score_field = 'log_likelihood'
     param_space = ParameterSpace(params)
-    param_space.run(run_model)
+    if args.adaptive:
+        param_space.run_adaptive(model_runner, result_dtype=model_runner.result_dtype, score_field=score_field, cache_file=cache_file, workers=args.workers)
+        print("Adaptive search evaluated %d/%d points" % (param_space.evaluated.sum(), param_space.evaluated.size))
+    else:
+        param_space.run(model_runner, result_dtype=model_runner.result_dtype, cache_file=cache_file, workers=args.workers)
 
     # 4. Visualize / characterize mapped parameter space. Somehow.
-    win = ParameterSearchWidget(param_space)
-    win.show()
+    if not args.no_gui:
+        win = ParameterSearchWidget(param_space, model_runner, field=score_field)
+        win.show()
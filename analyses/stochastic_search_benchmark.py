@@ -0,0 +1,65 @@
+"""
+Compare exhaustive and adaptive release model parameter searches on the example synapses
+from stochastic_dynamics.py.
+
+For each synapse, reports the best log-likelihood found by the full grid search, the best
+found by the adaptive search, and the number of model evaluations each needed to reach it.
+Full grid results are cached (and resumable) in the current directory because they take
+a long time to generate.
+"""
+from __future__ import print_function, division
+import sys, time, argparse
+from multipatch_analysis.database import database as db
+from multipatch_analysis.stochastic_release import StochasticModelRunner
+from multipatch_analysis.parameter_space import ParameterSpace
+from stochastic_dynamics import load_synapse_events, default_params, example_synapses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark adaptive vs. exhaustive release model parameter search.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default is one per CPU)")
+    parser.add_argument('--stride', type=int, default=4, help="Initial stride for the adaptive coarse grid")
+    parser.add_argument('--n-best', type=int, default=8, dest='n_best', help="Number of maxima refined by the adaptive search")
+    args = parser.parse_args(sys.argv[1:])
+
+    score_field = 'log_likelihood'
+    amplitude_field = 'pos_dec_amp'
+    session = db.Session()
+
+    report = []
+    for name, (expt_id, pre_cell_id, post_cell_id) in example_synapses.items():
+        print("======== %s  (%0.3f %d->%d) ========" % (name, expt_id, pre_cell_id, post_cell_id))
+        expt = db.experiment_from_timestamp(expt_id, session=session)
+        pair = expt.pairs[(pre_cell_id, post_cell_id)]
+        events, spike_times, amplitudes, bg_events = load_synapse_events(session, pair, amplitude_field)
+        params = default_params(bg_events[amplitude_field].std())
+        model_runner = StochasticModelRunner(spike_times[:-1], amplitudes[:-1])
+
+        full = ParameterSpace(params)
+        cache_file = 'stochastic_dynamics_%0.3f_%d_%d_grid.npy' % (expt_id, pre_cell_id, post_cell_id)
+        start = time.time()
+        full.run(model_runner, result_dtype=model_runner.result_dtype, cache_file=cache_file, workers=args.workers)
+        full_time = time.time() - start
+        full_best = full.result[score_field].reshape(-1)[full.best(score_field)[0]]
+
+        adaptive = ParameterSpace(params)
+        start = time.time()
+        adaptive.run_adaptive(model_runner, result_dtype=model_runner.result_dtype, score_field=score_field,
+                              initial_stride=args.stride, n_best=args.n_best, workers=args.workers)
+        adaptive_time = time.time() - start
+        adaptive_best = adaptive.search_history[-1][1]
+
+        # number of evaluations after which the adaptive search had found the full-grid maximum
+        n_to_best = None
+        for n_evals, best in adaptive.search_history:
+            if best >= full_best:
+                n_to_best = n_evals
+                break
+
+        report.append((name, full.result.size, full_best, full_time, adaptive.n_evaluations, adaptive_best, adaptive_time, n_to_best))
+
+    print("")
+    print("%-40s %12s %14s %10s | %12s %14s %10s %14s" % ('synapse', 'grid evals', 'grid best', 'grid time', 'adapt evals', 'adapt best', 'adapt time', 'evals to best'))
+    for name, n_full, full_best, full_time, n_adapt, adapt_best, adapt_time, n_to_best in report:
+        n_to_best = 'not reached' if n_to_best is None else '%d' % n_to_best
+        print("%-40s %12d %14.4f %9.0fs | %12d %14.4f %9.0fs %14s" % (name, n_full, full_best, full_time, n_adapt, adapt_best, adapt_time, n_to_best))
@@ -12,21 +12,18 @@ from __future__ import print_function, division
 import argparse, time, sys, os, pickle, io
 import numpy as np
 import scipy.stats
-import pandas
 from datetime import datetime
 
 from sqlalchemy.orm import aliased
-import sklearn.svm, sklearn.preprocessing, sklearn.ensemble
 
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
 
 from neuroanalysis.ui.plot_grid import PlotGrid
-from neuroanalysis.data import Trace, TraceList
+from neuroanalysis.data import TraceList
 from neuroanalysis import filter
 from neuroanalysis.event_detection import exp_deconvolve
 from neuroanalysis.baseline import float_mode
-from neuroanalysis.fitting import Psp
 
 from multipatch_analysis.database import database as db
 from multipatch_analysis.ui.multipatch_nwb_viewer import MultipatchNwbViewer
@@ -35,6 +32,10 @@ from multipatch_analysis.pulse_response_strength import (
     baseline_query, analyze_response_strength, pulse_response_strength_tables,
 )
 from multipatch_analysis.connection_strength import ConnectionStrength, get_amps, get_baseline_amps
+from multipatch_analysis import connection_strength
+from multipatch_analysis.record_array import join_struct_arrays
+from multipatch_analysis.pair_classifier import load_pair_classifier, train_pair_classifier, data_version
+from multipatch_analysis.detection_limit import simulate_detection
 import multipatch_analysis.morphology  # just to initialize ORM
 from multipatch_analysis import constants
 
@@ -486,81 +487,37 @@ class ResponseStrengthAnalyzer(object):
 
 
 def query_all_pairs(classifier=None):
-    columns = [
-        "connection_strength.*",
-        "experiment.id as experiment_id",
-        "experiment.acq_timestamp as acq_timestamp",
-        "experiment.rig_name",
-        "experiment.acsf",
-        "slice.species as donor_species",
-        "slice.genotype as donor_genotype",
-        "slice.age as donor_age",
-        "slice.sex as donor_sex",
-        "slice.quality as slice_quality",
-        "slice.weight as donor_weight",
-        "slice.slice_time",
-        "pre_cell.ext_id as pre_cell_id",
-        "pre_cell.cre_type as pre_cre_type",
-        "pre_cell.target_layer as pre_target_layer",
-        "pre_morphology.pyramidal as pre_pyramidal",
-        "post_cell.ext_id as post_cell_id",
-        "post_cell.cre_type as post_cre_type",
-        "post_cell.target_layer as post_target_layer",
-        "post_morphology.pyramidal as post_pyramidal",
-        "pair.synapse",
-        "pair.distance",
-        "pair.crosstalk_artifact",
-        "abs(post_cell.ext_id - pre_cell.ext_id) as electrode_distance",
-    ]
-    # columns.extend([
-    #     "detection_limit.minimum_amplitude",
-    # ])
-
-    joins = [
-        "join pair on connection_strength.pair_id=pair.id",
-        "join cell pre_cell on pair.pre_cell_id=pre_cell.id",
-        "join cell post_cell on pair.post_cell_id=post_cell.id",
-        "join morphology pre_morphology on pre_morphology.cell_id=pre_cell.id",
-        "join morphology post_morphology on post_morphology.cell_id=post_cell.id",
-        "join experiment on pair.experiment_id=experiment.id",
-        "join slice on experiment.slice_id=slice.id",
-    ]
-    # joins.extend([
-    #     "left join detection_limit on detection_limit.pair_id=pair.id",
-    # ])
-
-
-    query = ("""
-    select 
-    {columns}
-    from connection_strength
-    {joins}
-    order by acq_timestamp
-    """).format(
-        columns=", ".join(columns), 
-        joins=" ".join(joins),
-    )
+    """Return connection strength records for all pairs (see connection_strength.query_all_pairs).
 
-    session = db.Session()
-    df = pandas.read_sql(query, session.bind)
-
-    recs = df.to_records()
+    If *classifier* is given, then the results of its predictions are added to the records.
+    """
+    recs = connection_strength.query_all_pairs()
 
     if classifier is None:
         return recs
 
-    # Fit classifier and add results of classifier prediction in to records
-    classifier.fit(recs)
+    # add results of classifier prediction in to records
     prediction = classifier.predict(recs)
     recs = join_struct_arrays([recs, prediction])
     return recs
 
 
 pair_classifier = None
-def get_pair_classifier(**kwds):
+def get_pair_classifier(seed=0, use_vc_features=True):
+    """Return the pair classifier saved by the pipeline (see multipatch_analysis.pair_classifier),
+    or train a new one if no saved classifier is available for this configuration or the saved
+    classifier was trained on an older version of the data.
+    """
     global pair_classifier
     if pair_classifier is None:
-        pair_classifier = PairClassifier(**kwds)
+        pair_classifier = load_pair_classifier(seed=seed, use_vc_features=use_vc_features)
+        if pair_classifier is None:
+            print("No saved pair classifier found; training a new one (run util/analyze_pair_classifier.py to save).")
+        elif pair_classifier.data_version != data_version():
+            print("Saved pair classifier is out of date; training a new one (run util/analyze_pair_classifier.py to save).")
+            pair_classifier = None
+        if pair_classifier is None:
+            pair_classifier = train_pair_classifier(seed=seed, use_vc_features=use_vc_features, n_jobs=-1)
     return pair_classifier
     
 
@@ -597,200 +554,6 @@ def prs_qc():
     return rrec, w
 
 
-class PairClassifier(object):
-    """Supervised classifier used to predict whether a cell pair is synaptically connected.
-
-    Input records should be similar to those generated by query_all_pairs()
-    """
-    def __init__(self, seed=None, use_vc_features=True):
-        ic_features = [
-            # 'ic_amp_mean',
-            # 'ic_amp_stdev',
-            # 'ic_amp_ks2samp',  # hurts perfornamce
-            'ic_deconv_amp_mean',
-            # 'ic_deconv_amp_stdev',
-            'ic_deconv_amp_ks2samp',
-            'ic_latency_mean',
-            'ic_latency_stdev',
-            'ic_latency_ks2samp',
-            # 'ic_crosstalk_mean',
-            'ic_fit_amp',
-            'ic_fit_xoffset',
-            'ic_fit_yoffset',
-            'ic_fit_rise_time',
-            #'ic_fit_rise_power',
-            'ic_fit_decay_tau',
-            #'ic_fit_exp_amp',
-            'ic_fit_nrmse',
-
-        ]
-        vc_features = [
-            # 'vc_amp_mean',  # hurts perfornamce
-            # 'vc_amp_stdev',
-            'vc_amp_ks2samp',
-            # 'vc_deconv_amp_mean',
-            # 'vc_deconv_amp_stdev',
-            # 'vc_deconv_amp_ks2samp',  # hurts performance
-            # 'vc_latency_mean',
-            # 'vc_latency_stdev',  # hurts performance
-            'vc_latency_ks2samp',
-
-            'vc_fit_amp',
-            'vc_fit_xoffset',
-            'vc_fit_yoffset',
-            'vc_fit_rise_time',
-            #'vc_fit_rise_power',
-            'vc_fit_decay_tau',
-            #'vc_fit_exp_amp',
-            'vc_fit_nrmse',
-        ]
-        general_features = [
-            # 'electrode_distance',
-        ]
-
-        self.features = general_features + ic_features
-        if use_vc_features:
-             self.features.extend(vc_features)
-
-        # Random seed used when shuffling training/test inputs
-        self.seed = seed
-
-    def fit(self, recs):
-        ids = recs['id']
-
-        # Select features from records
-        features = np.array([tuple(r) for r in recs[self.features]])
-
-        # QC bad records; don't train on these
-        mask = (recs['ic_n_samples'] > 100) & (recs['ic_crosstalk_mean'] < 60e-6)
-
-        x = features[mask]
-        y = recs['synapse'][mask].astype(bool)
-        ids = ids[mask]
-
-        # shuffle
-        order = np.arange(len(y))
-        rand = np.random.RandomState(seed=self.seed)
-        rand.shuffle(order)
-        x = x[order]
-        y = y[order]
-        ids = ids[order]
-
-        # mask out nan/inf records
-        mask2 = np.all(np.isfinite(x), axis=1) & np.isfinite(y)
-        x = x[mask2]
-        y = y[mask2]
-        ids = ids[mask2]
-        mask[mask] = mask2
-
-        # prescale records, keep the scaler for later processing
-        scaler = sklearn.preprocessing.StandardScaler().fit(x)
-        x = scaler.transform(x)
-        self.scaler = scaler
-
-        # split into training and test sets
-        # select training set from connected and non-connected separately to ensure 
-        # we get enough connected examples in the training set
-        train_mask = np.zeros(len(y), dtype='bool')
-        syn = np.argwhere(y)
-        n = len(syn) // 4 * 3
-        train_mask[syn[:n]] = True
-        other = np.arange(len(y))[~train_mask]
-        rand.shuffle(other)
-        # 1/5 of training data is connected, the rest is unconnected
-        train_mask[other[:n*5]] = True
-
-        train_x = x[train_mask]
-        train_y = y[train_mask]
-        test_x = x[~train_mask]
-        test_y = y[~train_mask]
-        print("Train: %d  test: %d   random seed: %s" % (len(train_y), len(test_y), self.seed))
-
-        # build and fit the classifier
-        #clf = sklearn.svm.LinearSVC()
-        clf = sklearn.svm.SVC(C=1, class_weight='balanced', coef0=0.0,
-        decision_function_shape='ovr', degree=3, gamma='auto', kernel='rbf',
-        max_iter=-1, probability=True, random_state=self.seed)
-        # clf = sklearn.ensemble.RandomForestClassifier()
-
-        hyper_params = [{'C': [1, 10, 100, 1000], 'gamma': [0.1, 0.01, 0.001, 0.0001]}]
-        clf = sklearn.model_selection.GridSearchCV(clf, hyper_params)
-        self.clf = clf
-
-        clf.fit(train_x, train_y)
-        print("Classifier best hyperparameters:", clf.best_params_)
-
-        def test(clf, test_x, test_y):
-            pred = clf.predict(test_x)
-            def pr(name, pred, test_y):
-                print("%s:  %d/%d  %0.2f%%" % (name, (pred & test_y).sum(), test_y.sum(), 100 * (pred & test_y).sum() / test_y.sum()))
-                
-            pr(" True positive", pred, test_y)
-            pr("False positive", pred, ~test_y)
-            pr(" True negative", ~pred, ~test_y)
-            pr("False negative", ~pred, test_y)
-
-        print("TRAIN:")
-        test(clf, train_x, train_y)
-
-        print("TEST:")
-        test(clf, test_x, test_y)
-
-        # calculate approximate probability threshold between classes
-        pred = self.predict(recs)
-        min_prob = pred[pred['prediction'] == True]['confidence'].min()
-        max_prob = pred[pred['prediction'] == False]['confidence'].max()
-        self.prob_threshold = (min_prob + max_prob) / 2.
-
-    def predict(self, recs=None):
-        """Predict connectivity for a sequence of records output from analyze_response_strength
-
-        Input may be a structured array or list of dicts.
-        """
-        # Select features from records
-        if isinstance(recs, np.ndarray):
-            features = np.array([tuple(r) for r in recs[self.features]])
-        else:
-            features = np.array([tuple(map(r.__getitem__, self.features)) for r in recs])
-
-        # prepare ouptut array
-        result = np.empty(len(features), dtype=[('prediction', float), ('confidence', float)])
-        result[:] = np.nan
-
-        # mask out inf/nan records
-        mask = np.all(np.isfinite(features), axis=1)
-
-        # scale masked records
-        norm_features = self.scaler.transform(features[mask])
-
-        # fill in output array
-        result['prediction'][mask] = self.clf.predict(norm_features)
-        # result['confidence'][mask] = clf.decision_function(norm_features)
-        result['confidence'][mask] = self.clf.predict_proba(norm_features)[:,1]
-        # result['confidence'][mask] = clf.predict_proba(norm_features)[:,1]
-        assert np.isfinite(result[mask]['confidence']).sum() > 0
-        return result
-
-
-def join_struct_arrays(arrays):
-    """Join two structured arrays together.
-
-    This is the most inefficient possible approach, but other methods
-    don't work well with object dtypes.
-    """
-    dtype = []
-    for arr in arrays:
-        for name in arr.dtype.names:
-            dtype.append((str(name), arr.dtype.fields[name][0].str))
-    arr = np.empty(len(arrays[0]), dtype=dtype)
-    for i in range(len(arr)):
-        v = ()
-        for a in arrays:
-            v = v + tuple(a[i])
-        arr[i] = v
-    return arr
-
-
 class PairScatterPlot(pg.QtCore.QObject):
     """Create a ScatterPlotWidget that displays results selected with query_all_pairs()
     """
@@ -948,109 +711,10 @@ class PairView(pg.QtCore.QObject):
         
 
 
-
-def str_analysis_result_table(results, recs):
-    """Convert output of strength_analysis.analyze_response_strength to look like
-    the result was queried from the DB using get_amps() or get_baseline()
-    """
-    dtype = [
-        ('id', int),
-        ('pos_amp', float),
-        ('neg_amp', float),
-        ('pos_dec_amp', float),
-        ('neg_dec_amp', float),
-        ('pos_dec_latency', float),
-        ('neg_dec_latency', float),
-        ('crosstalk', float),
-        ('ex_qc_pass', bool),
-        ('in_qc_pass', bool),
-        ('clamp_mode', object),
-        ('pulse_number', int),
-        ('max_dvdt_time', float),
-        ('response_start_time', float),
-        ('data', object),
-        ('rec_start_time', float),
-    ]
-    
-    table = np.empty(len(recs), dtype=dtype)
-    for i,rec in enumerate(recs):
-        for key in ['ex_qc_pass', 'in_qc_pass', 'clamp_mode', 'data']:
-            table[i][key] = getattr(rec, key)
-        result = results[i]
-        for key,val in result.items():
-            if key in table.dtype.names:
-                table[i][key] = val
-        table[i]['max_dvdt_time'] = 10e-3
-        table[i]['response_start_time'] = 0
-    return table
-
-
-class RecordWrapper(object):
-    """Wraps records returned from DB so that we can override some values.
-    """
-    def __init__(self, rec):
-        self._rec = rec
-    def __getattr__(self, attr):
-        return getattr(self._rec, attr)
-        
-
-def simulate_response(fg_recs, bg_results, amp, rtime, seed=None):
-    if seed is not None:
-        np.random.seed(seed)
-
-    dt = 1.0 / db.default_sample_rate
-    t = np.arange(0, 15e-3, dt)
-    template = Psp.psp_func(t, xoffset=0, yoffset=0, rise_time=rtime, decay_tau=15e-3, amp=1, rise_power=2)
-
-    r_amps = scipy.stats.binom.rvs(p=0.2, n=24, size=len(fg_recs)) * scipy.stats.norm.rvs(scale=0.3, loc=1, size=len(fg_recs))
-    r_amps *= amp / r_amps.mean()
-    r_latency = np.random.normal(size=len(fg_recs), scale=200e-6, loc=13e-3)
-    fg_results = []
-    traces = []
-    fg_recs = [RecordWrapper(rec) for rec in fg_recs]  # can't modify fg_recs, so we wrap records with a mutable shell
-    for k,rec in enumerate(fg_recs):
-        rec.data = rec.data.copy()
-        start = int(r_latency[k] * db.default_sample_rate)
-        length = len(rec.data) - start
-        rec.data[start:] += template[:length] * r_amps[k]
-
-        fg_result = analyze_response_strength(rec, 'baseline')
-        fg_results.append(fg_result)
-
-        traces.append(Trace(rec.data, sample_rate=db.default_sample_rate))
-        traces[-1].amp = r_amps[k]
-    fg_results = str_analysis_result_table(fg_results, fg_recs)
-    conn_result = analyze_pair_connectivity({('ic', 'fg'): fg_results, ('ic', 'bg'): bg_results, ('vc', 'fg'): [], ('vc', 'bg'): []}, sign=1)
-    return conn_result, traces
-
-
 def simulate_connection(fg_recs, bg_results, classifier, amp, rtime, n_trials=8):
     """Run repeated simulation trials adding a synthetic PSP to recorded background noise.
     """
-    import pyqtgraph.multiprocess as mp
-    result = {'results': [], 'rise_time': rtime, 'amp': amp}
-
-    sim_results = [None] * n_trials
-    with mp.Parallelize(range(n_trials), results=sim_results, workers=8) as tasker:
-        for ii in tasker:
-            tasker.results[ii] = simulate_response(fg_recs, bg_results, amp, rtime, seed=ii)
-
-    for k in range(len(sim_results)):
-        conn_result, traces = sim_results[k]
-
-        result['results'].append(conn_result)
-        result['traces'] = traces
-        # print(conn_result)
-        # print(dict([(k, conn_result[k]) for k in classifier.features]))
-
-    pred = classifier.predict(result['results'])
-    result['predictions'] = pred['prediction']
-    result['confidence'] = pred['confidence']
-    # print("\nrise time:", rtime, " amplitude:", amp)
-    # print(pred)
-        
-    return result
-
+    return simulate_detection(fg_recs, bg_results, classifier, [amp], rtime, n_trials=n_trials)[0]
 
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@
 from __future__ import print_function, division
 
 from collections import OrderedDict
+import numpy as np
 from .database import database as db
 from .morphology import Morphology
 from . import constants
@@ -62,6 +63,41 @@ class CellClass(object):
         pyr = self.criteria.get('pyramidal')
         return cre == 'unknown' or cre in constants.EXCITATORY_CRE_TYPES or pyr is True
 
+    def match(self, columns):
+        """Return a boolean array indicating which cells are members of this class.
+
+        Parameters
+        ----------
+        columns : dict
+            Maps each criteria name to an array of values for that column, one element per
+            cell (see cell_columns()).
+        """
+        mask = None
+        for k, v in self.criteria.items():
+            if k not in columns:
+                raise Exception('Cannot use "%s" for cell typing; attribute not found on cell or cell.morphology' % k)
+            col_mask = np.asarray(columns[k], dtype=object) == v
+            mask = col_mask if mask is None else (mask & col_mask)
+        if mask is None:
+            # no criteria; every cell is a member
+            n_cells = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+            mask = np.ones(n_cells, dtype=bool)
+        return mask
+
+    def sql_filter(self):
+        """Return an SQL expression that selects cells belonging to this class.
+
+        The expression refers to columns of the cell and morphology tables, so queries using
+        it must join Morphology::
+
+            q = session.query(db.Cell.id).outerjoin(Morphology).filter(cell_class.sql_filter())
+        """
+        conditions = []
+        for k, v in self.criteria.items():
+            col = criteria_column(k)
+            conditions.append(col.is_(None) if v is None else col == v)
+        return db.and_(*conditions) if len(conditions) > 0 else db.sqlalchemy.true()
+
     def __contains__(self, cell):
         morpho = cell.morphology
         for k, v in self.criteria.items():
@@ -112,7 +148,8 @@ def classify_cells(cell_classes, cells=None, pairs=None, session=None):
         List of pairs from which cells will be collected. May not be used with *cells* or *session*
     session: Session | None
         If *cells* is not provided, then a database session may be given instead from which
-        cells will be selected.
+        cells will be selected. In this case, classification is done by the database (see
+        classify_cell_ids()) and only the cells that belong to at least one class are loaded.
         
     Returns
     -------
@@ -139,16 +176,115 @@ def classify_cells(cell_classes, cells=None, pairs=None, session=None):
         assert cells is None, "cells and pairs arguments are mutually exclusive"
         assert session is None, "session and pairs arguments are mutually exclusive"
         cells = set([p.pre_cell for p in pairs] + [p.post_cell for p in pairs])
+
     if cells is None:
-        cells = session.query(db.Cell, db.Cell.cre_type, db.Cell.target_layer, Morphology.pyramidal).join(Morphology)
-    cell_groups = OrderedDict([(cell_class, set()) for cell_class in cell_classes])
-    for cell in cells:
-        for cell_class in cell_classes:
-            if cell in cell_class:
-                cell_groups[cell_class].add(cell)
+        cell_ids = classify_cell_ids(cell_classes, session)
+        member_ids = set()
+        for ids in cell_ids.values():
+            member_ids.update(int(i) for i in ids)
+        if len(member_ids) == 0:
+            cells = {}
+        else:
+            cells = {cell.id: cell for cell in session.query(db.Cell).filter(db.Cell.id.in_(member_ids))}
+        return OrderedDict([(cell_class, set([cells[int(i)] for i in ids])) for cell_class, ids in cell_ids.items()])
+
+    cells = list(cells)
+    columns = cell_columns(cells, criteria_columns(cell_classes))
+
+    membership = class_membership(cell_classes, columns, len(cells))
+    cell_groups = OrderedDict()
+    for j, cell_class in enumerate(cell_classes):
+        cell_groups[cell_class] = set([cells[i] for i in np.flatnonzero(membership[:, j])])
     return cell_groups
 
 
+def classify_cell_ids(cell_classes, session):
+    """Classify all cells in the database without loading any Cell or Morphology records.
+
+    The criteria for all *cell_classes* are compiled into SQL (see CellClass.sql_filter()) and
+    evaluated by the database in a single query that returns one boolean membership column per
+    class.
+
+    Returns
+    -------
+    cell_groups : OrderedDict
+        Dictionary mapping {cell_class: array of cell IDs}
+    """
+    cell_classes = list(cell_classes)
+    member_cols = [db.func.coalesce(cell_class.sql_filter(), False).label('class_%d' % i) for i, cell_class in enumerate(cell_classes)]
+    rows = session.query(db.Cell.id, *member_cols).outerjoin(Morphology).all()
+
+    cell_ids = np.array([row[0] for row in rows], dtype=int)
+    membership = np.array([row[1:] for row in rows], dtype=bool).reshape(len(rows), len(cell_classes))
+    return OrderedDict([(cell_class, cell_ids[membership[:, j]]) for j, cell_class in enumerate(cell_classes)])
+
+
+def criteria_column(name):
+    """Return the Cell or Morphology column used to evaluate criteria *name* in SQL.
+    """
+    if hasattr(db.Cell, name):
+        return getattr(db.Cell, name)
+    elif hasattr(Morphology, name):
+        return getattr(Morphology, name)
+    else:
+        raise Exception('Cannot use "%s" for cell typing; column not found in cell or morphology tables' % name)
+
+
+def criteria_columns(cell_classes):
+    """Return the list of all column names used as criteria by any of *cell_classes*.
+    """
+    names = []
+    for cell_class in cell_classes:
+        for k in cell_class.criteria:
+            if k not in names:
+                names.append(k)
+    return names
+
+
+def cell_columns(cells, names):
+    """Collect the values of the columns *names* from a list of cells in a single pass.
+
+    Each name is looked up first on the cell and then on cell.morphology. Returns a dict
+    mapping each name to an object array with one value per cell.
+    """
+    columns = OrderedDict([(k, np.empty(len(cells), dtype=object)) for k in names])
+    for i, cell in enumerate(cells):
+        morpho = None
+        for k in names:
+            if hasattr(cell, k):
+                columns[k][i] = getattr(cell, k)
+                continue
+            if morpho is None:
+                morpho = cell.morphology
+            if hasattr(morpho, k):
+                columns[k][i] = getattr(morpho, k)
+            else:
+                raise Exception('Cannot use "%s" for cell typing; attribute not found on cell or cell.morphology' % k)
+    return columns
+
+
+def class_membership(cell_classes, columns, n_cells):
+    """Return a boolean array of shape (n_cells, n_classes) where element [i, j] is True if
+    cell i is a member of cell_classes[j]. *columns* is the output of cell_columns().
+    """
+    membership = np.ones((n_cells, len(cell_classes)), dtype=bool)
+    for j, cell_class in enumerate(cell_classes):
+        if n_cells > 0 and len(cell_class.criteria) > 0:
+            membership[:, j] = cell_class.match(columns)
+    return membership
+
+
+def cell_class_index(cell_groups):
+    """Given the output of classify_cells(), return a dict mapping each cell to the set of
+    indices (into cell_groups) of the classes it belongs to.
+    """
+    index = {}
+    for i, group in enumerate(cell_groups.values()):
+        for cell in group:
+            index.setdefault(cell, set()).add(i)
+    return index
+
+
 def classify_pairs(pairs, cell_groups):
     """Given a list of cell pairs and a dict that groups cells together by class (ie the output of classify_cells),
     return a dict that groups pairs into (pre, post) cell type buckets.
@@ -166,11 +302,25 @@ def classify_pairs(pairs, cell_groups):
     pair_groups : OrderedDict
         Maps {(pre_class, post_class): [list of pairs]}
     """
+    classes = list(cell_groups.keys())
+    n_classes = len(classes)
+    buckets = [[[] for j in range(n_classes)] for i in range(n_classes)]
+
+    # each pair is visited once and appended to every (pre, post) bucket it belongs to
+    index = cell_class_index(cell_groups)
+    no_classes = set()
+    for pair in pairs:
+        pre_classes = index.get(pair.pre_cell, no_classes)
+        if len(pre_classes) == 0:
+            continue
+        post_classes = index.get(pair.post_cell, no_classes)
+        for i in pre_classes:
+            for j in post_classes:
+                buckets[i][j].append(pair)
+
     results = OrderedDict()
-    for pre_class, pre_group in cell_groups.items():
-        for post_class, post_group in cell_groups.items():
-            post_group = cell_groups[post_class]
-            class_pairs = [p for p in pairs if p.pre_cell in pre_group and p.post_cell in post_group]
-            results[(pre_class, post_class)] = class_pairs
+    for i, pre_class in enumerate(classes):
+        for j, post_class in enumerate(classes):
+            results[(pre_class, post_class)] = buckets[i][j]
     
     return results
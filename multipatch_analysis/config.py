@@ -6,6 +6,10 @@ Local variables in this module are overwritten by the contents of config.yml
 """
 
 import os, yaml
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 
 synphys_db_host = None
@@ -15,12 +19,15 @@ synphys_db_readonly_user = "readonly"
 synphys_data = None
 cache_path = "cache"
 grow_cache = False
+cache_size_limit = None
+pyramid_cache_size = 2e9
 rig_name = None
 n_headstages = 8
 raw_data_paths = []
 rig_data_paths = {}
 known_addrs = {}
 import_old_data_on_submission = False
+lims_cache = True
 
 
 template = r"""
@@ -36,6 +43,10 @@ synphys_data: "N:\\"
 
 cache_path: "E:\\multipatch_analysis_cache"
 grow_cache: true
+# optional limit on the total size of cached files, in bytes
+cache_size_limit: null
+# limit on the total size of display pyramids cached for viewed sweeps, in bytes
+pyramid_cache_size: 2000000000
 rig_name: 'MP_'
 n_headstages: 8
 
@@ -67,10 +78,16 @@ backup_paths:
 """
 
 configfile = os.path.join(os.path.dirname(__file__), '..', 'config.yml')
-if not os.path.isfile(configfile):
-    open(configfile, 'wb').write(template)
-
-config = yaml.load(open(configfile, 'rb'))
+if os.path.isfile(configfile):
+    config = yaml.load(open(configfile, 'rb'), Loader=_Loader)
+else:
+    # Write a template for the user to edit. Processes that cannot write here (for example,
+    # workers running from a read-only installation) just use the template values.
+    try:
+        open(configfile, 'w').write(template)
+    except (IOError, OSError):
+        pass
+    config = yaml.load(template, Loader=_Loader)
 
 for k,v in config.items():
     locals()[k] = v
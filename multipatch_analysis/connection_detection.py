@@ -1,14 +1,12 @@
 from copy import deepcopy
 import numpy as np
 import scipy.signal
-import pyqtgraph as pg
 
 from .data import MultiPatchProbe, Analyzer, PulseStimAnalyzer
 from . import qc
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.fitting import StackedPsp, Psp
-from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.filter import bessel_filter
 
 class BaselineDistributor(Analyzer):
@@ -335,6 +333,9 @@ class NDDict(object):
 
 
 def plot_response_averages(expt, show_baseline=False, **kwds):
+    import pyqtgraph as pg
+    from neuroanalysis.ui.plot_grid import PlotGrid
+
     analyzer = MultiPatchExperimentAnalyzer.get(expt)
     devs = analyzer.list_devs()
 
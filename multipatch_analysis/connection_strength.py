@@ -8,7 +8,6 @@ from __future__ import print_function, division
 import sys, multiprocessing, time
 
 import numpy as np
-import pandas
 import scipy.stats
 
 from neuroanalysis.data import Trace, TraceList
@@ -18,6 +17,7 @@ from .database import database as db
 from .pulse_response_strength import PulseResponseStrength, BaselineResponseStrength
 from .connection_detection import fit_psp
 from .database import TableGroup
+from .record_array import read_sql_records
 
 
 class ConnectionStrengthTableGroup(TableGroup):
@@ -123,14 +123,13 @@ connection_strength_tables = ConnectionStrengthTableGroup()
 
 
 def init_tables():
-    global ConnectionStrength
-    connection_strength_tables.create_tables()
-
-    ConnectionStrength = connection_strength_tables['connection_strength']
+    """Create tables in the database if they do not exist yet (see TableGroup.ensure_tables).
+    """
+    connection_strength_tables.ensure_tables()
 
 
-# create tables in database and add global variables for ORM classes
-init_tables()
+# add global variables for ORM classes
+ConnectionStrength = connection_strength_tables['connection_strength']
 
 
 
@@ -138,6 +137,7 @@ init_tables()
 def update_connection_strength(limit=0, expts=None, parallel=True, workers=6, raise_exceptions=False, session=None):
     """Update connection strength table for all experiments
     """
+    init_tables()
     if expts is None:
         expts_ready = session.query(db.Experiment.acq_timestamp).join(db.SyncRec).join(db.Recording).join(db.PulseResponse).join(PulseResponseStrength).distinct().all()
         expts_done = session.query(db.Experiment.acq_timestamp).join(db.Pair).join(ConnectionStrength).distinct().all()
@@ -246,8 +246,7 @@ def get_amps(session, pair, clamp_mode='ic', get_data=False):
     # should result in chronological order
     q = q.order_by(db.PulseResponse.id)
 
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
+    recs = read_sql_records(q.statement, q.session.bind)
     return recs
 
 
@@ -294,8 +293,7 @@ def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
     # if amps is not None:
     #     q = q.limit(len(amps))
 
-    df = pandas.read_sql_query(q.statement, q.session.bind)
-    recs = df.to_records()
+    recs = read_sql_records(q.statement, q.session.bind)
 
     if amps is not None:
         # for each record returned from get_amps, return the nearest baseline record
@@ -314,6 +312,71 @@ def get_baseline_amps(session, pair, clamp_mode='ic', amps=None, get_data=True):
     return recs
 
 
+@db.default_session
+def query_all_pairs(session=None):
+    """Return a structured array containing connection strength results for all pairs, joined with
+    experiment, slice, cell, and morphology metadata.
+
+    Records are ordered by experiment acquisition timestamp.
+    """
+    columns = [
+        "connection_strength.*",
+        "experiment.id as experiment_id",
+        "experiment.acq_timestamp as acq_timestamp",
+        "experiment.rig_name",
+        "experiment.acsf",
+        "slice.species as donor_species",
+        "slice.genotype as donor_genotype",
+        "slice.age as donor_age",
+        "slice.sex as donor_sex",
+        "slice.quality as slice_quality",
+        "slice.weight as donor_weight",
+        "slice.slice_time",
+        "pre_cell.ext_id as pre_cell_id",
+        "pre_cell.cre_type as pre_cre_type",
+        "pre_cell.target_layer as pre_target_layer",
+        "pre_morphology.pyramidal as pre_pyramidal",
+        "post_cell.ext_id as post_cell_id",
+        "post_cell.cre_type as post_cre_type",
+        "post_cell.target_layer as post_target_layer",
+        "post_morphology.pyramidal as post_pyramidal",
+        "pair.synapse",
+        "pair.distance",
+        "pair.crosstalk_artifact",
+        "abs(post_cell.ext_id - pre_cell.ext_id) as electrode_distance",
+    ]
+    # columns.extend([
+    #     "detection_limit.minimum_amplitude",
+    # ])
+
+    joins = [
+        "join pair on connection_strength.pair_id=pair.id",
+        "join cell pre_cell on pair.pre_cell_id=pre_cell.id",
+        "join cell post_cell on pair.post_cell_id=post_cell.id",
+        "join morphology pre_morphology on pre_morphology.cell_id=pre_cell.id",
+        "join morphology post_morphology on post_morphology.cell_id=post_cell.id",
+        "join experiment on pair.experiment_id=experiment.id",
+        "join slice on experiment.slice_id=slice.id",
+    ]
+    # joins.extend([
+    #     "left join detection_limit on detection_limit.pair_id=pair.id",
+    # ])
+
+
+    query = ("""
+    select 
+    {columns}
+    from connection_strength
+    {joins}
+    order by acq_timestamp
+    """).format(
+        columns=", ".join(columns), 
+        joins=" ".join(joins),
+    )
+
+    return read_sql_records(query, session.bind)
+
+
 def join_pulse_response_to_expt(query):
     pre_rec = db.aliased(db.Recording)
     post_rec = db.aliased(db.Recording)
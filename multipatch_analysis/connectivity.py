@@ -11,6 +11,7 @@ from statsmodels.stats.proportion import proportion_confint
 from .database import database as db
 from .connection_strength import ConnectionStrength
 from .morphology import Morphology
+from .cell_class import classify_cells, classify_pairs
 
 
 def measure_connectivity(pair_groups):
@@ -106,3 +107,76 @@ def pair_was_probed(pair, excitatory):
     # of experiments included, but increase sensitivity for weaker connections
     return getattr(pair, qc_field) > 10
 
+
+def data_version(session):
+    """Return a value that changes whenever pairs or connection strength results are added to,
+    removed from, or updated in the database.
+
+    Row counts and ids alone are not enough: when a table is dropped and rebuilt its serial ids
+    start over, so the creation / modification times of its rows are included as well.
+    """
+    return session.query(
+        db.func.count(db.Pair.id),
+        db.func.max(db.Pair.id),
+        db.func.max(db.Pair.time_created),
+        db.func.max(db.Pair.time_modified),
+        db.func.count(ConnectionStrength.id),
+        db.func.max(ConnectionStrength.id),
+        db.func.max(ConnectionStrength.time_created),
+        db.func.max(ConnectionStrength.time_modified),
+    ).one()
+
+
+def class_key(cell_class):
+    # cell class names do not include every criteria, so cache by the criteria themselves
+    return tuple(sorted(cell_class.criteria.items()))
+
+
+class MatrixCache(object):
+    """Caches the pairs, cell groups, and per-element analysis results used to build a matrix.
+
+    Everything is discarded when the filter settings or the pair / connection strength data
+    change. Otherwise, cell groups are kept per cell class and analysis results are kept per
+    (pre_class, post_class) element, so that editing the list of cell classes only requires
+    analyzing the matrix elements that involve new classes.
+    """
+    def __init__(self, analysis_func):
+        self.analysis_func = analysis_func
+        self.clear()
+
+    def clear(self):
+        self.key = None
+        self.pairs = None
+        self.cell_groups = {}
+        self.elements = {}
+
+    def get_results(self, cell_classes, filters, session):
+        """Return (cell_groups, results) for *cell_classes*, where results is the output of
+        analysis_func for every (pre_class, post_class) element.
+
+        *filters* is a dict of keyword arguments for query_pairs.
+        """
+        key = (tuple(sorted(filters.items())), data_version(session))
+        if key != self.key:
+            self.clear()
+            # make sure pairs are reloaded rather than pulled from the session's identity map
+            session.expire_all()
+            self.key = key
+            self.pairs = query_pairs(session=session, **filters).all()
+
+        new_classes = [c for c in cell_classes if class_key(c) not in self.cell_groups]
+        if len(new_classes) > 0:
+            for cell_class, group in classify_cells(new_classes, pairs=self.pairs).items():
+                self.cell_groups[class_key(cell_class)] = group
+        cell_groups = OrderedDict([(c, self.cell_groups[class_key(c)]) for c in cell_classes])
+
+        elements = [(pre, post) for pre in cell_classes for post in cell_classes]
+        missing = [e for e in elements if (class_key(e[0]), class_key(e[1])) not in self.elements]
+        if len(missing) > 0:
+            pair_groups = classify_pairs(self.pairs, cell_groups)
+            new_results = self.analysis_func(OrderedDict([(e, pair_groups[e]) for e in missing]))
+            for pre, post in missing:
+                self.elements[(class_key(pre), class_key(post))] = new_results[(pre, post)]
+
+        results = OrderedDict([((pre, post), self.elements[(class_key(pre), class_key(post))]) for pre, post in elements])
+        return cell_groups, results
@@ -0,0 +1,155 @@
+"""
+Persistent store for the pipeline dashboard.
+
+Checking the status of an experiment touches several file systems, LIMS, and the database, so the
+dashboard records the result of each check in an SQLite file under config.cache_path. When the
+dashboard starts, stored results are displayed immediately, and the pollers only queue
+experiments whose files have changed (see site_signature), whose last check did not pass (see
+record_complete), or whose last check is too old.
+
+"""
+from __future__ import print_function
+
+import os, time, json, pickle, sqlite3, threading, traceback
+
+from . import config
+
+
+fail_color = (255, 200, 200)
+pass_color = (200, 255, 200)
+
+# pipeline stages that must pass for an experiment to be considered complete
+status_fields = ['description', 'archive', 'NAS', 'backup', 'data', 'submitted', 'connections',
+                 'site.mosaic', 'DB', 'LIMS', '20x', 'cell map', '63x']
+
+
+def site_signature(site_path):
+    """Return modification times for the files and folders that describe an experiment site:
+    the site and slice folders (which change when files are added or removed), the site, slice,
+    and experiment .index files, and pipettes.yml (None for any that are missing).
+    """
+    slice_path = os.path.join(site_path, '..')
+    paths = [
+        site_path,
+        os.path.join(site_path, '.index'),
+        os.path.join(site_path, 'pipettes.yml'),
+        slice_path,
+        os.path.join(slice_path, '.index'),
+        os.path.join(slice_path, '..', '.index'),
+    ]
+    return [os.path.getmtime(p) if os.path.exists(p) else None for p in paths]
+
+
+def persistent_record(rec):
+    """Return a copy of a dashboard record that can be stored: references to live objects are
+    removed and exception info is converted to a formatted traceback.
+    """
+    rec = {k: v for k, v in rec.items() if k not in ('experiment', 'item')}
+    err = rec.get('error')
+    if err is not None and not isinstance(err, str):
+        rec['error'] = ''.join(traceback.format_exception(*err))
+    return rec
+
+
+def record_complete(rec):
+    """Return True if every pipeline stage in a dashboard record has passed.
+
+    A stage passes if its value is True or '-' (not applicable), or a (text, color) tuple shown
+    in pass_color. Records with an error or with stages that have not been checked yet are not
+    complete. Incomplete experiments can change without any change to their site folders (for
+    example, when they are imported into the DB or copied to the NAS), so they are rechecked
+    more often.
+    """
+    if rec.get('error') is not None:
+        return False
+    for field in status_fields:
+        if field not in rec:
+            return False
+        val = rec[field]
+        if isinstance(val, tuple):
+            if tuple(val[1]) != pass_color:
+                return False
+        elif field == 'description':
+            if val is None:
+                return False
+        elif val is not True and val != '-':
+            return False
+    return True
+
+
+class DashboardStatusStore(object):
+    """Stores the last known signature of each site folder and the result of the last status
+    check of each experiment, backed by an SQLite file.
+
+    A single store may be shared between threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._db.execute("""
+                create table if not exists sites (
+                    path text primary key, signature text, timestamp real
+                )""")
+            self._db.execute("""
+                create table if not exists status (
+                    timestamp real primary key, site_path text, record blob, checked real, complete integer
+                )""")
+            self._db.commit()
+
+    def site(self, path):
+        """Return (signature, timestamp) recorded for the site folder at *path*, or None.
+        """
+        with self._lock:
+            row = self._db.execute("select signature, timestamp from sites where path=?", (path,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set_site(self, path, signature, timestamp):
+        with self._lock:
+            self._db.execute("insert or replace into sites (path, signature, timestamp) values (?, ?, ?)",
+                             (path, json.dumps(signature), timestamp))
+            self._db.commit()
+
+    def last_check(self, timestamp):
+        """Return (checked_time, complete) for the last check of the experiment with *timestamp*,
+        or None if it has not been checked. *complete* is the result of record_complete().
+        """
+        with self._lock:
+            row = self._db.execute("select checked, complete from status where timestamp=?", (round(timestamp, 3),)).fetchone()
+        return None if row is None else (row[0], bool(row[1]))
+
+    def save_record(self, timestamp, site_path, rec):
+        """Store the result of checking an experiment (see persistent_record).
+        """
+        blob = sqlite3.Binary(pickle.dumps(persistent_record(rec), protocol=2))
+        complete = int(record_complete(rec))
+        with self._lock:
+            self._db.execute("insert or replace into status (timestamp, site_path, record, checked, complete) values (?, ?, ?, ?, ?)",
+                             (round(timestamp, 3), site_path, blob, time.time(), complete))
+            self._db.commit()
+
+    def records(self):
+        """Return a list of (timestamp, site_path, record, checked) for all stored experiments,
+        newest first.
+        """
+        with self._lock:
+            rows = self._db.execute("select timestamp, site_path, record, checked from status order by timestamp desc").fetchall()
+        return [(ts, path, pickle.loads(bytes(rec)), checked) for ts, path, rec, checked in rows]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Return the DashboardStatusStore kept in config.cache_path.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            if not os.path.isdir(config.cache_path):
+                os.makedirs(config.cache_path)
+            _store = DashboardStatusStore(os.path.join(config.cache_path, 'dashboard_status.sqlite'))
+    return _store
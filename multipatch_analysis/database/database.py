@@ -213,6 +213,7 @@ class TableGroup(object):
     """
     def __init__(self):
         self.mappings = {}
+        self._tables_checked = None
         self.create_mappings()
 
     def __getitem__(self, item):
@@ -224,20 +225,35 @@ class TableGroup(object):
 
     def drop_tables(self):
         global engine_rw
+        _check_engine()
         for k in self.schemas:
             if k in engine_rw.table_names():
                 self[k].__table__.drop(bind=engine_rw)
+        self._tables_checked = None
 
     def create_tables(self):
         global engine_rw, engine_ro
+        _check_engine()
         if engine_rw is None:
             for k in self.schemas:
                 if k not in engine_ro.table_names():
                     raise Exception("Table %s not found in database %s" % (k, db_address_ro))
-            return
-        for k in self.schemas:
-            if k not in engine_rw.table_names():
-                self[k].__table__.create(bind=engine_rw)
+        else:
+            for k in self.schemas:
+                if k not in engine_rw.table_names():
+                    self[k].__table__.create(bind=engine_rw)
+        self._tables_checked = os.getpid()
+
+    def ensure_tables(self):
+        """Call create_tables() unless it has already been called by this process.
+
+        Table groups do not touch the database when they are defined, so modules that declare
+        them can be imported without a database connection. Each module instead provides an
+        init_tables() function that calls this method before its tables are first queried or
+        updated.
+        """
+        if self._tables_checked != os.getpid():
+            self.create_tables()
 
 
 
@@ -375,8 +391,8 @@ def create_all_mappings():
 
         @property
         def nwb_cache_file(self):
-            from ..synphys_cache import SynPhysCache
-            return SynPhysCache().get_cache(self.nwb_file)
+            from ..synphys_cache import get_cache
+            return get_cache().get_cache(self.nwb_file)
 
         @property
         def data(self):
@@ -479,12 +495,16 @@ def create_all_mappings():
 
 
 #-------------- initial DB access ----------------
+# Engines are created on first use (see _check_engine) rather than at import time, so that
+# modules which only need the ORM classes can be imported without a reachable database.
 engine_ro = None
 engine_rw = None
 engine_pid = None  # pid of process that created this engine. 
 def init_engine():
-    global engine_ro, engine_rw, engine_pid
+    global engine_ro, engine_rw, engine_pid, _sessionmaker_ro, _sessionmaker_rw
     dispose_engines()
+    _sessionmaker_ro = None
+    _sessionmaker_rw = None
     
     engine_ro = create_engine(db_address_ro, pool_size=10, max_overflow=40, isolation_level='AUTOCOMMIT')
     if db_address_rw is not None:
@@ -502,7 +522,18 @@ def dispose_engines():
         engine_rw = None
     engine_pid = None    
 
-init_engine()
+
+def _check_engine():
+    """Create database engines if they have not been created yet by this process.
+    """
+    if os.getpid() != engine_pid:
+        # In forked processes, we need to re-initialize the engine before
+        # creating a new session, otherwise child processes will
+        # inherit and muck with the same connections. See:
+        # http://docs.sqlalchemy.org/en/rel_1_0/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
+        if engine_pid is not None:
+            print("Making new session for subprocess %d != %d" % (os.getpid(), engine_pid))
+        init_engine()
 
 
 _sessionmaker_ro = None
@@ -516,15 +547,7 @@ def Session(readonly=True):
     open after each request.
     """
     global _sessionmaker_ro, _sessionmaker_rw, engine_ro, engine_rw, engine_pid
-    if os.getpid() != engine_pid:
-        # In forked processes, we need to re-initialize the engine before
-        # creating a new session, otherwise child processes will
-        # inherit and muck with the same connections. See:
-        # http://docs.sqlalchemy.org/en/rel_1_0/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
-        if engine_pid is not None:
-            print("Making new session for subprocess %d != %d" % (os.getpid(), engine_pid))
-        init_engine()
-        _sessionmaker_ro = None
+    _check_engine()
     
     if _sessionmaker_ro is None:
         _sessionmaker_ro = sessionmaker(bind=engine_ro)
@@ -580,6 +603,7 @@ def vacuum(tables=None):
     Should be run after any significant changes to the database.
     """
     global engine_rw
+    _check_engine()
     with engine_rw.begin() as conn:
         conn.connection.set_isolation_level(0)
         if tables is None:
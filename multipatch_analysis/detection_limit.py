@@ -0,0 +1,390 @@
+# coding: utf8
+"""
+Analyses that estimate the minimum synaptic strength that could be detected for each pair.
+
+Synthetic PSPs of increasing amplitude are added to recorded background noise, and the pair
+classifier is used to decide whether each simulated connection would have been detected. The
+detection limit is the amplitude at which the classifier confidence crosses its threshold.
+
+"""
+from __future__ import print_function, division
+
+import sys, multiprocessing, time
+
+import numpy as np
+import scipy.stats
+
+from neuroanalysis.data import Trace
+from neuroanalysis.baseline import float_mode
+from neuroanalysis.fitting import Psp
+
+from .database import database as db
+from .database import TableGroup
+from .pulse_response_strength import BaselineResponseStrength, baseline_query, analyze_response_strength, deconv_filter
+from .connection_strength import get_amps, get_baseline_amps, analyze_pair_connectivity, query_all_pairs
+from .pair_classifier import load_pair_classifier
+
+
+class DetectionLimitTableGroup(TableGroup):
+    schemas = {
+        'detection_limit': [
+            """Estimated minimum PSP amplitude that could be detected for each pair, measured by adding
+            synthetic PSPs to recorded background noise and running the pair classifier.
+            """,
+            ('pair_id', 'pair.id', 'The ID of the entry in the pair table to which these results apply', {'index': True}),
+            ('simulation_results', 'object', 'Classifier predictions and confidence for each simulated amplitude'),
+            ('minimum_amplitude', 'float', 'Interpolated PSP amplitude (V) at which classifier confidence crosses its threshold'),
+            ('compute_time', 'float', 'Time (s) spent computing the detection limit for this pair'),
+        ]
+    }
+
+    def create_mappings(self):
+        TableGroup.create_mappings(self)
+
+        DetectionLimit = self['detection_limit']
+
+        db.Pair.detection_limit = db.relationship(DetectionLimit, back_populates="pair", cascade="delete", single_parent=True, uselist=False)
+        DetectionLimit.pair = db.relationship(db.Pair, back_populates="detection_limit", single_parent=True)
+
+
+detection_limit_tables = DetectionLimitTableGroup()
+
+
+def init_tables():
+    """Create tables in the database if they do not exist yet (see TableGroup.ensure_tables).
+    """
+    detection_limit_tables.ensure_tables()
+
+
+# add global variables for ORM classes
+DetectionLimit = detection_limit_tables['detection_limit']
+
+
+# classifier configuration used to decide whether simulated connections were detected
+classifier_config = {'seed': 0, 'use_vc_features': False}
+
+
+def pair_qc_mask(recs):
+    """Return a mask selecting records from query_all_pairs() that have usable current clamp data.
+    """
+    with np.errstate(invalid='ignore'):
+        mask = np.isfinite(recs['ic_deconv_amp_mean'])
+        # remove recordings with gain errors
+        mask &= recs['ic_deconv_amp_mean'] < 0.02
+        # remove recordings with high crosstalk
+        mask &= abs(recs['ic_crosstalk_mean']) < 60e-6
+        # remove recordings with low sample count
+        mask &= recs['ic_n_samples'] > 50
+    return mask
+
+
+@db.default_session
+def update_detection_limits(limit=0, pair_ids=None, parallel=True, workers=6, raise_exceptions=False, session=None):
+    """Update detection_limit table for all pairs that pass QC and do not have a detection limit yet.
+    """
+    init_tables()
+    if load_pair_classifier(**classifier_config) is None:
+        raise Exception("No saved pair classifier available; run util/analyze_pair_classifier.py first.")
+
+    if pair_ids is None:
+        recs = query_all_pairs(session=session)
+        recs = recs[pair_qc_mask(recs)]
+        pairs_done = set([rec.pair_id for rec in session.query(DetectionLimit.pair_id).all()])
+        print("Skipping %d already complete pairs" % len(pairs_done))
+        pending = [(rec['acq_timestamp'], int(rec['pair_id'])) for rec in recs if int(rec['pair_id']) not in pairs_done]
+
+        if limit > 0:
+            np.random.shuffle(pending)
+            pending = pending[:limit]
+    else:
+        pending = [(ts, pid) for pid, ts in session.query(db.Pair.id, db.Experiment.acq_timestamp).join(db.Experiment).filter(db.Pair.id.in_(pair_ids)).all()]
+
+    # one job per experiment so that each job writes all of its results in a single commit
+    by_expt = {}
+    for expt_id, pair_id in pending:
+        by_expt.setdefault(expt_id, []).append(pair_id)
+    jobs = [(expt_id, by_expt[expt_id], index, len(by_expt)) for index, expt_id in enumerate(sorted(by_expt))]
+
+    if parallel:
+        pool = multiprocessing.Pool(processes=workers)
+        pool.map(compute_detection_limits, jobs)
+    else:
+        for job in jobs:
+            compute_detection_limits(job, raise_exceptions=raise_exceptions)
+
+
+_classifier = None
+
+def compute_detection_limits(job_info, raise_exceptions=False):
+    """Fill the detection_limit table for a list of pairs from a single experiment.
+    """
+    global _classifier
+    session = db.Session(readonly=False)
+
+    try:
+        expt_id, pair_ids, index, n_jobs = job_info
+        print("Measuring detection limits (expt_id=%f): %d/%d" % (expt_id, index, n_jobs))
+
+        # each worker process loads the saved classifier once
+        if _classifier is None:
+            _classifier = load_pair_classifier(**classifier_config)
+
+        entries = []
+        for pair in session.query(db.Pair).filter(db.Pair.id.in_(pair_ids)).all():
+            start = time.time()
+            results, limit = measure_detection_limit(pair, _classifier, session=session)
+            entries.append(DetectionLimit(
+                pair_id=pair.id,
+                simulation_results=results,
+                minimum_amplitude=limit,
+                compute_time=time.time() - start,
+            ))
+
+        session.add_all(entries)
+        session.commit()
+    except:
+        session.rollback()
+        print("Error in experiment: %f" % expt_id)
+        if raise_exceptions:
+            raise
+        else:
+            sys.excepthook(*sys.exc_info())
+
+
+def measure_detection_limit(pair, classifier, session, rise_time=2e-3):
+    """Estimate the minimum PSP amplitude that *classifier* could detect in the background noise
+    recorded from the postsynaptic cell of *pair*.
+
+    Returns a list of simulation results (one per amplitude, up to the detection threshold) and
+    the interpolated minimum amplitude (None if the threshold was never crossed).
+    """
+    amps = get_amps(session, pair)
+    base_amps = get_baseline_amps(session, pair, amps=amps, clamp_mode='ic')
+
+    q = baseline_query(session)
+    q = q.join(BaselineResponseStrength)
+    q = q.filter(BaselineResponseStrength.id.in_(base_amps['id']))
+    bg_recs = q.all()
+
+    # measure background connection strength
+    bg_results = [analyze_response_strength(rec, 'baseline') for rec in bg_recs]
+    bg_results = str_analysis_result_table(bg_results, bg_recs)
+
+    # background data is used to simulate foreground
+    # (but this will be biased due to lack of crosstalk in background data)
+    fg_recs = bg_recs
+
+    # now measure foreground simulated under different conditions
+    sim_amps = 2e-6 * 2**np.arange(9)
+    sim_amps[0] = 0
+    sim_results = simulate_detection(fg_recs, bg_results, classifier, sim_amps, rise_time, threshold=classifier.prob_threshold)
+
+    results = []
+    avg_conf = []
+    limit = None
+    for i, result in enumerate(sim_results):
+        amp = result['amp']
+        results.append({'amp': amp, 'rise_time': rise_time, 'predictions': list(result['predictions']), 'confidence': list(result['confidence'])})
+        avg_conf.append(result['confidence'].mean())
+        # if we crossed threshold, interpolate to estimate the minimum amplitude
+        # (results above threshold are not stored)
+        if i > 0 and avg_conf[-1] > classifier.prob_threshold:
+            a1 = sim_amps[i-1]
+            a2 = amp
+            c1, c2 = avg_conf[-2:]
+            s = (classifier.prob_threshold - c1) / (c2 - c1)
+            limit = a1 + s * (a2 - a1)
+            break
+
+    return results, limit
+
+
+def str_analysis_result_table(results, recs):
+    """Convert output of strength_analysis.analyze_response_strength to look like
+    the result was queried from the DB using get_amps() or get_baseline()
+    """
+    dtype = [
+        ('id', int),
+        ('pos_amp', float),
+        ('neg_amp', float),
+        ('pos_dec_amp', float),
+        ('neg_dec_amp', float),
+        ('pos_dec_latency', float),
+        ('neg_dec_latency', float),
+        ('crosstalk', float),
+        ('ex_qc_pass', bool),
+        ('in_qc_pass', bool),
+        ('clamp_mode', object),
+        ('pulse_number', int),
+        ('max_dvdt_time', float),
+        ('response_start_time', float),
+        ('data', object),
+        ('rec_start_time', float),
+    ]
+    
+    table = np.empty(len(recs), dtype=dtype)
+    for i,rec in enumerate(recs):
+        for key in ['ex_qc_pass', 'in_qc_pass', 'clamp_mode', 'data']:
+            table[i][key] = getattr(rec, key)
+        result = results[i]
+        for key,val in result.items():
+            if key in table.dtype.names:
+                table[i][key] = val
+        table[i]['max_dvdt_time'] = 10e-3
+        table[i]['response_start_time'] = 0
+    return table
+
+
+def simulate_detection(fg_recs, bg_results, classifier, amps, rtime, n_trials=8, threshold=None):
+    """Simulate connections with every amplitude in *amps* by adding a synthetic PSP to recorded
+    background noise, and return a list of results (one per amplitude). Each result is a dict
+    with the connectivity analysis results, classifier predictions and confidence for every
+    trial, and the simulated traces from the last trial.
+
+    If *threshold* is given, *amps* must be in ascending order, and simulation stops after the
+    first amplitude (other than the first) whose mean classifier confidence exceeds *threshold*;
+    results are only returned up to that amplitude.
+
+    Rather than running analyze_response_strength() on every simulated record, all trials and
+    amplitudes are processed together:
+
+    * Each background record is filtered and measured only once, and filtered templates are
+      computed once per onset sample. The filtered response to (background + scaled template)
+      is taken to be the filtered background plus the scaled, filtered template.
+    * Peaks for all amplitudes, trials, and records are measured as array operations within the
+      response window.
+
+    This is an approximation: the median baseline subtracted in deconv_filter() and the
+    zero-phase Bessel filter both see a small part of the PSP onset, so the filtered sum is not
+    exactly the sum of the filtered parts. Measured amplitudes agree with the per-record analysis
+    to within a small fraction of the simulated amplitude (see tests/test_detection_limit.py).
+    """
+    amps = np.asarray(amps, dtype=float)
+    sample_rate = db.default_sample_rate
+    n_recs = len(fg_recs)
+
+    # same fake stimulus timing that analyze_response_strength uses for background data
+    pulse_times = [10e-3, 12e-3]
+    spike_time = 11e-3
+
+    t = np.arange(0, 15e-3, 1.0 / sample_rate)
+    template = Psp.psp_func(t, xoffset=0, yoffset=0, rise_time=rtime, decay_tau=15e-3, amp=1, rise_power=2)
+
+    # random amplitude scale factors and onset samples for every trial, each drawn from a
+    # RandomState seeded with the trial number
+    r_scale = np.empty((n_trials, n_recs))
+    r_start = np.empty((n_trials, n_recs), dtype=int)
+    for i in range(n_trials):
+        rng = np.random.RandomState(i)
+        r_amps = scipy.stats.binom.rvs(p=0.2, n=24, size=n_recs, random_state=rng) * scipy.stats.norm.rvs(scale=0.3, loc=1, size=n_recs, random_state=rng)
+        r_scale[i] = r_amps / r_amps.mean()
+        r_start[i] = (rng.normal(size=n_recs, scale=200e-6, loc=13e-3) * sample_rate).astype(int)
+
+    # measure background records once, and compute raw / filtered templates once per onset sample
+    raw_base = np.empty(n_recs)
+    dec_base = np.empty(n_recs)
+    crosstalk = np.empty(n_recs)
+    raw_bg = []
+    dec_bg = []
+    psps = [[None] * n_recs for i in range(n_trials)]
+    raw_tmpl = [[None] * n_recs for i in range(n_trials)]
+    dec_tmpl = [[None] * n_recs for i in range(n_trials)]
+    template_cache = {}
+    for j, rec in enumerate(fg_recs):
+        tau = 15e-3 if rec.clamp_mode == 'ic' else 5e-3
+        raw_trace = Trace(rec.data, sample_rate=sample_rate)
+        dec_trace = deconv_filter(raw_trace, pulse_times, tau=tau)
+        raw_base[j], raw_inds, _ = _peak_window(raw_trace, spike_time, pulse_times)
+        dec_base[j], dec_inds, dec_times = _peak_window(dec_trace, spike_time, pulse_times)
+        raw_bg.append(raw_trace.data[raw_inds])
+        dec_bg.append(dec_trace.data[dec_inds])
+
+        # crosstalk is measured before the PSP onset, so it is the same as in the background
+        p1 = raw_trace.time_slice(pulse_times[0]-200e-6, pulse_times[0]).median()
+        p2 = raw_trace.time_slice(pulse_times[0], pulse_times[0]+200e-6).median()
+        crosstalk[j] = p2 - p1
+
+        for i in range(n_trials):
+            key = (len(rec.data), r_start[i, j], tau)
+            if key not in template_cache:
+                psp = np.zeros(len(rec.data))
+                start = r_start[i, j]
+                length = min(len(template), len(psp) - start)
+                psp[start:start+length] = template[:length]
+                dec_psp = deconv_filter(Trace(psp, sample_rate=sample_rate), pulse_times, tau=tau)
+                template_cache[key] = (psp, psp[raw_inds], dec_psp.data[dec_inds])
+            psps[i][j], raw_tmpl[i][j], dec_tmpl[i][j] = template_cache[key]
+
+    raw_bg = np.array(raw_bg)
+    dec_bg = np.array(dec_bg)
+    raw_tmpl = np.array(raw_tmpl)
+    dec_tmpl = np.array(dec_tmpl)
+
+    # measure peaks for all (amplitude, trial, record) combinations at once
+    scale = amps[:, None, None, None] * r_scale[None, :, :, None]
+    raw = raw_bg[None, None] + scale * raw_tmpl[None]
+    dec = dec_bg[None, None] + scale * dec_tmpl[None]
+    pos_amp = raw.max(axis=-1) - raw_base
+    neg_amp = raw.min(axis=-1) - raw_base
+    pos_ind = dec.argmax(axis=-1)
+    neg_ind = dec.argmin(axis=-1)
+    pos_dec_amp = dec.max(axis=-1) - dec_base
+    neg_dec_amp = dec.min(axis=-1) - dec_base
+    pos_dec_latency = dec_times[pos_ind] - spike_time
+    neg_dec_latency = dec_times[neg_ind] - spike_time
+
+    # run connectivity analysis on each simulated (amplitude, trial); this is the expensive part,
+    # so amplitudes are analyzed in ascending order until the threshold is crossed
+    bg_table = str_analysis_result_table([{'crosstalk': c} for c in crosstalk], fg_recs)
+    results = []
+    for a, amp in enumerate(amps):
+        conn_results = []
+        for i in range(n_trials):
+            fg_results = bg_table.copy()
+            for j, rec in enumerate(fg_recs):
+                fg_results['data'][j] = rec.data + psps[i][j] * (amp * r_scale[i, j])
+            fg_results['pos_amp'] = pos_amp[a, i]
+            fg_results['neg_amp'] = neg_amp[a, i]
+            fg_results['pos_dec_amp'] = pos_dec_amp[a, i]
+            fg_results['neg_dec_amp'] = neg_dec_amp[a, i]
+            fg_results['pos_dec_latency'] = pos_dec_latency[a, i]
+            fg_results['neg_dec_latency'] = neg_dec_latency[a, i]
+            conn_result = analyze_pair_connectivity({('ic', 'fg'): fg_results, ('ic', 'bg'): bg_results, ('vc', 'fg'): [], ('vc', 'bg'): []}, sign=1)
+            conn_results.append(conn_result)
+
+        pred = classifier.predict(conn_results)
+
+        # traces from the last trial are kept for display
+        traces = []
+        for j, rec in enumerate(fg_recs):
+            k = r_scale[-1, j] * amp
+            traces.append(Trace(rec.data + psps[-1][j] * k, sample_rate=sample_rate))
+            traces[-1].amp = k
+
+        results.append({
+            'results': conn_results,
+            'rise_time': rtime,
+            'amp': amp,
+            'traces': traces,
+            'predictions': pred['prediction'],
+            'confidence': pred['confidence'],
+        })
+
+        if threshold is not None and a > 0 and pred['confidence'].mean() > threshold:
+            break
+
+    return results
+
+
+def _peak_window(trace, spike_time, pulse_times, spike_delay=1e-3, response_window=4e-3):
+    """Return the baseline, sample indices, and time values of the response window used by
+    pulse_response_strength.measure_peak() for *trace*.
+    """
+    response_start = spike_time + spike_delay
+    response_stop = response_start + response_window
+    baseline = float_mode(trace.time_slice(0, pulse_times[0] - 50e-6).data)
+
+    # slice a trace of sample indices so that the window exactly matches Trace.time_slice()
+    index = Trace(np.arange(len(trace.data), dtype=float), dt=trace.dt, t0=trace.t0)
+    response = index.time_slice(response_start, response_stop)
+    return baseline, response.data.astype(int), response.time_values
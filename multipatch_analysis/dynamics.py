@@ -0,0 +1,164 @@
+# coding: utf8
+"""
+Analyses that measure short-term synaptic dynamics (induction and recovery) for each
+stimulus condition recorded from a pair.
+
+"""
+from __future__ import print_function, division
+
+import sys, multiprocessing, time
+
+import numpy as np
+
+from .database import database as db
+from .database import TableGroup
+from .connection_strength import ConnectionStrength
+from .synaptic_dynamics import DynamicsAnalyzer
+
+
+class DynamicsTableGroup(TableGroup):
+    schemas = {
+        'dynamics': [
+            """Describes short-term dynamics of synaptic responses, one record per pair per set of
+            stimulus parameters (induction frequency, recovery delay, and holding potential).
+            Amplitudes are measured from exponentially deconvolved, averaged train responses.
+            """,
+            ('pair_id', 'pair.id', 'The ID of the entry in the pair table to which these results apply', {'index': True}),
+            ('induction_frequency', 'float', 'The induction frequency (Hz) of presynaptic pulses', {'index': True}),
+            ('recovery_delay', 'float', 'The recovery delay (s) inserted between presynaptic induction and recovery pulses', {'index': True}),
+            ('holding_potential', 'float', 'Rounded postsynaptic holding potential (V) during these recordings'),
+            ('n_sweeps', 'int', 'Number of sweeps averaged to generate the amplitudes in this record'),
+            ('amp_sign', 'str', 'Sign ("+" or "-") of the peaks measured from the deconvolved trains'),
+            ('pulse_offsets', 'array', 'Times (s) of all presynaptic pulses relative to the first pulse'),
+            ('induction_amps', 'array', 'Deconvolved peak amplitudes for each pulse in the induction train'),
+            ('recovery_amps', 'array', 'Deconvolved peak amplitudes for each pulse in the recovery train'),
+            ('paired_pulse_ratio', 'float', 'Ratio of the second to first induction amplitude'),
+            ('induction_ratio', 'float', 'Ratio of the mean of the last two induction amplitudes to the first induction amplitude'),
+            ('recovery_ratio', 'float', 'Ratio of the first recovery amplitude to the first induction amplitude'),
+        ],
+    }
+
+    def create_mappings(self):
+        TableGroup.create_mappings(self)
+
+        Dynamics = self['dynamics']
+
+        db.Pair.dynamics = db.relationship(Dynamics, back_populates="pair", cascade="delete", single_parent=True)
+        Dynamics.pair = db.relationship(db.Pair, back_populates="dynamics", single_parent=True)
+
+
+dynamics_tables = DynamicsTableGroup()
+
+
+def init_tables():
+    """Create tables in the database if they do not exist yet (see TableGroup.ensure_tables).
+    """
+    dynamics_tables.ensure_tables()
+
+
+# add global variables for ORM classes
+Dynamics = dynamics_tables['dynamics']
+
+
+@db.default_session
+def update_dynamics(limit=0, expts=None, parallel=True, workers=6, raise_exceptions=False, session=None):
+    """Update dynamics table for all experiments
+    """
+    init_tables()
+    if expts is None:
+        expts_ready = session.query(db.Experiment.acq_timestamp).join(db.Pair).join(ConnectionStrength).distinct().all()
+        expts_done = session.query(db.Experiment.acq_timestamp).filter(db.Experiment.meta.has_key('dynamics_timestamp')).all()
+
+        print("Skipping %d already complete experiments" % (len(expts_done)))
+        experiments = [e for e in expts_ready if e not in set(expts_done)]
+
+        if limit > 0:
+            np.random.shuffle(experiments)
+            experiments = experiments[:limit]
+
+        jobs = [(record.acq_timestamp, index, len(experiments)) for index, record in enumerate(experiments)]
+    else:
+        jobs = [(expt, i, len(expts)) for i, expt in enumerate(expts)]
+
+    if parallel:
+        pool = multiprocessing.Pool(processes=workers)
+        pool.map(compute_dynamics, jobs)
+    else:
+        for job in jobs:
+            compute_dynamics(job, raise_exceptions=raise_exceptions)
+
+
+def compute_dynamics(job_info, raise_exceptions=False):
+    """Fill the dynamics table for all synaptically connected pairs in the given experiment.
+    """
+    session = db.Session(readonly=False)
+
+    try:
+        expt_id, index, n_jobs = job_info
+        print("Analyzing dynamics (expt_id=%f): %d/%d" % (expt_id, index, n_jobs))
+
+        expt = db.experiment_from_timestamp(expt_id, session=session)
+
+        for pair in expt.pair_list:
+            if pair.synapse is not True or pair.connection_strength is None:
+                continue
+
+            for results in analyze_pair_dynamics(pair):
+                dyn = Dynamics(pair_id=pair.id, **results)
+                session.add(dyn)
+
+        # experiments with no connected pairs are also marked as complete
+        expt.meta = expt.meta.copy()  # required by sqlalchemy to flag as modified
+        expt.meta['dynamics_timestamp'] = time.time()
+
+        session.commit()
+    except:
+        session.rollback()
+        print("Error in experiment: %f" % expt_id)
+        if raise_exceptions:
+            raise
+        else:
+            sys.excepthook(*sys.exc_info())
+
+
+def analyze_pair_dynamics(pair, analyzer=None):
+    """Measure deconvolved train amplitudes for every set of stimulus parameters recorded from *pair*.
+
+    The sign of the measured peaks is taken from the synapse type chosen by the connection_strength
+    analysis (current clamp only; excitatory synapses produce positive deflections).
+
+    Returns a list of dicts, one per stimulus condition, suitable for creating Dynamics records.
+    """
+    if analyzer is None:
+        analyzer = DynamicsAnalyzer(pair.experiment, pair.pre_cell.ext_id, pair.post_cell.ext_id, method='deconv', align_to='spike')
+    amp_sign = '+' if pair.connection_strength.synapse_type == 'ex' else '-'
+
+    train_responses = analyzer.train_responses
+    if len(train_responses) == 0:
+        return []
+
+    analyzer.measure_train_amps_from_deconv(amp_sign={'amp_sign': amp_sign})
+
+    records = []
+    for stim_params, (t, amps) in analyzer.train_amplitudes.items():
+        ind_freq, rec_delay, holding = stim_params
+        ind_amps = amps[:8]
+        rec_amps = amps[8:]
+        rec = {
+            'induction_frequency': ind_freq,
+            'recovery_delay': rec_delay,
+            'holding_potential': holding,
+            'n_sweeps': len(train_responses[stim_params][0]),
+            'amp_sign': amp_sign,
+            'pulse_offsets': np.asarray(t, dtype=float),
+            'induction_amps': np.asarray(ind_amps, dtype=float),
+            'recovery_amps': np.asarray(rec_amps, dtype=float),
+        }
+        if ind_amps[0] != 0:
+            rec['paired_pulse_ratio'] = ind_amps[1] / ind_amps[0]
+            rec['induction_ratio'] = np.mean(ind_amps[-2:]) / ind_amps[0]
+            if len(rec_amps) > 0:
+                rec['recovery_ratio'] = rec_amps[0] / ind_amps[0]
+        records.append(rec)
+
+    return records
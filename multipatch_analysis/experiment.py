@@ -12,8 +12,6 @@ import pickle
 from collections import OrderedDict
 
 import yaml
-import pyqtgraph as pg
-import pyqtgraph.configfile
 
 from . import lims
 from .constants import ALL_CRE_TYPES, ALL_LABELS, FLUOROPHORES, LAYERS
@@ -22,10 +20,20 @@ from .electrode import Electrode
 from .data import MultiPatchExperiment
 from .pipette_metadata import PipetteMetadata
 from .genotypes import Genotype
-from .synphys_cache import SynPhysCache
+from .synphys_cache import get_cache
 from . import yaml_local, config
 
 
+def read_index_file(filename):
+    """Read an acq4 .index file.
+
+    pyqtgraph (and with it, Qt) is only imported when needed so that pipeline tools can import
+    this module without GUI libraries.
+    """
+    import pyqtgraph.configfile
+    return pyqtgraph.configfile.readConfigFile(filename)
+
+
 class Experiment(object):
     def __init__(self, site_path=None, entry=None, yml_file=None, verify=True):
         self.entry = entry
@@ -781,7 +789,7 @@ class Experiment(object):
             index = os.path.join(self.path, '.index')
             if not os.path.isfile(index):
                 return None
-            self._site_info = pg.configfile.readConfigFile(index)['.']
+            self._site_info = read_index_file(index)['.']
         return self._site_info
 
     @property
@@ -790,7 +798,7 @@ class Experiment(object):
             index = os.path.join(os.path.split(self.path)[0], '.index')
             if not os.path.isfile(index):
                 return None
-            self._slice_info = pg.configfile.readConfigFile(index)['.']
+            self._slice_info = read_index_file(index)['.']
         return self._slice_info
 
     @property
@@ -807,7 +815,7 @@ class Experiment(object):
             index = os.path.join(self.expt_path, '.index')
             if not os.path.isfile(index):
                 raise TypeError("Cannot find index file (%s) for experiment %s" % (index, self))
-            self._expt_info = pg.configfile.readConfigFile(index)['.']
+            self._expt_info = read_index_file(index)['.']
         return self._expt_info
 
     @property
@@ -841,7 +849,7 @@ class Experiment(object):
     def nwb_cache_file(self):
         if self.nwb_file is None:
             return None
-        return SynPhysCache().get_cache(self.nwb_file)
+        return get_cache().get_cache(self.nwb_file)
 
     @property
     def data(self):
@@ -1064,6 +1072,7 @@ class Experiment(object):
         return self.slice_info.get('project', None)
 
     def show(self):
+        import pyqtgraph as pg
         if self._view is None:
             pg.mkQApp()
             self._view_widget = pg.GraphicsLayoutWidget()
@@ -0,0 +1,322 @@
+# *-* coding: utf-8 *-*
+"""
+Persistent, incremental catalog of the experiments found on the server.
+
+The catalog is a directory containing a small index (one record per site, keyed by the path
+to the site's pipettes.yml) and one pickled Experiment per site. Each record stores the
+modification times of the files an Experiment is built from, so that updating the catalog
+only re-parses sites whose files have changed. Experiments are unpickled lazily, the first
+time anything other than their uid / timestamp / source_id is requested. Records also carry
+the metadata used to index experiments (see experiment_index.py), so an ExperimentList can be
+queried without loading any experiments.
+
+"""
+from __future__ import print_function, division
+
+import os, sys, glob, pickle, hashlib, datetime, traceback, multiprocessing
+from collections import OrderedDict
+
+from .experiment import Experiment
+from .experiment_index import expt_metadata
+from . import config
+
+
+# Increment whenever changes to Experiment invalidate previously cached sites
+catalog_version = 2
+
+
+def find_sites(data_path=None):
+    """Return paths to all pipettes.yml files found under *data_path* (default is config.synphys_data).
+    """
+    if data_path is None:
+        data_path = config.synphys_data
+    return sorted(glob.glob(os.path.join(data_path, '*', 'slice_*', 'site_*', 'pipettes.yml')))
+
+
+def site_mtimes(yml_file):
+    """Return modification times for all files an Experiment is loaded from: the pipettes.yml file
+    and the site, slice, and experiment .index files (None for any that are missing).
+    """
+    site_path = os.path.dirname(yml_file)
+    files = [
+        yml_file,
+        os.path.join(site_path, '.index'),
+        os.path.join(site_path, '..', '.index'),
+        os.path.join(site_path, '..', '..', '.index'),
+    ]
+    return tuple([os.path.getmtime(f) if os.path.isfile(f) else None for f in files])
+
+
+def site_key(site_id):
+    """Return the file name (without extension) used to store the site identified by *site_id*.
+    """
+    return hashlib.md5(str(site_id).encode('utf8')).hexdigest()
+
+
+class CatalogExperiment(object):
+    """Placeholder for an Experiment stored in an ExperimentCatalog.
+
+    The uid, timestamp, datetime, source_id, and indexed metadata are available immediately from
+    the catalog record; accessing any other attribute loads the complete Experiment from disk.
+    """
+    def __init__(self, catalog, record):
+        self._catalog = catalog
+        self._record = record
+        self._expt = None
+
+    @property
+    def experiment(self):
+        if self._expt is None:
+            self._expt = self._catalog.load_experiment(self._record)
+        return self._expt
+
+    @property
+    def loaded(self):
+        return self._expt is not None
+
+    @property
+    def uid(self):
+        return self._record['uid']
+
+    @property
+    def timestamp(self):
+        return self._record['timestamp']
+
+    @property
+    def datetime(self):
+        return datetime.datetime.fromtimestamp(self._record['timestamp'])
+
+    @property
+    def source_id(self):
+        return self._record['source_id']
+
+    @property
+    def _metadata(self):
+        return self._record['meta']
+
+    @_metadata.setter
+    def _metadata(self, meta):
+        self._record['meta'] = meta
+
+    def __getattr__(self, name):
+        if name in ('_catalog', '_record', '_expt') or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+        return getattr(self.experiment, name)
+
+    def __repr__(self):
+        if self._expt is not None:
+            return repr(self._expt)
+        return "<Experiment %s uid=%s (not loaded)>" % (self.source_id[0], self.uid)
+
+
+class ExperimentCatalog(object):
+    """A directory of cached experiments with an index of per-site records.
+
+    Parameters
+    ----------
+    path : str
+        Directory where the catalog is stored. It is created when the catalog is first written.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.index_file = os.path.join(self.path, 'index.pkl')
+        self.site_path = os.path.join(self.path, 'sites')
+        self.records = OrderedDict()
+        if os.path.isfile(self.index_file):
+            self._read_index()
+
+    def _read_index(self):
+        index = pickle.load(open(self.index_file, 'rb'))
+        ver = index.get('catalog_version')
+        if ver != catalog_version:
+            print("Ignoring experiment catalog %s due to incompatible version (%s != %s)" % (self.path, ver, catalog_version))
+            return
+        self.records = index['records']
+
+    def write_index(self):
+        if not os.path.isdir(self.site_path):
+            os.makedirs(self.site_path)
+        index = {'catalog_version': catalog_version, 'records': self.records}
+        # write to a temporary file first so that readers never see a partially written index
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump(index, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
+        os.rename(tmp_file, self.index_file)
+
+    def experiments(self):
+        """Return a list of CatalogExperiments for every site in the catalog, without loading any
+        of them from disk.
+        """
+        return [CatalogExperiment(self, rec) for rec in self.records.values()]
+
+    def expt_file(self, site_id):
+        return os.path.join(self.site_path, site_key(site_id) + '.pkl')
+
+    def load_experiment(self, record):
+        return pickle.load(open(self.expt_file(record['site_id']), 'rb'))
+
+    def add_experiment(self, expt, mtimes=None):
+        """Write *expt* to the catalog, replacing any previous version of the same site.
+
+        The index is not written until write_index() is called.
+        """
+        if not os.path.isdir(self.site_path):
+            os.makedirs(self.site_path)
+        rec = make_record(expt, mtimes)
+        _write_expt(expt, self.expt_file(rec['site_id']))
+        self.records[rec['site_id']] = rec
+        return rec
+
+    def remove_site(self, site_id):
+        self.records.pop(site_id)
+        expt_file = self.expt_file(site_id)
+        if os.path.isfile(expt_file):
+            os.remove(expt_file)
+
+    def update(self, yml_files=None, workers=None):
+        """Bring the catalog up to date with the pipettes.yml files on the server.
+
+        Only sites that are new, or whose yml / .index files have changed since they were
+        cataloged, are parsed; this is done in parallel using *workers* processes (default is one
+        per CPU). Sites that no longer exist are removed from the catalog. The index is written
+        when the update completes.
+
+        Returns the list of records that were (re)loaded and a list of (yml_file, traceback)
+        for any sites that failed to load.
+        """
+        if yml_files is None:
+            yml_files = find_sites()
+
+        jobs = []
+        mtimes = {}
+        for yml_file in yml_files:
+            mtimes[yml_file] = site_mtimes(yml_file)
+            rec = self.records.get(yml_file)
+            if rec is not None and rec['mtimes'] == mtimes[yml_file]:
+                continue
+            jobs.append((yml_file, self.expt_file(yml_file)))
+
+        for site_id in list(self.records.keys()):
+            if site_id not in mtimes and self.records[site_id]['mtimes'] is not None:
+                # site was removed from the server (text-format entries have no mtimes; keep them)
+                self.remove_site(site_id)
+
+        print("Experiment catalog: %d sites up to date, %d to load" % (len(yml_files) - len(jobs), len(jobs)))
+        if not os.path.isdir(self.site_path):
+            os.makedirs(self.site_path)
+
+        pool, results = _map_sites(_load_site, jobs, workers)
+        loaded = []
+        errs = []
+        try:
+            for yml_file, rec, err in results:
+                if err is not None:
+                    errs.append((yml_file, err))
+                    # forget any stale version of this site so that it is retried next time
+                    if yml_file in self.records:
+                        self.remove_site(yml_file)
+                    continue
+                rec['mtimes'] = mtimes[yml_file]
+                self.records[yml_file] = rec
+                loaded.append(rec)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.write_index()
+        return loaded, errs
+
+
+def make_record(expt, mtimes=None):
+    """Return the catalog record describing *expt*.
+    """
+    site_id = expt.source_id[0] if expt.source_id[1] is None else expt.source_id
+    return {
+        'site_id': site_id,
+        'mtimes': mtimes,
+        'uid': expt.uid,
+        'timestamp': expt.timestamp,
+        'source_id': expt.source_id,
+        'meta': expt_metadata(expt),
+    }
+
+
+def _write_expt(expt, expt_file):
+    tmp_file = expt_file + '.tmp'
+    with open(tmp_file, 'wb') as fh:
+        pickle.dump(expt, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(expt_file):
+        os.remove(expt_file)
+    os.rename(tmp_file, expt_file)
+
+
+def load_sites(yml_files, workers=None):
+    """Parse the experiments described by *yml_files* in parallel, without caching them.
+
+    Returns a list of Experiments and a list of (yml_file, traceback) for any sites that failed to load.
+    """
+    pool, results = _map_sites(_parse_site, yml_files, workers)
+    expts = []
+    errs = []
+    try:
+        for yml_file, expt, err in results:
+            if err is None:
+                expts.append(expt)
+            else:
+                errs.append((yml_file, err))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return expts, errs
+
+
+def _map_sites(func, jobs, workers):
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        return pool, pool.imap_unordered(func, jobs)
+    else:
+        return None, map(func, jobs)
+
+
+def _parse_site(yml_file):
+    """Load one site (runs in a worker process).
+
+    Returns (yml_file, experiment, None) on success or (yml_file, None, traceback_string) on failure.
+    """
+    try:
+        expt = Experiment(yml_file=yml_file)
+        # run cell QC now so that it is cached along with the experiment
+        try:
+            expt.connections_probed
+        except Exception:
+            print("Error counting probed connections for experiment %s:" % yml_file)
+            sys.excepthook(*sys.exc_info())
+        return yml_file, expt, None
+    except Exception as exc:
+        if len(exc.args) > 0 and exc.args[0] == 'breakpoint':
+            raise
+        return yml_file, None, traceback.format_exc()
+
+
+def _load_site(job):
+    """Parse one site and write it to the catalog (runs in a worker process).
+
+    Only the catalog record is returned to the parent process; collecting its metadata here
+    means that LIMS queries for new sites are also made in parallel.
+    """
+    yml_file, expt_file = job
+    yml_file, expt, err = _parse_site(yml_file)
+    if err is not None:
+        return yml_file, None, err
+    try:
+        rec = make_record(expt)
+    except Exception:
+        return yml_file, None, traceback.format_exc()
+    _write_expt(expt, expt_file)
+    return yml_file, rec, None
@@ -0,0 +1,257 @@
+# *-* coding: utf-8 *-*
+"""
+Columnar metadata indexes used to query an ExperimentList.
+
+Reading experiment metadata can be slow (for example, age and organism are queried from LIMS),
+so the values used for filtering are collected once per experiment by expt_metadata() and
+cached (in the experiment catalog, or on the experiment itself). ExperimentIndex arranges these
+values into columns with inverted indexes so that select() can be answered by intersecting
+index lookups, and keeps a table of all probed pairs so that connectivity can be summarized
+without loading experiments.
+
+"""
+from __future__ import print_function, division
+
+import sys
+import numpy as np
+
+
+pair_dtype = [
+    ('pre_id', object),
+    ('post_id', object),
+    ('pre_layer', object),
+    ('pre_cre_type', object),
+    ('post_layer', object),
+    ('post_cre_type', object),
+    ('distance', float),
+    ('connected', bool),
+]
+
+
+def expt_metadata(expt):
+    """Return the metadata dict used to index *expt*, collecting it the first time it is needed.
+    """
+    meta = getattr(expt, '_metadata', None)
+    if meta is None:
+        meta = collect_metadata(expt)
+        expt._metadata = meta
+    return meta
+
+
+def collect_metadata(expt):
+    """Read all indexed metadata from *expt*.
+
+    Values that cannot be determined (for example, when LIMS has no record of the specimen) are
+    set to None (nan for age), and will not match any filter on that value.
+    """
+    def get(func, default=None):
+        try:
+            return func()
+        except Exception:
+            return default
+
+    try:
+        pairs = pair_table(expt)
+    except Exception:
+        print("Error collecting probed pairs for experiment %s:" % str(expt.source_id))
+        sys.excepthook(*sys.exc_info())
+        pairs = None
+
+    return {
+        'timestamp': expt.timestamp,
+        'date': expt.date,
+        'source_file': expt.source_id[0],
+        'region': get(lambda: expt.region),
+        'cre_types': get(lambda: list(expt.cre_types), []),
+        'target_layers': get(lambda: list(expt.target_layers), []),
+        'calcium': get(lambda: expt_calcium(expt)),
+        'temperature': get(lambda: str(expt.expt_info['temperature'])[:2]),
+        'organism': get(lambda: expt.lims_record['organism']),
+        'rig': get(lambda: expt.rig_name),
+        'age': get(lambda: float(expt.age), np.nan),
+        'pairs': pairs,
+    }
+
+
+def expt_calcium(expt):
+    """Return 'high' or 'low' external calcium concentration for *expt*, or None if unknown.
+    """
+    solution = expt.expt_info.get('solution', None)
+    if solution is None:
+        return None
+    if '2mM' in solution:
+        return 'high'
+    elif '1.3mM' in solution:
+        return 'low'
+    return None
+
+
+def pair_table(expt):
+    """Return a structured array (see pair_dtype) describing every probed pair in *expt* that
+    passed QC, or None if connectivity was not analyzed.
+    """
+    if expt.connections is None:
+        return None
+    connections = set(expt.connections)
+    probed = expt.connections_probed
+    table = np.empty(len(probed), dtype=pair_dtype)
+    for k, (i, j) in enumerate(probed):
+        ci, cj = expt.cells[i], expt.cells[j]
+        dist = ci.distance(cj)
+        table[k] = (i, j, ci.target_layer, ci.cre_type, cj.target_layer, cj.cre_type,
+                    np.nan if dist is None else dist, (i, j) in connections)
+    return table
+
+
+class ExperimentIndex(object):
+    """Columnar view of the metadata for a sequence of experiments.
+
+    Experiments are referred to by their position in the sequence given at construction.
+    """
+    # single-valued columns that may be filtered by value
+    categorical_columns = ['region', 'calcium', 'temperature', 'organism', 'rig', 'source_file']
+    # columns containing a list of values per experiment
+    list_columns = ['cre_types', 'target_layers']
+
+    def __init__(self, expts):
+        metas = [expt_metadata(ex) for ex in expts]
+        self.n_expts = len(metas)
+        self.timestamp = np.array([m['timestamp'] for m in metas], dtype=float)
+        self.date = np.array([m['date'] for m in metas], dtype='datetime64[D]')
+        self.age = np.array([m['age'] for m in metas], dtype=float)
+        self.columns = {}
+        for name in self.categorical_columns + self.list_columns:
+            col = np.empty(len(metas), dtype=object)
+            col[:] = [m[name] for m in metas]
+            self.columns[name] = col
+        self._pair_tables = [m['pairs'] for m in metas]
+        self._inverted = {}
+        self._pairs = None
+
+    def inverted_index(self, name):
+        """Return a dict mapping each value in column *name* to a sorted array of experiment indices.
+        """
+        if name not in self._inverted:
+            inv = {}
+            for i, val in enumerate(self.columns[name]):
+                vals = val if name in self.list_columns else [val]
+                for v in vals:
+                    inv.setdefault(v, []).append(i)
+            self._inverted[name] = {v: np.array(inds, dtype=int) for v, inds in inv.items()}
+        return self._inverted[name]
+
+    def lookup(self, name, values):
+        """Return a boolean mask of experiments whose column *name* contains any of *values*.
+        """
+        inv = self.inverted_index(name)
+        mask = np.zeros(self.n_expts, dtype=bool)
+        for v in values:
+            if v in inv:
+                mask[inv[v]] = True
+        return mask
+
+    def select(self, start=None, stop=None, region=None, source_files=None, cre_type=None, target_layer=None,
+               calcium=None, age=None, temp=None, organism=None, rig=None):
+        """Return indices of experiments matching all of the given filters (see ExperimentList.select).
+        """
+        mask = np.ones(self.n_expts, dtype=bool)
+        if start is not None:
+            mask &= self.date >= np.datetime64(start, 'D')
+        if stop is not None:
+            mask &= self.date <= np.datetime64(stop, 'D')
+        if region is not None:
+            mask &= self.lookup('region', [region])
+        if source_files is not None:
+            mask &= self.lookup('source_file', source_files)
+        if cre_type is not None:
+            mask &= self.lookup('cre_types', cre_type)
+        if target_layer is not None:
+            mask &= self.lookup('target_layers', target_layer)
+        if calcium is not None:
+            mask &= self.lookup('calcium', [calcium.lower()])
+        if age is not None:
+            age_range = sorted([int(i) for i in age.split('-')])
+            with np.errstate(invalid='ignore'):
+                mask &= (self.age >= age_range[0]) & (self.age <= age_range[1])
+        if temp is not None:
+            mask &= self.lookup('temperature', [str(temp)[:2]])
+        if organism is not None:
+            mask &= self.lookup('organism', [organism])
+        if rig is not None:
+            mask &= self.lookup('rig', [rig])
+        return np.argwhere(mask)[:, 0]
+
+    @property
+    def pairs(self):
+        """Structured array of all probed pairs (see pair_dtype) with an extra 'expt_index' field.
+
+        Experiments whose connectivity was not analyzed are excluded.
+        """
+        if self._pairs is None:
+            tables = [t for t in self._pair_tables if t is not None]
+            n_pairs = sum([len(t) for t in tables])
+            pairs = np.empty(n_pairs, dtype=[('expt_index', int)] + pair_dtype)
+            i = 0
+            for expt_index, table in enumerate(self._pair_tables):
+                if table is None:
+                    continue
+                pairs['expt_index'][i:i+len(table)] = expt_index
+                for name in table.dtype.names:
+                    pairs[name][i:i+len(table)] = table[name]
+                i += len(table)
+            self._pairs = pairs
+        return self._pairs
+
+    def count_connections(self, pre_types=None, post_types=None, connection_types=None):
+        """Vectorized implementation of ExperimentList.count_connections.
+        """
+        pairs = self.pairs
+        if connection_types is not None:
+            mask = np.zeros(len(pairs), dtype=bool)
+            for pre_cre, post_cre in connection_types:
+                mask |= (pairs['pre_cre_type'] == pre_cre) & (pairs['post_cre_type'] == post_cre)
+        else:
+            mask = self._type_mask(pairs, 'pre', pre_types) & self._type_mask(pairs, 'post', post_types)
+        mask &= np.isfinite(pairs['distance'])
+        return list(pairs['connected'][mask]), list(pairs['distance'][mask])
+
+    @staticmethod
+    def _type_mask(pairs, side, types):
+        if types is None:
+            return np.ones(len(pairs), dtype=bool)
+        mask = np.zeros(len(pairs), dtype=bool)
+        for layer, cre_type in types:
+            m = np.ones(len(pairs), dtype=bool)
+            if layer is not None:
+                m &= pairs[side + '_layer'] == layer
+            if cre_type is not None:
+                m &= pairs[side + '_cre_type'] == cre_type
+            mask |= m
+        return mask
+
+    def connectivity_summary(self, cre_type=None):
+        """Vectorized implementation of ExperimentList.connectivity_summary.
+        """
+        pairs = self.pairs
+        keys = list(zip(zip(pairs['pre_layer'], pairs['pre_cre_type']), zip(pairs['post_layer'], pairs['post_cre_type'])))
+        groups = {}
+        for i, k in enumerate(keys):
+            groups.setdefault(k, []).append(i)
+
+        summary = {}
+        for k, inds in groups.items():
+            if cre_type is not None and list(cre_type) != [x[1] for x in k]:
+                continue
+            group = pairs[np.array(inds, dtype=int)]
+            connected = group['connected']
+            ts = self.timestamp[group['expt_index']]
+            pair_ids = list(zip(ts, group['pre_id'], group['post_id']))
+            summary[k] = {
+                'connected': int(connected.sum()),
+                'unconnected': int((~connected).sum()),
+                'cdist': list(group['distance'][connected]),
+                'udist': list(group['distance'][~connected]),
+                'connected_pairs': [p for p, c in zip(pair_ids, connected) if c],
+                'probed_pairs': pair_ids,
+            }
+        return summary
@@ -1,7 +1,7 @@
 # *-* coding: utf-8 *-*
 from __future__ import print_function, division
 import numpy as np
-import os, glob
+import os
 import pickle
 import scipy.optimize
 import scipy.stats
@@ -10,21 +10,23 @@ import traceback
 import warnings
 import datetime
 
-import pyqtgraph as pg
-
-from .ui.graphics import MatrixItem, distance_plot
 from .experiment import Experiment
+from .experiment_catalog import ExperimentCatalog, CatalogExperiment, find_sites, load_sites
+from .experiment_index import ExperimentIndex
 from .constants import INHIBITORY_CRE_TYPES, EXCITATORY_CRE_TYPES
 from . import config
-from statsmodels.stats.proportion import proportion_confint
 
 
 _expt_list = None
-cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache.pkl')
+cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache')
+legacy_cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache.pkl')
 def cached_experiments():
     global _expt_list, cache_file
     if _expt_list is None:
-        _expt_list = ExperimentList(cache=cache_file)
+        _expt_list = ExperimentList(cache=cache_file, catalog=True)
+        if len(_expt_list) == 0 and os.path.isfile(legacy_cache_file):
+            # catalog has not been built yet; fall back to the old single-file cache
+            _expt_list.load(legacy_cache_file)
     return _expt_list
 
 
@@ -60,10 +62,16 @@ def indentation(line):
 
 
 class ExperimentList(object):
+    """A list of experiments that can be loaded from the server and cached.
 
-    def __init__(self, expts=None, cache=None):
+    *cache* may be a pickle file or a catalog directory (see experiment_catalog.py). Existing
+    directories are used as catalogs; pass catalog=True to create a new catalog at *cache*.
+    """
+    def __init__(self, expts=None, cache=None, catalog=False):
         self._cache_version = 10
         self._cache = cache
+        self._catalog = None
+        self._index = None
         self._expts = []
         self._expts_by_datetime = {}
         self._expts_by_uid = {}
@@ -73,58 +81,76 @@ class ExperimentList(object):
 
         if expts is not None:
             for expt in expts:
-                self.add_experiment(expt)
-        if cache is not None and os.path.isfile(cache):
+                self._add_experiment(expt)
+            self._expts.sort(key=lambda ex: ex.uid)
+        if cache is not None and (catalog or os.path.isdir(cache)):
+            self._catalog = ExperimentCatalog(cache)
+        if cache is not None and os.path.exists(cache):
             try:
                 self.load(cache)
             except Exception:
                 sys.excepthook(*sys.exc_info())
                 print('Error reading cache file "%s". (exception printed above)' % cache)
 
-    def load_from_server(self):
-        errs = []
+    def load_from_server(self, workers=None):
+        """Load all experiments found on the server.
 
-        # Load all pipettes.yml files found on server
-        yamls = glob.glob(os.path.join(config.synphys_data, '*', 'slice_*', 'site_*', 'pipettes.yml'))
+        If this list has a catalog cache, only sites that are new or have changed since the last
+        update are parsed. Sites are parsed in parallel using *workers* processes (default is one
+        per CPU).
+        """
+        yamls = find_sites()
         if len(yamls) == 0:
             print("No experiments found at %s" % config.synphys_data)
 
-        for i,yml_file in enumerate(yamls):
-            # if i>15:
-                # break
-            try:
-                expt = Experiment(yml_file=yml_file)
-                self.add_experiment(expt)
-            except Exception as exc:
-                if len(exc.args) > 0 and exc.args[0] == 'breakpoint':
-                    raise
-                errs.append((yml_file, sys.exc_info()))
-                continue
+        if self._catalog is not None:
+            loaded, errs = self._catalog.update(yamls, workers=workers)
+            # drop stale copies of reloaded sites, and sites that were removed from the server
+            reloaded = set([rec['source_id'] for rec in loaded])
+            self._remove_experiments([ex for ex in self._expts if ex.source_id in reloaded or 
+                (isinstance(ex, CatalogExperiment) and ex._record['site_id'] not in self._catalog.records)])
+            for rec in loaded:
+                self._add_experiment(CatalogExperiment(self._catalog, rec))
+        else:
+            expts, errs = load_sites(yamls, workers=workers)
+            for expt in expts:
+                self._add_experiment(expt)
+        self._expts.sort(key=lambda ex: ex.uid)
 
         if len(errs) > 0:
             print("Errors loading %d experiments from server:" % len(errs))
             for yml_file, exc in errs:
                 print("=======================")
                 print("yml:", yml_file)
-                traceback.print_exception(*exc)
+                print(exc)
                 src_file = open(os.path.join(os.path.dirname(yml_file), 'sync_source')).read()
                 print("source:", os.path.join(src_file, 'pipettes.yml'))
                 print("")
 
     def load(self, filename):
-        if filename.endswith('.pkl'):
+        if os.path.isdir(filename):
+            self._load_catalog(filename)
+        elif filename.endswith('.pkl'):
             self._load_pickle(filename)
         else:
             self._load_text(filename)
 
+    def _load_catalog(self, path):
+        catalog = self._catalog
+        if catalog is None or catalog.path != os.path.abspath(path):
+            catalog = ExperimentCatalog(path)
+        for expt in catalog.experiments():
+            self._add_experiment(expt)
+        self._expts.sort(key=lambda ex: ex.uid)
+
     def _load_pickle(self, filename):
-        el = pickle.load(open(filename))
+        el = pickle.load(open(filename, 'rb'))
         ver = getattr(el, '_cache_version', None)
         if ver != self._cache_version:
             print("Ignoring cache file %s due to incompatible version (%s != %s)" % (filename, ver, self._cache_version))
             return
         for expt in el._expts:
-            self.add_experiment(expt)
+            self._add_experiment(expt)
         self.sort()
 
     def _load_text(self, filename):
@@ -185,63 +211,69 @@ class ExperimentList(object):
         self.sort()
 
     def add_experiment(self, expt):
+        self._add_experiment(expt)
+        self._expts.sort(key=lambda ex: ex.uid)
+
+    def _add_experiment(self, expt):
         if expt.uid in self._expts_by_uid:
             print("SKIP adding %s; ID already exists." % expt)
             return
         self._expts.append(expt)
+        self._index = None
         self._expts_by_uid[expt.uid] = expt
         self._expts_by_datetime[expt.datetime] = expt
         self._expts_by_source_id[expt.source_id] = expt
-        self._expts.sort(key=lambda ex: ex.uid)
+
+    def _remove_experiments(self, expts):
+        if len(expts) == 0:
+            return
+        remove = set([id(ex) for ex in expts])
+        self._expts = [ex for ex in self._expts if id(ex) not in remove]
+        self._index = None
+        for expt in expts:
+            self._expts_by_uid.pop(expt.uid, None)
+            self._expts_by_datetime.pop(expt.datetime, None)
+            self._expts_by_source_id.pop(expt.source_id, None)
 
     def write_cache(self):
+        """Write this list to its cache.
+
+        For a catalog cache, only experiments that are not already stored in the catalog are
+        written, followed by the catalog index.
+        """
         if self._cache is None:
             raise Exception("ExperimentList has no cache file; cannot write cache.")
-        pickle.dump(self, open(self._cache, 'w'))
+        if self._catalog is None:
+            pickle.dump(self, open(self._cache, 'wb'))
+            return
+        for expt in self._expts:
+            if isinstance(expt, CatalogExperiment) and expt._catalog is self._catalog:
+                continue
+            self._catalog.add_experiment(expt)
+        self._catalog.write_index()
+
+    @property
+    def index(self):
+        """ExperimentIndex of the experiments in this list (built the first time it is needed).
+        """
+        if self._index is None:
+            self._index = ExperimentIndex(self._expts)
+        return self._index
 
     def select(self, start=None, stop=None, region=None, source_files=None, cre_type=None, target_layer=None, calcium=None,
                age=None, temp=None, organism=None, rig=None):
-        expts = []
-        for ex in self._expts:
-            # filter experiments by experimental date and conditions
-            if calcium is not None:
-                if 'solution' in ex.expt_info:
-                    if '2mM' in ex.expt_info['solution']:
-                        ex_calcium = 'high'
-                    elif '1.3mM' in ex.expt_info['solution']:
-                        ex_calcium = 'low'
-                else:
-                    print("External calcium concentration not set for experiment %s" % str(ex.source_id))
-                    continue
-            if age is not None:
-                age_range = sorted([int(i) for i in age.split('-')])
-            if start is not None and ex.date < start:
-                continue
-            elif stop is not None and ex.date > stop:
-                continue
-            elif region is not None and ex.region != region:
-                continue
-            elif source_files is not None and ex.source_id[0] not in source_files:
-                continue
-            elif cre_type is not None and len(set(cre_type) & set(ex.cre_types)) == 0:
-                continue
-            elif target_layer is not None and len(set(target_layer) & set(ex.target_layers)) == 0:
-                continue
-            elif calcium is not None and calcium.lower() != ex_calcium:
-                continue
-            elif age is not None and ((ex.age < age_range[0]) or (ex.age > age_range[1])) :
-                continue
-            elif temp is not None and ex.expt_info['temperature'][:2] != temp:
-                continue
-            elif organism is not None and ex.lims_record['organism'] != organism:
-                continue
-            elif rig is not None and ex.rig_name != rig_name:
-                continue
-            else:
-                expts.append(ex)
+        """Return a new ExperimentList containing only experiments that match all of the given filters.
 
-        el = ExperimentList(expts)
-        return el
+        Filters are resolved using the metadata index, so experiments are not loaded and LIMS is
+        not queried. Experiments whose value for a filtered field is unknown are excluded.
+        """
+        index = self.index
+        if calcium is not None:
+            for i in np.argwhere(index.columns['calcium'] == None)[:, 0]:
+                print("External calcium concentration not set for experiment %s" % str(self._expts[i].source_id))
+        inds = index.select(start=start, stop=stop, region=region, source_files=source_files, cre_type=cre_type,
+                            target_layer=target_layer, calcium=calcium, age=age, temp=temp, organism=organism, rig=rig)
+        return ExperimentList([self._expts[i] for i in inds])
 
     def __getitem__(self, item):
         if isinstance(item, float):
@@ -272,6 +304,7 @@ class ExperimentList(object):
 
     def sort(self, key=lambda expt: expt.source_id[1], **kwds):
         self._expts.sort(key=key, **kwds)
+        self._index = None
 
     def check(self):
         # sanity check: all experiments should have cre and fl labels
@@ -286,50 +319,15 @@ class ExperimentList(object):
                 print("Warning: Experiment %s has no region" % str(expt.source_id))
 
     def count_connections(self, pre_types=None, post_types=None, connection_types=None):
-        # get all connected and unconnected distances for pre->post
-        probed = []
-        connected = []
-
+        """Return lists of connectivity (bool) and intersomatic distance for all probed pairs
+        with finite distance that match the given types.
+        """
         if isinstance(pre_types, str):
             pre_types = [(None, pre_types)]
         if isinstance(post_types, str):
             post_types = [(None, post_types)]
 
-        for expt in self:
-            if expt.connections is None:
-                continue
-            for i,j in expt.connections_probed:
-                ci, cj = expt.cells[i], expt.cells[j]
-                if connection_types is not None:
-                    if (ci.cre_type, cj.cre_type) not in connection_types:
-                        continue
-                else:
-                    if pre_types is None:
-                        pre_ok = True
-                    else:
-                        pre_ok = False
-                        for layer, cre_type in pre_types:
-                            if (layer is None or ci.target_layer == layer) and (cre_type is None or ci.cre_type == cre_type):
-                                pre_ok = True
-                                continue
-
-                    if post_types is None:
-                        post_ok = True
-                    else:
-                        post_ok = False
-                        for layer, cre_type in post_types:
-                            if (layer is None or cj.target_layer == layer) and (cre_type is None or cj.cre_type == cre_type):
-                                post_ok = True
-                                continue
-
-                    if not (pre_ok and post_ok):
-                        continue
-                dist = ci.distance(cj)
-                if dist is not None and np.isfinite(dist):
-                    probed.append(dist)
-                    connected.append((i, j) in expt.connections)
-        
-        return connected, probed
+        return self.index.count_connections(pre_types, post_types, connection_types)
         
     def distance_plot(self, pre_types=None, post_types=None, connection_types=None, plots=None, color=(100, 100, 255), name=None):
         if isinstance(pre_types, str):
@@ -344,6 +342,7 @@ class ExperimentList(object):
             post_strs = [("" if layer is None else ("L" + layer + " ")) + (cre_type or "") for layer, cre_type in post_types]
             name = ("%s->%s "%(','.join(pre_strs), ','.join(post_strs)))
         
+        from .ui.graphics import distance_plot
         return distance_plot(connected, distance=probed, plots=plots, color=color, name=name, window=40e-6, spacing=40e-6)
 
     def connectivity_matrix(self, rows, cols):
@@ -361,6 +360,9 @@ class ExperimentList(object):
         return matrix
 
     def matrix(self, rows, cols, size=50, header_color='k', no_data_color=0.9, mode='connectivity', title='Connectivity Matrix'):
+        import pyqtgraph as pg
+        from .ui.graphics import MatrixItem
+
         w = pg.GraphicsLayoutWidget()
         w.setRenderHints(w.renderHints() | pg.QtGui.QPainter.Antialiasing)
         w.setWindowTitle(title)
@@ -510,23 +512,12 @@ class ExperimentList(object):
         print("")
 
     def connectivity_summary(self, cre_type=None):
-        summary = {}
-        for expt in self:
-            ex_sum = expt.summary()
-            if ex_sum is None:
-                continue
-            for k,v in ex_sum.items():
-                if cre_type is not None and list(cre_type) != [x[1] for x in k]:
-                    continue
-                if k not in summary:
-                    summary[k] = {'connected':0, 'unconnected':0, 'cdist':[], 'udist':[], 'connected_pairs': [], 'probed_pairs': []}
-                summary[k]['connected'] += v['connected']
-                summary[k]['unconnected'] += v['unconnected']
-                summary[k]['cdist'].extend(v['cdist'])
-                summary[k]['udist'].extend(v['udist'])
-                summary[k]['connected_pairs'].extend([(expt.timestamp, i, j) for i,j in v['connected_pairs']])
-                summary[k]['probed_pairs'].extend([(expt.timestamp, i, j) for i,j in v['probed_pairs']])
-        return summary
+        """Return a structure summarizing (non)connectivity across all experiments.
+
+        This has the same format as Experiment.summary(), except that pairs are given as
+        (expt_timestamp, pre_cell_id, post_cell_id).
+        """
+        return self.index.connectivity_summary(cre_type)
 
     def compare_connectivity(self, expts):
         """Print a comparison of connectivity between two experiment lists.
@@ -601,6 +592,8 @@ class ExperimentList(object):
         return summary
 
     def print_connectivity_summary(self, cre_type=None):
+        from statsmodels.stats.proportion import proportion_confint
+
         print("------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
         print("     Connectivity                           (# connected/probed, # reciprocal, % connectivity, lower CI, upper CI, %250, lower CI, upper CI, %100, lower CI, upper CI, cdist, udist, adist)")
         print("------------------------------------------------------------------------------------------------------------------------------------------------------------------------")
@@ -6,7 +6,6 @@ from neuroanalysis.data import Trace, TraceList
 from multipatch_analysis.database import database as db
 import multipatch_analysis.connection_strength as cs 
 from multipatch_analysis.database.database import TableGroup
-import matplotlib.pyplot as plt
 import numpy as np
 import time
 from neuroanalysis.fitting import fit_psp
@@ -70,17 +69,17 @@ class FirstPulseFitTableGroup(TableGroup):
 first_pulse_fit_tables = FirstPulseFitTableGroup()
 
 def init_tables():
+    """Create tables in the database if they do not exist yet (see TableGroup.ensure_tables).
+    """
+    first_pulse_fit_tables.ensure_tables()
 
-    global AvgFirstPulseFit
-    first_pulse_fit_tables.create_tables()
-    AvgFirstPulseFit = first_pulse_fit_tables['avg_first_pulse_fit']
-
-# create tables in database and add global variables for ORM classes
-init_tables()
+# add global variables for ORM classes
+AvgFirstPulseFit = first_pulse_fit_tables['avg_first_pulse_fit']
 
 def update_DB(limit=None, expts=None, parallel=True, workers=6, raise_exceptions=False, session=None):
     """
     """
+    init_tables()
     session=db.Session()
     if expts is None:
         experiments = session.query(db.Experiment.acq_timestamp).all()
@@ -345,6 +344,7 @@ def fit_trace(waveform, excitation, clamp_mode='ic', weight=None, latency=None,
         ylabel='current (pA)'        
 
     if False:
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(14,10))
         ax1=plt.subplot(1,1,1)
         ln1=ax1.plot(waveform.time_values*1.e3, waveform.data*scale_factor, 'b', label='data')
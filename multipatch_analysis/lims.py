@@ -1,8 +1,58 @@
 from __future__ import print_function
 import os, re, json
-from allensdk_internal.core import lims_utilities as lims
+from collections import OrderedDict
+from . import lims_cache
+from .lims_cache import cached, clear as clear_cache, MINUTE, HOUR, DAY
+try:
+    from allensdk_internal.core import lims_utilities as lims
+except ImportError:
+    # LIMS is only reachable from inside the institute; set_backend() may supply a stand-in
+    lims = None
+
+
+def set_backend(backend):
+    """Set the object used to run LIMS queries (anything with a query(sql) method that returns
+    a list of dicts, such as lims_cache.LocalLims).
+    """
+    global lims
+    lims = backend
+
+
+_specimen_info_query = """
+    select 
+        organisms.name as organism, 
+        ages.days as age,
+        donors.date_of_birth as date_of_birth,
+        donors.full_genotype as genotype,
+        donors.weight as weight,
+        genders.name as sex,
+        tissue_processings.section_thickness_um as thickness,
+        tissue_processings.instructions as section_instructions,
+        plane_of_sections.name as plane_of_section,
+        flipped_specimens.name as flipped,
+        specimens.histology_well_name as histology_well_name,
+        specimens.carousel_well_name as carousel_well_name,
+        specimens.parent_id as parent_id,
+        specimens.name as specimen_name,
+        specimens.id as specimen_id
+    from specimens
+        left join donors on specimens.donor_id=donors.id 
+        left join organisms on donors.organism_id=organisms.id
+        left join ages on donors.age_id=ages.id
+        left join genders on donors.gender_id=genders.id
+        left join tissue_processings on specimens.tissue_processing_id=tissue_processings.id
+        left join plane_of_sections on tissue_processings.plane_of_section_id=plane_of_sections.id
+        left join flipped_specimens on flipped_specimens.id = specimens.flipped_specimen_id
+"""
+
+
+def _specimen_info_key(specimen_name=None, specimen_id=None):
+    if specimen_name is not None:
+        return repr(('name', specimen_name.strip()))
+    return repr(('id', specimen_id))
 
 
+@cached(ttl=DAY, key=_specimen_info_key)
 def specimen_info(specimen_name=None, specimen_id=None):
     """Return a dictionary of information about a slice specimen queried from LIMS.
     
@@ -32,32 +82,7 @@ def specimen_info(specimen_name=None, specimen_id=None):
     """
     
     # Query all interesting information about this specimen from LIMS
-    query = """
-        select 
-            organisms.name as organism, 
-            ages.days as age,
-            donors.date_of_birth as date_of_birth,
-            donors.full_genotype as genotype,
-            donors.weight as weight,
-            genders.name as sex,
-            tissue_processings.section_thickness_um as thickness,
-            tissue_processings.instructions as section_instructions,
-            plane_of_sections.name as plane_of_section,
-            flipped_specimens.name as flipped,
-            specimens.histology_well_name as histology_well_name,
-            specimens.carousel_well_name as carousel_well_name,
-            specimens.parent_id as parent_id,
-            specimens.name as specimen_name,
-            specimens.id as specimen_id
-        from specimens
-            left join donors on specimens.donor_id=donors.id 
-            left join organisms on donors.organism_id=organisms.id
-            left join ages on donors.age_id=ages.id
-            left join genders on donors.gender_id=genders.id
-            left join tissue_processings on specimens.tissue_processing_id=tissue_processings.id
-            left join plane_of_sections on tissue_processings.plane_of_section_id=plane_of_sections.id
-            left join flipped_specimens on flipped_specimens.id = specimens.flipped_specimen_id
-    """
+    query = _specimen_info_query
     if specimen_name is not None:
         sid = specimen_name.strip()
         query += "where specimens.name='%s';" % sid
@@ -70,8 +95,54 @@ def specimen_info(specimen_name=None, specimen_id=None):
     r = lims.query(query)
     if len(r) != 1:
         raise Exception("LIMS lookup for specimen '%s' returned %d results (expected 1)" % (sid, len(r)))
-    rec = r[0]
-    
+    return _parse_specimen_info(r[0])
+
+
+def specimen_info_many(specimen_names, chunk_size=500):
+    """Return specimen_info() for many specimens at once.
+
+    Specimens that are not already cached are queried from LIMS in batches of up to *chunk_size*,
+    rather than one query per specimen, and the results are cached for later specimen_info() calls.
+
+    Returns an OrderedDict mapping each specimen name to its info dict, or to None if the
+    specimen could not be found (or its record could not be parsed).
+    """
+    names = [name.strip() for name in specimen_names]
+    results = OrderedDict([(name, None) for name in names])
+
+    cache = lims_cache.get_cache()
+    missing = []
+    for name in results:
+        if cache is not None:
+            hit, rec = cache.get('specimen_info', _specimen_info_key(name), specimen_info.ttl)
+            if hit:
+                results[name] = rec
+                continue
+        missing.append(name)
+
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i+chunk_size]
+        query = _specimen_info_query + "where specimens.name in (%s);" % ', '.join(["'%s'" % name.replace("'", "''") for name in chunk])
+        recs = {}
+        for rec in lims.query(query):
+            recs.setdefault(rec['specimen_name'], []).append(rec)
+        for name in chunk:
+            if len(recs.get(name, [])) != 1:
+                continue
+            try:
+                rec = _parse_specimen_info(recs[name][0])
+            except Exception:
+                continue
+            results[name] = rec
+            if cache is not None:
+                cache.set('specimen_info', _specimen_info_key(name), rec)
+
+    return results
+
+
+def _parse_specimen_info(rec):
+    """Convert and extend a specimen record queried by specimen_info().
+    """
     # convert thickness to unscaled
     rec['thickness'] = rec['thickness'] * 1e-6
     # convert organism to more easily searchable form
@@ -140,6 +211,7 @@ def specimen_info(specimen_name=None, specimen_id=None):
     return rec
     
     
+@cached(ttl=HOUR)
 def specimen_images(specimen):
     """Return a list of dicts describing images for a specimen.
 
@@ -216,6 +288,7 @@ def specimen_20x_image(specimen, treatment='Biocytin'):
     return None
 
 
+@cached(ttl=DAY)
 def specimen_species(specimen_name):
     """returns species information
     """
@@ -231,6 +304,7 @@ def specimen_species(specimen_name):
     return r[0]['species']
 
 
+@cached(ttl=30*DAY)
 def specimen_id_from_name(spec_name):
     """Return the LIMS ID of a specimen give its name.
     """
@@ -240,6 +314,7 @@ def specimen_id_from_name(spec_name):
     return recs[0]['id']
 
 
+@cached(ttl=30*DAY)
 def specimen_name(spec_id):
     recs = lims.query("select name from specimens where id=%s" % spec_id)
     if len(recs) == 0:
@@ -247,6 +322,7 @@ def specimen_name(spec_id):
     return recs[0]['name']
 
 
+@cached(ttl=HOUR)
 def specimen_ephys_roi_plans(specimen):
     """Return a list of all ephys roi plans for this specimen.
 
@@ -272,6 +348,7 @@ def specimen_ephys_roi_plans(specimen):
     return recs
 
 
+@cached(ttl=10*MINUTE, cache_empty=False)
 def cell_cluster_ids(specimen):
     """Return the IDs of all cell-cluster children of *specimen*.
 
@@ -293,6 +370,7 @@ def cell_cluster_ids(specimen):
     return [rec['id'] for rec in recs]
 
 
+@cached(ttl=10*MINUTE)
 def child_specimens(specimen):
     if not isinstance(specimen, int):
         specimen = specimen_id_from_name(specimen)
@@ -304,6 +382,7 @@ def child_specimens(specimen):
     return [rec['id'] for rec in recs]    
 
 
+@cached(ttl=30*DAY)
 def parent_specimen(specimen):
     if isinstance(specimen, int):
         q = """select parent_id from specimens where specimens.id=%d""" % specimen
@@ -313,6 +392,7 @@ def parent_specimen(specimen):
     return recs[0]['parent_id']
 
 
+@cached(ttl=10*MINUTE)
 def cell_cluster_data_paths(specimen):
     if not isinstance(specimen, int):
         specimen = specimen_id_from_name(specimen)
@@ -325,6 +405,7 @@ def cell_cluster_data_paths(specimen):
     return [r['storage_directory'] for r in recs]
 
   
+@cached(ttl=10*MINUTE, cache_empty=False)
 def specimen_metadata(specimen):
     if not isinstance(specimen, int):
         specimen = specimen_id_from_name(specimen)
@@ -339,6 +420,7 @@ def specimen_metadata(specimen):
         meta = json.loads(meta)  # unserialization corrects for a LIMS bug; we can remove this later.
     return meta
 
+@cached(ttl=HOUR)
 def specimen_tags(specimen):
     if not isinstance(specimen, int):
         specimen = specimen_id_from_name(specimen)
@@ -350,6 +432,7 @@ def specimen_tags(specimen):
     return [rec['name'] for rec in recs]
 
 
+@cached(ttl=30*DAY)
 def specimen_type(specimen):
     if not isinstance(specimen, int):
         specimen = specimen_id_from_name(specimen)
@@ -377,6 +460,7 @@ def filename_base(specimen_id, acq_timestamp):
     return "synphys-%d-%s" % (specimen_id, acq_timestamp)
 
 
+@cached(ttl=DAY)
 def get_incoming_dir(specimen_name):
     """Returns the path for incoming files for each project
     """
@@ -393,6 +477,7 @@ def get_incoming_dir(specimen_name):
         return recs[0]['incoming_directory']
 
 
+@cached(ttl=DAY)
 def get_trigger_dir(specimen_name):
     """Returns the path for trigger files for each project
     """
@@ -473,6 +558,9 @@ def expt_submissions(specimen, acq_timestamp):
     failed_trigger = os.path.join(incoming_path, 'failed_trigger', '%s.mp' % filebase)
     
     if os.path.exists(incoming_nwb):
+        # a new cell cluster appears once LIMS processes the submission; don't rely on cluster
+        # IDs cached before that happened
+        cell_cluster_ids.invalidate(specimen)
         if os.path.exists(incoming_trigger):
             submissions.append(("trigger pending", incoming_trigger))
         if os.path.exists(failed_trigger):
@@ -502,6 +590,7 @@ def expt_cluster_ids(specimen, acq_timestamp):
     return cids
 
 
+@cached(ttl=10*MINUTE)
 def cluster_cells(cluster):
     """Return information about a CellCluster's child cells.
     """
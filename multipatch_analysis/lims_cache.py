@@ -0,0 +1,187 @@
+"""
+Persistent local cache for LIMS queries.
+
+LIMS lookups are slow relative to how often the same metadata is requested (by Experiment,
+metadata submission, and the dashboard), so the functions in lims.py store their results in an
+SQLite file under config.cache_path. Each function declares how long its results remain valid
+with the @cached decorator; entries older than that are re-queried. Use clear() or a cached
+function's invalidate() method to discard entries manually.
+
+"""
+from __future__ import print_function
+
+import os, time, pickle, sqlite3, threading, functools
+
+from . import config
+
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+class LimsCache(object):
+    """Key/value store for LIMS query results, backed by an SQLite file.
+
+    Values are pickled, so any picklable result may be cached. A single LimsCache may be shared
+    between threads; separate processes may open the same file concurrently. Processes forked
+    after the cache is opened (for example, multiprocessing workers) open their own connection.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._pid = None
+        self._connect()
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self._pid = os.getpid()
+        with self._lock:
+            self._db.execute("""
+                create table if not exists lims_cache (
+                    func text, key text, value blob, time real,
+                    primary key (func, key)
+                )""")
+            self._db.commit()
+
+    @property
+    def db(self):
+        # sqlite connections must not be shared with forked child processes
+        if self._pid != os.getpid():
+            self._connect()
+        return self._db
+
+    def get(self, func, key, ttl):
+        """Return (True, value) if a result for *func*, *key* was cached less than *ttl* seconds ago,
+        or (False, None) otherwise.
+        """
+        db = self.db
+        with self._lock:
+            row = db.execute("select value, time from lims_cache where func=? and key=?", (func, key)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return False, None
+        return True, pickle.loads(bytes(row[0]))
+
+    def set(self, func, key, value):
+        blob = sqlite3.Binary(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        db = self.db
+        with self._lock:
+            db.execute("insert or replace into lims_cache (func, key, value, time) values (?, ?, ?, ?)",
+                       (func, key, blob, time.time()))
+            db.commit()
+
+    def invalidate(self, func=None, key=None):
+        """Remove cached results for *func* (all functions if None), optionally only for one *key*.
+        """
+        query = "delete from lims_cache"
+        conditions = []
+        args = []
+        if func is not None:
+            conditions.append("func=?")
+            args.append(func)
+        if key is not None:
+            conditions.append("key=?")
+            args.append(key)
+        if len(conditions) > 0:
+            query += " where " + " and ".join(conditions)
+        db = self.db
+        with self._lock:
+            db.execute(query, args)
+            db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Return the LimsCache used by lims.py, or None if caching is disabled in config.yml.
+    """
+    global _cache
+    if not config.lims_cache:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            if not os.path.isdir(config.cache_path):
+                os.makedirs(config.cache_path)
+            _cache = LimsCache(os.path.join(config.cache_path, 'lims_cache.sqlite'))
+    return _cache
+
+
+def set_cache(cache):
+    """Replace the LimsCache used by lims.py (for example, with one stored in a temporary file).
+    """
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+def clear(func=None):
+    """Discard all cached LIMS results, or only those for the function named *func*.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(func)
+
+
+def cached(ttl, key=None, cache_empty=True):
+    """Decorator that caches the return value of a LIMS query function for *ttl* seconds.
+
+    Results are keyed on the function name and the repr of its arguments, unless *key* is given;
+    it is called with the same arguments and must return a string. Exceptions are not cached.
+    If *cache_empty* is False, None and empty results are not cached either; use this for
+    queries whose results are expected to appear soon (such as the cell clusters created when an
+    experiment is submitted).
+    The decorated function gains an invalidate(*args, **kwds) method that discards the cached
+    result for a particular set of arguments.
+    """
+    def decorate(fn):
+        name = fn.__name__
+        if key is None:
+            make_key = lambda *args, **kwds: repr((args, sorted(kwds.items())))
+        else:
+            make_key = key
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwds):
+            cache = get_cache()
+            if cache is None:
+                return fn(*args, **kwds)
+            k = make_key(*args, **kwds)
+            hit, value = cache.get(name, k, ttl)
+            if hit:
+                return value
+            value = fn(*args, **kwds)
+            if cache_empty or not _is_empty(value):
+                cache.set(name, k, value)
+            return value
+
+        def invalidate(*args, **kwds):
+            cache = get_cache()
+            if cache is not None:
+                cache.invalidate(name, make_key(*args, **kwds))
+
+        wrapper.ttl = ttl
+        wrapper.cache_key = make_key
+        wrapper.invalidate = invalidate
+        wrapper.uncached = fn
+        return wrapper
+    return decorate
+
+
+def _is_empty(value):
+    return value is None or (hasattr(value, '__len__') and len(value) == 0)
+
+
+class LocalLims(object):
+    """Stand-in for the LIMS query interface that runs queries against a local SQLite database.
+
+    Useful for testing and offline work; install with lims.set_backend(LocalLims(filename)).
+    """
+    def __init__(self, filename=':memory:'):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.n_queries = 0
+
+    def query(self, sql):
+        self.n_queries += 1
+        return [dict(zip(row.keys(), row)) for row in self.db.execute(sql).fetchall()]
@@ -37,13 +37,13 @@ morphology_tables = MorphologyTableGroup()
 
 
 def init_tables():
-    global Morphology
-    morphology_tables.create_tables()
-    Morphology = morphology_tables['morphology']
+    """Create tables in the database if they do not exist yet (see TableGroup.ensure_tables).
+    """
+    morphology_tables.ensure_tables()
 
 
-# create tables in database and add global variables for ORM classes
-init_tables()
+# add global variables for ORM classes
+Morphology = morphology_tables['morphology']
 
 
 
@@ -51,6 +51,7 @@ init_tables()
 def update_morphology(limit=0, expts=None, parallel=True, workers=6, raise_exceptions=False, session=None):
     """Update morphology table for all experiments
     """
+    init_tables()
     if expts is None:
         expts_ready = session.query(db.Experiment.acq_timestamp).join(db.Electrode).join(db.Cell).distinct().all()
         expts_done = session.query(db.Experiment.acq_timestamp).join(db.Electrode).join(db.Cell).join(Morphology).distinct().all()
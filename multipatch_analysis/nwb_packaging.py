@@ -6,6 +6,8 @@ import argparse
 import glob
 import hashlib
 import os
+import sys
+import posixpath
 import datetime
 import time
 import numpy as np
@@ -15,6 +17,12 @@ import h5py
 import shutil
 import tempfile
 import atexit
+import multiprocessing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Requires the patched version of nwb-api from https://github.com/t-b/nwb-api/tree/local_fixes
 import nwb
@@ -22,6 +30,19 @@ from nwb.nwbco import *
 
 tmpdir = None
 
+# How output NWB files are created from the site NWB files (see prepareOutputNWB)
+packagingModes = ('copy', 'clone', 'link')
+packagingMode = 'clone'
+
+# output NWB file name : open nwb.NWB handle, kept open while a combined file is built
+openHandles = {}
+
+# groups that metadata is appended to; these are real groups in linked output files
+writableGroups = ['/acquisition', '/acquisition/images', '/general', '/general/misc_files']
+
+# ioctl request for copy-on-write file clones on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
 def removeTmpdir():
     global tmpdir
     if tmpdir is not None:
@@ -76,8 +97,6 @@ def appendMAFile(siteNWBs, filePath, filedesc):
             imageAttrs['desc'] = json.dumps(meta)
             handle.create_reference_image(image, name, **imageAttrs)
 
-        handle.close()
-
     root.close()
 
 def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc):
@@ -100,7 +119,6 @@ def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc):
 
         name = getUnusedDatasetName(handle, "/acquisition/images/", "image")
         handle.create_reference_image(data, name, **imageAttrs)
-        handle.close()
 
 def appendMiscFileToNWB(siteNWBs, basename, content):
     """ Write the given file contents into all NWB files"""
@@ -110,7 +128,6 @@ def appendMiscFileToNWB(siteNWBs, basename, content):
 
         name = getUnusedDatasetName(handle, "/general/misc_files", basename)
         handle.set_metadata("misc_files" + "/" + name, content)
-        handle.close()
 
 def getUnusedDatasetName(fileHandle, group, basename):
     """ Return an unuused dataset name """
@@ -202,12 +219,20 @@ def getSiteNWBs(basepath):
     return matches
 
 def openNWB(siteNWB):
-    """ Open the given NWB file """
+    """
+    Open the output NWB file for the given site NWB, creating it first if needed.
+
+    The handle stays open (and is returned again by later calls) until closeNWBs() is called.
+    """
 
     outputNWB = deriveOutputNWB(siteNWB)
 
+    handle = openHandles.get(outputNWB)
+    if handle is not None:
+        return handle
+
     if not os.path.isfile(outputNWB):
-        shutil.copyfile(siteNWB, outputNWB)
+        prepareOutputNWB(siteNWB, outputNWB, packagingMode)
 
     settings = {}
 
@@ -216,10 +241,92 @@ def openNWB(siteNWB):
     settings["modify"]        = True
 
     try:
-        return nwb.NWB(**settings)
+        handle = nwb.NWB(**settings)
     except:
         raise NameError("Could not open the NWB file \"%s\"." % outputNWB)
 
+    openHandles[outputNWB] = handle
+    return handle
+
+def closeNWBs():
+    """ Close all output NWB files opened by openNWB() """
+
+    while len(openHandles) > 0:
+        outputNWB, handle = openHandles.popitem()
+        handle.close()
+
+def prepareOutputNWB(siteNWB, outputNWB, mode):
+    """
+    Create the output NWB file that metadata is appended to.
+
+    mode is one of:
+      'copy'  : full copy of siteNWB
+      'clone' : copy-on-write clone of siteNWB where the file system supports it (no data is
+                copied until either file is modified), otherwise a full copy
+      'link'  : small file that refers to the contents of siteNWB through HDF5 external links
+                (see createLinkedNWB); siteNWB must remain in place while the output is used
+    """
+
+    if mode == 'copy':
+        shutil.copyfile(siteNWB, outputNWB)
+    elif mode == 'clone':
+        cloneFile(siteNWB, outputNWB)
+    elif mode == 'link':
+        createLinkedNWB(siteNWB, outputNWB)
+    else:
+        raise NameError("Unknown packaging mode \"%s\", expected one of %s." % (mode, ', '.join(packagingModes)))
+
+def cloneFile(src, dst):
+    """ Copy src to dst as a copy-on-write clone if possible, otherwise make a regular copy. Return True if the file was cloned. """
+
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as srcFile:
+                with open(dst, 'wb') as dstFile:
+                    fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+            return True
+        except (IOError, OSError):
+            # not supported by this file system, or src and dst are on different file systems
+            if os.path.isfile(dst):
+                os.remove(dst)
+
+    shutil.copyfile(src, dst)
+    return False
+
+def createLinkedNWB(siteNWB, outputNWB):
+    """
+    Create a companion file for siteNWB that contains no data of its own.
+
+    All groups and datasets of siteNWB are referenced through HDF5 external links (using the
+    absolute path of siteNWB), except for the groups listed in writableGroups, which are created
+    as real groups so that metadata can be appended to them.
+    """
+
+    target = os.path.abspath(siteNWB)
+    src = h5py.File(siteNWB, 'r')
+    dst = h5py.File(outputNWB, 'w')
+
+    try:
+        for k, v in src.attrs.items():
+            dst.attrs[k] = v
+        linkChildren(src, dst, '/', target)
+    finally:
+        dst.close()
+        src.close()
+
+def linkChildren(src, dst, group, target):
+    """ Recursively add external links to the children of group in src to dst """
+
+    for name in src[group]:
+        path = posixpath.join(group, name)
+        if path in writableGroups and src.get(path, getclass=True) is h5py.Group:
+            g = dst.create_group(path)
+            for k, v in src[path].attrs.items():
+                g.attrs[k] = v
+            linkChildren(src, dst, path, target)
+        else:
+            dst[path] = h5py.ExternalLink(target, path)
+
 def getFileContents(path):
     """ Read the contents of a file and return it """
 
@@ -316,7 +423,7 @@ def addSliceContents(siteNWBs, filesToInclude, basepath, sliceName):
     slicePath  = os.path.join(basepath, sliceName)
     sliceIndex = os.path.join(slicePath, ".index")
 
-    sliceNWBs = [elem for elem in siteNWBs if elem.startswith(slicePath)]
+    sliceNWBs = [elem for elem in siteNWBs if elem.startswith(slicePath + os.sep)]
 
     if len(sliceNWBs) == 0:
         #print "No NWB files belong to slice folder %s, skipping it." % slicePath
@@ -339,7 +446,11 @@ def addSliceContents(siteNWBs, filesToInclude, basepath, sliceName):
 
         if os.path.isdir(path): # site folder
             appendMiscFileToNWB(sliceNWBs, "%s_%s" % (sliceName, k), filedesc)
-            addSiteContents(sliceNWBs, filesToInclude, slicePath, k)
+
+            # site contents only go to the NWB file of that site
+            folderNWBs = [elem for elem in sliceNWBs if elem.startswith(path + os.sep)]
+            if len(folderNWBs) > 0:
+                addSiteContents(folderNWBs, filesToInclude, slicePath, k)
         elif os.path.isfile(path): # check if we need to handle it
 
             if fileShouldBeSkipped(path, filesToInclude):
@@ -374,7 +485,7 @@ def deriveOutputNWB(siteNWB):
 
     return os.path.abspath(os.path.join(tmpdir, filename))
 
-def buildCombinedNWB(siteNWB, filesToInclude = []):
+def buildCombinedNWB(siteNWB, filesToInclude = [], mode = 'clone'):
     """
     Convenience function for creating a new NWB file from an existing one
     with additional relevant metadata added.
@@ -383,6 +494,7 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
     @param: filesToInclude List of absolute paths to slice/site metadata files
                            (.ma/.tif/.log) to include only. Default is to include all metadata
                            retrievable from the .index files.
+    @param: mode           How the combined file is created from siteNWB, see prepareOutputNWB()
 
     @return: absolute path to the combined NWB file
 
@@ -399,7 +511,7 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
 
     basepath = os.path.abspath(os.path.join(os.path.dirname(siteNWB), "../.."))
 
-    return buildCombinedNWBInternal(basepath, [siteNWB], filesToInclude)[0]
+    return buildCombinedNWBInternal(basepath, [siteNWB], filesToInclude, mode = mode)[0]
 
 # - base 1     # no NWB
 #   - slice 1  # no NWB
@@ -408,49 +520,92 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
 #   - slice 2
 #   - ...
 
-def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude):
-    """ NOT FOR PUBLIC USE """
+def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude, mode = 'clone', workers = 1):
+    """
+    NOT FOR PUBLIC USE
 
-    # we have three types of keys in the main index file
-    # ---------------------------------------------------------------------
-    # '.'               | common description of the experiment | (unique)
-    # '$existingFile'   | log file of the experiment           | (multiple)
-    # '$existingFolder' | different slices for each experiment | (multiple)
+    Each site NWB is packaged independently; with workers > 1, sites are packaged by a pool of
+    worker processes.
+    """
 
-    dh = adm.getHandle(basepath)
-    dh.checkIndex()
+    global packagingMode
 
-    data = encodeAsJSONString(dh["."].info())
-    appendMiscFileToNWB(siteNWBs, basename = "main_index_meta", content = data)
+    if mode not in packagingModes:
+        raise NameError("Unknown packaging mode \"%s\", expected one of %s." % (mode, ', '.join(packagingModes)))
 
-    logfile = os.path.join(basepath, '.index')
-    appendMiscFileToNWB(siteNWBs, basename = "main_index", content = getFileContents(logfile))
+    # remove output files left over from earlier runs
+    for elem in siteNWBs:
+        outputNWB = deriveOutputNWB(elem)
+        if os.path.isfile(outputNWB):
+            os.remove(outputNWB)
+
+    jobs = [(basepath, elem, filesToInclude) for elem in siteNWBs]
+
+    if workers > 1 and len(siteNWBs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(siteNWBs)), initializer = initWorker, initargs = (tmpdir, mode))
+        try:
+            pool.map(buildSiteNWB, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        packagingMode = mode
+        for job in jobs:
+            buildSiteNWB(job)
+
+    combinedNWBs = []
 
     for elem in siteNWBs:
-        os.remove(deriveOutputNWB(elem))
+        combinedNWBs.append(deriveOutputNWB(elem))
 
-    for k in dh.ls():
-        if not dh.isManaged(k):
-            continue
+    return combinedNWBs
 
-        path = os.path.abspath(os.path.join(basepath, k))
+def initWorker(parentTmpdir, mode):
+    """ Use the output folder and packaging mode of the parent process """
 
-        if os.path.isdir(path): # slice folder
-            addSliceContents(siteNWBs, filesToInclude, basepath, k)
-        elif os.path.isfile(path): # main log file
+    global tmpdir, packagingMode
+    tmpdir = parentTmpdir
+    packagingMode = mode
 
-            data = encodeAsJSONString(dh[k].info())
-            appendMiscFileToNWB(siteNWBs, basename = "main_logfile_meta", content = data)
-            appendMiscFileToNWB(siteNWBs, basename = "main_logfile", content = getFileContents(path))
-        else:
-            raise NameError("Unexpected key \"%s\" in index \"%s\"" % (k, logfile))
+def buildSiteNWB(job):
+    """ Add all metadata for a single site NWB to its output file """
 
-    combinedNWBs = []
+    basepath, siteNWB, filesToInclude = job
+    siteNWBs = [siteNWB]
 
-    for elem in siteNWBs:
-        combinedNWBs.append(deriveOutputNWB(elem))
+    # we have three types of keys in the main index file
+    # ---------------------------------------------------------------------
+    # '.'               | common description of the experiment | (unique)
+    # '$existingFile'   | log file of the experiment           | (multiple)
+    # '$existingFolder' | different slices for each experiment | (multiple)
 
-    return combinedNWBs
+    try:
+        dh = adm.getHandle(basepath)
+        dh.checkIndex()
+
+        data = encodeAsJSONString(dh["."].info())
+        appendMiscFileToNWB(siteNWBs, basename = "main_index_meta", content = data)
+
+        logfile = os.path.join(basepath, '.index')
+        appendMiscFileToNWB(siteNWBs, basename = "main_index", content = getFileContents(logfile))
+
+        for k in dh.ls():
+            if not dh.isManaged(k):
+                continue
+
+            path = os.path.abspath(os.path.join(basepath, k))
+
+            if os.path.isdir(path): # slice folder
+                addSliceContents(siteNWBs, filesToInclude, basepath, k)
+            elif os.path.isfile(path): # main log file
+
+                data = encodeAsJSONString(dh[k].info())
+                appendMiscFileToNWB(siteNWBs, basename = "main_logfile_meta", content = data)
+                appendMiscFileToNWB(siteNWBs, basename = "main_logfile", content = getFileContents(path))
+            else:
+                raise NameError("Unexpected key \"%s\" in index \"%s\"" % (k, logfile))
+    finally:
+        closeNWBs()
 
 # Example invocations:
 #
@@ -466,6 +621,8 @@ def main():
     parser.add_argument('--basePath', help='Base path to look for MIES NWB files, alternative to --siteNWB')
     parser.add_argument('--siteNWB', help='Site NWB file')
     parser.add_argument('--filesToInclude', default = [], nargs = '*', help='Only include these metadata files')
+    parser.add_argument('--mode', default = 'clone', choices = packagingModes, help='How output files are created from the site NWB files (see prepareOutputNWB)')
+    parser.add_argument('--workers', type = int, default = 1, help='Number of sites to package at the same time')
 
     args = parser.parse_args()
 
@@ -495,7 +652,7 @@ def main():
 
     filesToInclude = [ os.path.abspath(elem) for elem in args.filesToInclude ]
 
-    outputNWBs = buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude)
+    outputNWBs = buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude, mode = args.mode, workers = args.workers)
 
     print "Creating combined NWB files:"
     for elem in outputNWBs:
@@ -0,0 +1,337 @@
+# coding: utf8
+"""
+Supervised classifier used to predict whether a cell pair is synaptically connected, based on
+the results of the connection_strength analysis.
+
+Training is expensive, so the classifier is trained as a pipeline stage (update_pair_classifier)
+and saved to the cache path along with its features and the version of the data it was trained
+on. Analyses then load the saved classifier with load_pair_classifier().
+
+"""
+from __future__ import print_function, division
+
+import os, pickle, time
+import numpy as np
+import sklearn.svm, sklearn.preprocessing, sklearn.model_selection
+
+from . import config
+from .database import database as db
+from .connection_strength import ConnectionStrength, query_all_pairs
+
+
+# Increment whenever changes to this module invalidate previously saved classifiers
+classifier_version = 1
+
+# Classifier configurations that are trained and saved by the pipeline
+default_configs = [
+    {'seed': 0, 'use_vc_features': False},
+    {'seed': 0, 'use_vc_features': True},
+]
+
+
+class PairClassifier(object):
+    """Supervised classifier used to predict whether a cell pair is synaptically connected.
+
+    Input records should be similar to those generated by query_all_pairs()
+
+    Parameters
+    ----------
+    seed : int | None
+        Random seed used when shuffling training/test inputs
+    use_vc_features : bool
+        If True, voltage clamp results are used as features in addition to current clamp results
+    n_jobs : int | None
+        Number of processes used for the cross-validated hyperparameter search (-1 uses all cores)
+    """
+    def __init__(self, seed=None, use_vc_features=True, n_jobs=1):
+        ic_features = [
+            # 'ic_amp_mean',
+            # 'ic_amp_stdev',
+            # 'ic_amp_ks2samp',  # hurts perfornamce
+            'ic_deconv_amp_mean',
+            # 'ic_deconv_amp_stdev',
+            'ic_deconv_amp_ks2samp',
+            'ic_latency_mean',
+            'ic_latency_stdev',
+            'ic_latency_ks2samp',
+            # 'ic_crosstalk_mean',
+            'ic_fit_amp',
+            'ic_fit_xoffset',
+            'ic_fit_yoffset',
+            'ic_fit_rise_time',
+            #'ic_fit_rise_power',
+            'ic_fit_decay_tau',
+            #'ic_fit_exp_amp',
+            'ic_fit_nrmse',
+
+        ]
+        vc_features = [
+            # 'vc_amp_mean',  # hurts perfornamce
+            # 'vc_amp_stdev',
+            'vc_amp_ks2samp',
+            # 'vc_deconv_amp_mean',
+            # 'vc_deconv_amp_stdev',
+            # 'vc_deconv_amp_ks2samp',  # hurts performance
+            # 'vc_latency_mean',
+            # 'vc_latency_stdev',  # hurts performance
+            'vc_latency_ks2samp',
+
+            'vc_fit_amp',
+            'vc_fit_xoffset',
+            'vc_fit_yoffset',
+            'vc_fit_rise_time',
+            #'vc_fit_rise_power',
+            'vc_fit_decay_tau',
+            #'vc_fit_exp_amp',
+            'vc_fit_nrmse',
+        ]
+        general_features = [
+            # 'electrode_distance',
+        ]
+
+        self.features = general_features + ic_features
+        if use_vc_features:
+             self.features.extend(vc_features)
+
+        self.seed = seed
+        self.use_vc_features = use_vc_features
+        self.n_jobs = n_jobs
+
+        # version of the data used for training (see data_version())
+        self.data_version = None
+
+    def fit(self, recs):
+        ids = recs['id']
+
+        # Select features from records
+        features = feature_matrix(recs, self.features)
+
+        # QC bad records; don't train on these
+        mask = (recs['ic_n_samples'] > 100) & (recs['ic_crosstalk_mean'] < 60e-6)
+
+        x = features[mask]
+        y = recs['synapse'][mask].astype(bool)
+        ids = ids[mask]
+
+        # shuffle
+        order = np.arange(len(y))
+        rand = np.random.RandomState(seed=self.seed)
+        rand.shuffle(order)
+        x = x[order]
+        y = y[order]
+        ids = ids[order]
+
+        # mask out nan/inf records
+        mask2 = np.all(np.isfinite(x), axis=1) & np.isfinite(y)
+        x = x[mask2]
+        y = y[mask2]
+        ids = ids[mask2]
+        mask[mask] = mask2
+
+        # prescale records, keep the scaler for later processing
+        scaler = sklearn.preprocessing.StandardScaler().fit(x)
+        x = scaler.transform(x)
+        self.scaler = scaler
+
+        # split into training and test sets
+        # select training set from connected and non-connected separately to ensure
+        # we get enough connected examples in the training set
+        train_mask = np.zeros(len(y), dtype='bool')
+        syn = np.argwhere(y)
+        n = len(syn) // 4 * 3
+        train_mask[syn[:n]] = True
+        other = np.arange(len(y))[~train_mask]
+        rand.shuffle(other)
+        # 1/5 of training data is connected, the rest is unconnected
+        train_mask[other[:n*5]] = True
+
+        train_x = x[train_mask]
+        train_y = y[train_mask]
+        test_x = x[~train_mask]
+        test_y = y[~train_mask]
+        print("Train: %d  test: %d   random seed: %s" % (len(train_y), len(test_y), self.seed))
+
+        # build and fit the classifier
+        #clf = sklearn.svm.LinearSVC()
+        clf = sklearn.svm.SVC(C=1, class_weight='balanced', coef0=0.0,
+        decision_function_shape='ovr', degree=3, gamma='auto', kernel='rbf',
+        max_iter=-1, probability=True, random_state=self.seed)
+        # clf = sklearn.ensemble.RandomForestClassifier()
+
+        hyper_params = [{'C': [1, 10, 100, 1000], 'gamma': [0.1, 0.01, 0.001, 0.0001]}]
+        search = sklearn.model_selection.GridSearchCV(clf, hyper_params, n_jobs=self.n_jobs)
+        search.fit(train_x, train_y)
+        print("Classifier best hyperparameters:", search.best_params_)
+
+        # only the refit best estimator is needed for prediction
+        self.clf = search.best_estimator_
+
+        def test(clf, test_x, test_y):
+            pred = clf.predict(test_x)
+            def pr(name, pred, test_y):
+                print("%s:  %d/%d  %0.2f%%" % (name, (pred & test_y).sum(), test_y.sum(), 100 * (pred & test_y).sum() / test_y.sum()))
+
+            pr(" True positive", pred, test_y)
+            pr("False positive", pred, ~test_y)
+            pr(" True negative", ~pred, ~test_y)
+            pr("False negative", ~pred, test_y)
+
+        print("TRAIN:")
+        test(self.clf, train_x, train_y)
+
+        print("TEST:")
+        test(self.clf, test_x, test_y)
+
+        # calculate approximate probability threshold between classes
+        pred = self.predict(recs)
+        min_prob = pred[pred['prediction'] == True]['confidence'].min()
+        max_prob = pred[pred['prediction'] == False]['confidence'].max()
+        self.prob_threshold = (min_prob + max_prob) / 2.
+
+    def predict(self, recs=None):
+        """Predict connectivity for a sequence of records output from analyze_response_strength
+
+        Input may be a structured array or list of dicts.
+        """
+        # Select features from records
+        if isinstance(recs, np.ndarray):
+            features = feature_matrix(recs, self.features)
+        else:
+            features = np.array([tuple(map(r.__getitem__, self.features)) for r in recs], dtype=float).reshape(len(recs), len(self.features))
+
+        # prepare ouptut array
+        result = np.empty(len(features), dtype=[('prediction', float), ('confidence', float)])
+        result[:] = np.nan
+
+        # mask out inf/nan records
+        mask = np.all(np.isfinite(features), axis=1)
+
+        # scale masked records
+        norm_features = self.scaler.transform(features[mask])
+
+        # fill in output array
+        result['prediction'][mask] = self.clf.predict(norm_features)
+        # result['confidence'][mask] = clf.decision_function(norm_features)
+        result['confidence'][mask] = self.clf.predict_proba(norm_features)[:,1]
+        # result['confidence'][mask] = clf.predict_proba(norm_features)[:,1]
+        assert np.isfinite(result[mask]['confidence']).sum() > 0
+        return result
+
+    def save(self, filename):
+        state = {
+            'classifier_version': classifier_version,
+            'features': self.features,
+            'seed': self.seed,
+            'use_vc_features': self.use_vc_features,
+            'data_version': self.data_version,
+            'scaler': self.scaler,
+            'clf': self.clf,
+            'prob_threshold': self.prob_threshold,
+        }
+        # write to a temporary file first so that readers never see a partially written classifier
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a classifier previously written by save().
+
+        Returns None if the file was written by an incompatible version of this module.
+        """
+        with open(filename, 'rb') as fh:
+            state = pickle.load(fh)
+        if state.get('classifier_version') != classifier_version:
+            return None
+        clf = cls(seed=state['seed'], use_vc_features=state['use_vc_features'])
+        if clf.features != state['features']:
+            return None
+        for k in ('data_version', 'scaler', 'clf', 'prob_threshold'):
+            setattr(clf, k, state[k])
+        return clf
+
+
+def feature_matrix(recs, features):
+    """Return a float array of shape (len(recs), len(features)) containing the named fields from
+    structured array *recs*.
+
+    Fields are copied column by column into a single preallocated array rather than converting
+    each record to a tuple.
+    """
+    x = np.empty((len(recs), len(features)), dtype=float)
+    for i, name in enumerate(features):
+        x[:, i] = recs[name]
+    return x
+
+
+def classifier_file(seed=0, use_vc_features=True):
+    return os.path.join(config.cache_path, 'pair_classifier_seed%s_%s.pkl' % (seed, 'icvc' if use_vc_features else 'ic'))
+
+
+@db.default_session
+def data_version(session=None):
+    """Return a value that changes whenever connection strength results are added, removed, or
+    rebuilt (ids start over when the table is recreated, so creation times are included).
+    """
+    return list(session.query(
+        db.func.count(ConnectionStrength.id),
+        db.func.max(ConnectionStrength.id),
+        db.func.max(ConnectionStrength.time_created),
+        db.func.max(ConnectionStrength.time_modified),
+    ).one())
+
+
+def load_pair_classifier(seed=0, use_vc_features=True):
+    """Load the classifier saved by the pipeline for the given configuration.
+
+    Returns None if no compatible classifier has been saved.
+    """
+    filename = classifier_file(seed, use_vc_features)
+    if not os.path.isfile(filename):
+        return None
+    return PairClassifier.load(filename)
+
+
+def train_pair_classifier(seed=0, use_vc_features=True, n_jobs=1, recs=None, session=None):
+    """Train a new classifier on all pairs in the database.
+    """
+    clf = PairClassifier(seed=seed, use_vc_features=use_vc_features, n_jobs=n_jobs)
+    clf.data_version = data_version(session=session)
+    if recs is None:
+        recs = query_all_pairs(session=session)
+    clf.fit(recs)
+    return clf
+
+
+@db.default_session
+def update_pair_classifier(configs=None, n_jobs=-1, rebuild=False, session=None):
+    """Train and save classifiers for each configuration in *configs* (default is default_configs).
+
+    Saved classifiers are only retrained if the connection strength data have changed since they
+    were trained, or if *rebuild* is True.
+    """
+    if configs is None:
+        configs = default_configs
+    current_version = data_version(session=session)
+    recs = None
+
+    if not os.path.isdir(config.cache_path):
+        os.makedirs(config.cache_path)
+
+    for cfg in configs:
+        if not rebuild:
+            clf = load_pair_classifier(**cfg)
+            if clf is not None and clf.data_version == current_version:
+                print("Pair classifier %r is up to date." % cfg)
+                continue
+
+        print("Training pair classifier %r.." % cfg)
+        if recs is None:
+            recs = query_all_pairs(session=session)
+        start = time.time()
+        clf = train_pair_classifier(n_jobs=n_jobs, recs=recs, session=session, **cfg)
+        clf.save(classifier_file(**cfg))
+        print("  trained in %0.1f s" % (time.time() - start))
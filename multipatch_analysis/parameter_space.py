@@ -0,0 +1,278 @@
+# coding: utf8
+"""
+Headless, resumable evaluation of a function over a grid of parameters.
+
+Results are stored as numeric records in a (optionally memory-mapped) array with one record
+per grid point, so that very large parameter spaces never need to be held in memory and an
+interrupted search can be resumed without re-evaluating completed points. The grid can be
+searched exhaustively (ParameterSpace.run) or adaptively, refining only around the best
+results found so far (ParameterSpace.run_adaptive).
+
+"""
+from __future__ import print_function, division
+
+import os, json, time, itertools, multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+
+class ParameterSpace(object):
+    """An N-dimensional grid of parameters to be searched.
+
+    Parameters
+    ----------
+    params : dict
+        Maps parameter names to either an array of values to search (these become the
+        axes of the space) or a scalar value that is held constant for all evaluations.
+
+    Examples
+    --------
+
+        space = ParameterSpace({'a': np.linspace(0, 1, 10), 'b': np.arange(5), 'c': 3.0})
+        space.run(func, result_dtype=[('score', float)], cache_file='search.npy', workers=8)
+        score = space.result['score']  # shape (10, 5), memory-mapped
+    """
+    def __init__(self, params):
+        params = params.copy()
+        static_params = {}
+        for param, val in list(params.items()):
+            if np.isscalar(val):
+                static_params[param] = params.pop(param)
+        self.static_params = static_params
+        self.params = params
+
+        self.param_order = list(params.keys())
+        self.shape = tuple([len(params[p]) for p in self.param_order])
+
+        self.result = None
+        self.evaluated = None
+        self.cache_file = None
+        self.n_evaluations = 0
+        self.search_history = []
+
+    def axes(self):
+        return OrderedDict([(ax, {'values': self.params[ax]}) for ax in self.param_order])
+
+    def __getitem__(self, inds):
+        params = self.static_params.copy()
+        for i,param in enumerate(self.param_order):
+            params[param] = self.params[param][inds[i]]
+        return params
+
+    def run(self, func, result_dtype, cache_file=None, workers=None, chunk_size=1000, resume=True):
+        """Evaluate *func(params)* for every point in the parameter space.
+
+        *func* must return a tuple matching *result_dtype*. When *workers* is greater than 1, *func*
+        must be picklable (for example, a module-level function or an instance of a module-level
+        class) because chunks of the space are dispatched to a process pool.
+
+        If *cache_file* is given, results are written to a memory-mapped .npy file as each chunk
+        completes, along with a mask of which points have been evaluated. Calling run() again with
+        the same cache file and parameters resumes from the last completed chunk (unless *resume* is
+        False). The result array is available afterward as ``self.result``.
+        """
+        self._open(result_dtype, cache_file, resume)
+        pool = self._start_workers(func, workers)
+        try:
+            self._evaluate(np.arange(self.result.size), pool, chunk_size)
+        finally:
+            self._stop_workers(pool)
+        return self.result
+
+    def run_adaptive(self, func, result_dtype, score_field, initial_stride=4, n_best=8, max_iter=100,
+                     cache_file=None, workers=None, chunk_size=100, resume=True):
+        """Search for the maximum of *score_field* without evaluating the entire parameter space.
+
+        The search begins by evaluating a coarse grid that samples every *initial_stride*-th value
+        along each axis. The *n_best* highest-scoring points are then refined by evaluating all of
+        their neighbors at half the previous stride, repeating until the stride reaches 1 and no
+        unevaluated neighbors of the best points remain (or *max_iter* refinements are done).
+
+        Arguments are otherwise the same as for run(). Grid points that were never evaluated are
+        left as NaN in ``self.result`` (and False in ``self.evaluated``), so the result can be
+        browsed the same way as an exhaustive search.
+        """
+        self._open(result_dtype, cache_file, resume)
+        pool = self._start_workers(func, workers)
+        try:
+            coarse_axes = [np.unique(np.append(np.arange(0, n, initial_stride), n-1)) for n in self.shape]
+            coarse = np.ravel_multi_index(np.meshgrid(*coarse_axes, indexing='ij'), self.shape).ravel()
+            self._evaluate(coarse, pool, chunk_size, score_field)
+
+            stride = initial_stride
+            for i in range(max_iter):
+                stride = max(1, stride // 2)
+                best = self.best(score_field, n_best)
+                n_new = self._evaluate(self._neighborhood(best, stride), pool, chunk_size, score_field)
+                if stride == 1 and n_new == 0:
+                    break
+        finally:
+            self._stop_workers(pool)
+        return self.result
+
+    def best(self, score_field, n=1):
+        """Return flat indices of the *n* evaluated points with the highest *score_field*, best first.
+        """
+        scores = np.array(self.result[score_field]).reshape(-1)
+        scores[~self.evaluated.reshape(-1) | np.isnan(scores)] = -np.inf
+        n = min(n, len(scores))
+        best = np.argpartition(scores, len(scores) - n)[-n:]
+        return best[np.argsort(scores[best])[::-1]]
+
+    def _neighborhood(self, flat_inds, stride):
+        """Return flat indices of all grid points within *stride* steps of *flat_inds* along each axis.
+        """
+        inds = np.array(np.unravel_index(flat_inds, self.shape)).T
+        offsets = np.array(list(itertools.product([-stride, 0, stride], repeat=len(self.shape))))
+        points = inds[:, None, :] + offsets[None, :, :]
+        points = np.clip(points, 0, np.array(self.shape) - 1).reshape(-1, len(self.shape))
+        return np.unique(np.ravel_multi_index(tuple(points.T), self.shape))
+
+    def _open(self, result_dtype, cache_file, resume):
+        """Allocate or reopen the result and evaluation mask arrays.
+        """
+        result_dtype = np.dtype(result_dtype)
+        self.n_evaluations = 0
+        self.search_history = []
+        self.cache_file = cache_file
+
+        if cache_file is None:
+            self.result = np.empty(self.shape, dtype=result_dtype)
+            self.evaluated = np.zeros(self.shape, dtype=bool)
+            _fill_nan(self.result)
+            return
+
+        meta = self._cache_meta(result_dtype)
+        meta_file, mask_file = _cache_file_names(cache_file)
+        if resume and os.path.isfile(cache_file) and os.path.isfile(meta_file) and os.path.isfile(mask_file):
+            old_meta = json.load(open(meta_file, 'r'))
+            if old_meta != meta:
+                raise ValueError('Parameter search cache "%s" was generated with different parameters; '
+                                 'use a different cache file or resume=False.' % cache_file)
+            self.result = np.load(cache_file, mmap_mode='r+')
+            self.evaluated = np.load(mask_file, mmap_mode='r+')
+            n_done = self.evaluated.sum()
+            if n_done > 0:
+                print("Resuming parameter search: %d/%d points already evaluated" % (n_done, self.evaluated.size))
+        else:
+            self.result = np.lib.format.open_memmap(cache_file, mode='w+', dtype=result_dtype, shape=self.shape)
+            self.evaluated = np.lib.format.open_memmap(mask_file, mode='w+', dtype=bool, shape=self.shape)
+            _fill_nan(self.result)
+            json.dump(meta, open(meta_file, 'w'), indent=2)
+
+    def _start_workers(self, func, workers):
+        worker_args = (self.params, self.static_params, self.param_order, self.shape, func, self.result.dtype)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers > 1:
+            return multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=worker_args)
+        else:
+            _init_worker(*worker_args)
+            return None
+
+    def _stop_workers(self, pool):
+        if pool is not None:
+            pool.terminate()
+        self._flush()
+
+    def _evaluate(self, flat_inds, pool, chunk_size, score_field=None):
+        """Evaluate all points in *flat_inds* that have not already been evaluated.
+
+        Returns the number of new points evaluated.
+        """
+        flat_result = self.result.reshape(-1)
+        flat_evaluated = self.evaluated.reshape(-1)
+        flat_inds = np.asarray(flat_inds)
+        flat_inds = flat_inds[~flat_evaluated[flat_inds]]
+        if len(flat_inds) == 0:
+            return 0
+
+        chunks = [flat_inds[i:i+chunk_size] for i in range(0, len(flat_inds), chunk_size)]
+        if pool is None:
+            results = (_run_chunk(chunk) for chunk in chunks)
+        else:
+            results = pool.imap_unordered(_run_chunk, chunks)
+
+        start_time = time.time()
+        last_flush = start_time
+        for i, (inds, chunk_result) in enumerate(results):
+            flat_result[inds] = chunk_result
+            flat_evaluated[inds] = True
+            self.n_evaluations += len(inds)
+
+            now = time.time()
+            if self.cache_file is not None and now - last_flush > 10:
+                self._flush()
+                last_flush = now
+                remaining = (now - start_time) * (len(chunks) - i - 1) / (i + 1)
+                print("  parameter search: %d/%d points evaluated  (%0.0f s remaining)" % (flat_evaluated.sum(), flat_evaluated.size, remaining))
+
+        if score_field is not None:
+            best = self.best(score_field)[0]
+            self.search_history.append((self.n_evaluations, flat_result[best][score_field]))
+
+        return len(flat_inds)
+
+    def _flush(self):
+        # results must hit the disk before the points are marked complete
+        if isinstance(self.result, np.memmap):
+            self.result.flush()
+            self.evaluated.flush()
+
+    def _cache_meta(self, result_dtype):
+        return {
+            'param_order': self.param_order,
+            'params': {k: np.asarray(v).tolist() for k,v in self.params.items()},
+            'static_params': {k: np.asarray(v).tolist() for k,v in self.static_params.items()},
+            'result_dtype': [list(f) for f in np.lib.format.dtype_to_descr(result_dtype)],
+        }
+
+    @classmethod
+    def load(cls, cache_file, mode='r'):
+        """Open the results of a previous search from *cache_file* without loading them into memory.
+
+        Returns a ParameterSpace whose ``result`` and ``evaluated`` attributes are memory-mapped
+        arrays, and the fraction of the space that has been evaluated.
+        """
+        meta_file, mask_file = _cache_file_names(cache_file)
+        meta = json.load(open(meta_file, 'r'))
+        params = OrderedDict([(k, np.array(meta['params'][k])) for k in meta['param_order']])
+        params.update(meta['static_params'])
+        space = cls(params)
+        space.result = np.load(cache_file, mmap_mode=mode)
+        space.evaluated = np.load(mask_file, mmap_mode=mode)
+        space.cache_file = cache_file
+        return space, space.evaluated.mean()
+
+
+def _cache_file_names(cache_file):
+    base = os.path.splitext(cache_file)[0]
+    return base + '_meta.json', base + '_evaluated.npy'
+
+
+def _fill_nan(result):
+    # unevaluated points are NaN so that they are distinguishable from real results
+    for field in result.dtype.names:
+        if result.dtype[field].kind == 'f':
+            result[field] = np.nan
+
+
+_worker_state = None
+
+def _init_worker(params, static_params, param_order, shape, func, result_dtype):
+    global _worker_state
+    _worker_state = (params, static_params, param_order, shape, func, result_dtype)
+
+
+def _run_chunk(flat_inds):
+    """Evaluate a block of flat indices into the parameter space.
+    """
+    params, static_params, param_order, shape, func, result_dtype = _worker_state
+    result = np.zeros(len(flat_inds), dtype=result_dtype)
+    inds = np.unravel_index(flat_inds, shape)
+    for i in range(len(flat_inds)):
+        p = static_params.copy()
+        for j,param in enumerate(param_order):
+            p[param] = params[param][inds[j][i]]
+        result[i] = func(p)
+    return flat_inds, result
@@ -8,7 +8,6 @@ from __future__ import print_function, division
 import sys, multiprocessing, time
 
 import numpy as np
-import pyqtgraph as pg
 
 from neuroanalysis.data import Trace
 from neuroanalysis import filter
@@ -66,15 +65,14 @@ pulse_response_strength_tables = PulseResponseStrengthTableGroup()
 
 
 def init_tables():
-    global PulseResponseStrength, BaselineResponseStrength
-    pulse_response_strength_tables.create_tables()
-
-    PulseResponseStrength = pulse_response_strength_tables['pulse_response_strength']
-    BaselineResponseStrength = pulse_response_strength_tables['baseline_response_strength']
+    """Create tables in the database if they do not exist yet (see TableGroup.ensure_tables).
+    """
+    pulse_response_strength_tables.ensure_tables()
 
 
-# create tables in database and add global variables for ORM classes
-init_tables()
+# add global variables for ORM classes
+PulseResponseStrength = pulse_response_strength_tables['pulse_response_strength']
+BaselineResponseStrength = pulse_response_strength_tables['baseline_response_strength']
 
 
 def measure_peak(trace, sign, spike_time, pulse_times, spike_delay=1e-3, response_window=4e-3):
@@ -143,6 +141,7 @@ def remove_crosstalk_artifacts(data, pulse_times):
 def update_strength(limit=0, expts=None, parallel=True, workers=6, raise_exceptions=False, session=None):
     """Update pulse response strength tables for all experiments
     """
+    init_tables()
     if expts is None:
         experiments = session.query(db.Experiment.acq_timestamp).all()
         expts_done = session.query(db.Experiment.acq_timestamp).join(db.SyncRec).join(db.Recording).join(db.Baseline).join(BaselineResponseStrength).distinct().all()
@@ -204,10 +203,7 @@ def _compute_strength(source, expt_id, session=None):
     # select just data for the selected experiment
     q = q.join(db.SyncRec).join(db.Experiment).filter(db.Experiment.acq_timestamp==expt_id)
 
-    prof = pg.debug.Profiler(delayed=False)
-    
     recs = q.all()
-    prof('fetch')
         
     new_recs = []
 
@@ -218,8 +214,6 @@ def _compute_strength(source, expt_id, session=None):
         for k in ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp', 'pos_dec_latency', 'neg_dec_latency', 'crosstalk']:
             new_rec[k] = result[k]
         new_recs.append(new_rec)
-    
-    prof('process')
 
     # Bulk insert is not safe with parallel processes
     # if source == 'pulse_response':
@@ -235,7 +229,6 @@ def _compute_strength(source, expt_id, session=None):
             brs = BaselineResponseStrength(**rec)
             session.add(brs)
 
-    prof('insert')
     new_recs = []
 
     return "succeeded"
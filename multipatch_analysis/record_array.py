@@ -0,0 +1,63 @@
+# coding: utf8
+"""
+Utilities for building and combining numpy structured (record) arrays.
+
+All functions here allocate their output once and copy data field by field, so they scale
+with the number of fields rather than the number of records, and handle object fields
+(strings, None, etc.) the same way as numeric fields.
+
+"""
+from __future__ import print_function, division
+
+from collections import OrderedDict
+import numpy as np
+import pandas
+
+
+def records_from_columns(columns):
+    """Return a structured array built from an ordered dict of {field_name: column_array}.
+
+    All columns must have the same length; the dtype of each field is taken from its column.
+    """
+    columns = OrderedDict([(str(name), np.asarray(col)) for name, col in columns.items()])
+    lengths = set([len(col) for col in columns.values()])
+    if len(lengths) > 1:
+        raise ValueError("All columns must have the same length (got %r)" % sorted(lengths))
+    n_recs = lengths.pop() if len(lengths) > 0 else 0
+
+    dtype = [(name, col.dtype, col.shape[1:]) for name, col in columns.items()]
+    recs = np.empty(n_recs, dtype=dtype)
+    for name, col in columns.items():
+        recs[name] = col
+    return recs
+
+
+def join_struct_arrays(arrays):
+    """Join structured arrays together field-wise.
+
+    All arrays must have the same length, and field names must be unique across all arrays.
+    Returns a new structured array containing every field from every array, in order.
+    """
+    columns = OrderedDict()
+    for arr in arrays:
+        for name in arr.dtype.names:
+            if name in columns:
+                raise ValueError("Field %r appears in more than one array" % name)
+            columns[name] = arr[name]
+    return records_from_columns(columns)
+
+
+def read_sql_records(sql, bind, index=True):
+    """Run an SQL query (a string or SQLAlchemy selectable) and return the results as a
+    structured array with one field per result column.
+
+    If *index* is True, the first field is named 'index' and contains the row number
+    (this matches the output of pandas.DataFrame.to_records()).
+    """
+    df = pandas.read_sql(sql, bind)
+    columns = OrderedDict()
+    if index:
+        columns['index'] = np.arange(len(df))
+    for name in df.columns:
+        columns[name] = df[name].values
+    return records_from_columns(columns)
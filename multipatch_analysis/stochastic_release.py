@@ -0,0 +1,272 @@
+# coding: utf8
+"""
+Stochastic vesicle release model used to estimate the likelihood that a set of measured
+synaptic response amplitudes could have been generated by a synapse with particular
+release parameters.
+
+"""
+from __future__ import print_function, division
+
+import numpy as np
+import scipy.stats as stats
+
+try:
+    import numba
+    jit = numba.jit(nopython=True, error_model='numpy')
+except ImportError:
+    # the likelihood kernel still works without numba, just much more slowly
+    jit = lambda fn: fn
+
+
+class StochasticReleaseModel(object):
+
+    result_dtype = [
+        ('spike_time', float),
+        ('amplitude', float),
+        ('expected_amplitude', float),
+        ('likelihood', float),
+    ]
+
+    state_dtype = [
+        ('available_vesicle', float),
+    ]
+
+    def __init__(self):
+        # model parameters
+        self.n_release_sites = 20
+        self.release_probability = 0.1
+        self.mini_amplitude = 50e-6
+        self.mini_amplitude_stdev = 20e-6
+        self.recovery_tau = 100e-3
+        self.measurement_stdev = 100e-6
+
+    def measure_likelihood(self, spike_times, amplitudes):
+        """Compute a measure of the likelihood that *times* and *amplitudes* could be generated
+        by a synapse with the current dynamic parameters.
+
+        Returns
+        -------
+        result : array
+            result contains fields: spike_time, amplitude, expected_amplitude, likelihood
+        pre_spike_state:
+            state variables immediately before each spike
+        post_spike_state:
+            state variables immediately after each spike
+        """
+        spike_times = np.ascontiguousarray(spike_times, dtype=float)
+        amplitudes = np.ascontiguousarray(amplitudes, dtype=float)
+        n_sites = int(self.n_release_sites)
+
+        # all spikes share the same release statistics, so the binomial pmf and the
+        # per-release-count amplitude distributions are computed only once per train
+        pmf_table = binomial_pmf_table(n_sites, self.release_probability)
+        n_vesicles = np.arange(n_sites + 1)
+        amp_mean = n_vesicles * float(self.mini_amplitude)
+        amp_stdev = (self.mini_amplitude_stdev**2 * n_vesicles + self.measurement_stdev**2) ** 0.5
+
+        expected_amplitude, likelihood, pre_vesicle, post_vesicle = release_likelihood_kernel(
+            spike_times, amplitudes, pmf_table, amp_mean, amp_stdev,
+            float(n_sites), float(self.release_probability), float(self.mini_amplitude), float(self.recovery_tau),
+        )
+
+        result = np.empty(len(spike_times), dtype=self.result_dtype)
+        result['spike_time'] = spike_times
+        result['amplitude'] = amplitudes
+        result['expected_amplitude'] = expected_amplitude
+        result['likelihood'] = likelihood
+
+        pre_spike_state = np.empty(len(spike_times), dtype=self.state_dtype)
+        pre_spike_state['available_vesicle'] = pre_vesicle
+        post_spike_state = np.empty(len(spike_times), dtype=self.state_dtype)
+        post_spike_state['available_vesicle'] = post_vesicle
+
+        return result, pre_spike_state, post_spike_state
+
+    def likelihood(self, amplitudes, state):
+        """Estimate the probability density of seeing a particular *amplitude*
+        given a number of *available_vesicles*.
+        """
+        available_vesicles = int(np.clip(np.round(state['available_vesicle']), 0, self.n_release_sites))
+        return release_likelihood(amplitudes, available_vesicles, self.release_probability, self.mini_amplitude, self.mini_amplitude_stdev, self.measurement_stdev)
+
+
+class StochasticModelRunner(object):
+    """Evaluates StochasticReleaseModel against a fixed set of measured events.
+
+    Instances are picklable so that they can be handed to ParameterSpace.run() and
+    evaluated in worker processes. Calling the runner with a dict of model parameters
+    returns a tuple of summary statistics matching *result_dtype*; use run_model() to
+    get the complete per-spike results for a single parameter set.
+    """
+    result_dtype = [
+        ('likelihood', float),       # mean of log(likelihood + 1) across all events
+        ('log_likelihood', float),   # sum of log(likelihood) across all events (likelihood clipped at 1e-300)
+        ('rms_error', float),        # rms difference between expected and measured amplitudes
+        ('mean_available_vesicle', float),
+    ]
+
+    def __init__(self, spike_times, amplitudes):
+        self.spike_times = spike_times
+        self.amplitudes = amplitudes
+
+    def run_model(self, params):
+        model = StochasticReleaseModel()
+        for k,v in params.items():
+            setattr(model, k, v)
+        return (model,) + model.measure_likelihood(self.spike_times, self.amplitudes)
+
+    def __call__(self, params):
+        model, result, pre_state, post_state = self.run_model(params)
+        return self.summarize(result, pre_state)
+
+    @staticmethod
+    def summarize(result, pre_state):
+        likelihood = result['likelihood']
+        # likelihoods that underflow to 0 are clipped so that very poor models are still
+        # ranked against each other rather than all scoring -inf
+        log_likelihood = np.log(np.clip(likelihood, 1e-300, None)).sum()
+        return (
+            np.log(likelihood + 1).mean(),
+            log_likelihood,
+            ((result['expected_amplitude'] - result['amplitude'])**2).mean()**0.5,
+            pre_state['available_vesicle'].mean(),
+        )
+
+
+def binomial_pmf_table(n_release_sites, release_probability):
+    """Return a lookup table of binomial probabilities for all possible vesicle counts.
+
+    The returned array has shape (n_release_sites+1, n_release_sites+1), where
+    ``table[nV, nR]`` is the probability that *nR* vesicles are released when *nV* vesicles
+    are available (zero wherever nR > nV).
+    """
+    n = np.arange(n_release_sites + 1)
+    table = stats.binom.pmf(n[None, :], n[:, None], release_probability)
+    return np.ascontiguousarray(table, dtype=float)
+
+
+@jit
+def release_likelihood_kernel(spike_times, amplitudes, pmf_table, amp_mean, amp_stdev, n_release_sites, release_probability, mini_amplitude, recovery_tau):
+    """Run the stochastic release model over an entire spike train.
+
+    This is the compiled inner loop of StochasticReleaseModel.measure_likelihood. *pmf_table* is
+    the output of binomial_pmf_table(), and *amp_mean* / *amp_stdev* give the mean and stdev of the
+    response amplitude expected for each possible number of released vesicles.
+
+    Returns arrays of expected amplitude, likelihood, and available vesicles immediately before
+    and after each spike.
+    """
+    n_spikes = spike_times.shape[0]
+    n_amps = amp_mean.shape[0]
+    expected_amplitude = np.empty(n_spikes)
+    likelihood = np.empty(n_spikes)
+    pre_vesicle = np.empty(n_spikes)
+    post_vesicle = np.empty(n_spikes)
+    if n_spikes == 0:
+        return expected_amplitude, likelihood, pre_vesicle, post_vesicle
+
+    # precompute gaussian normalization for each possible number of released vesicles
+    norm = np.empty(n_amps)
+    inv_var = np.empty(n_amps)
+    for j in range(n_amps):
+        var = amp_stdev[j]**2
+        norm[j] = (1.0 / (2 * np.pi * var))**0.5
+        inv_var[j] = 1.0 / (2 * var)
+
+    available_vesicle = n_release_sites
+    previous_t = spike_times[0]
+    for i in range(n_spikes):
+        t = spike_times[i]
+        amplitude = amplitudes[i]
+
+        # recover vesicles up to the current timepoint
+        dt = t - previous_t
+        previous_t = t
+        recovery = np.exp(-dt / recovery_tau)
+        available_vesicle = available_vesicle * recovery + n_release_sites * (1.0 - recovery)
+        pre_vesicle[i] = available_vesicle
+
+        # measure likelihood of seeing this response amplitude
+        expected_amplitude[i] = available_vesicle * release_probability * mini_amplitude
+        n_avail = int(min(max(np.round(available_vesicle), 0), n_release_sites))
+        total = 0.0
+        for j in range(n_avail + 1):
+            diff = amplitude - amp_mean[j]
+            total += pmf_table[n_avail, j] * norm[j] * np.exp(-diff * diff * inv_var[j])
+        likelihood[i] = total
+
+        # release vesicles
+        # note: we allow available_vesicle to become negative because this help to ensure
+        # that the overall likelihood will be low for such models
+        available_vesicle -= amplitude / mini_amplitude
+        post_vesicle[i] = available_vesicle
+
+    return expected_amplitude, likelihood, pre_vesicle, post_vesicle
+
+
+def release_likelihood(amplitudes, available_vesicles, release_probability, mini_amplitude, mini_amplitude_stdev, measurement_stdev):
+    """Return a measure of the likelihood that a synaptic response will have certain amplitude(s),
+    given the state parameters for the synapse.
+
+    Parameters
+    ----------
+    amplitudes : array
+        The amplitudes for which likelihood values will be returned
+    available_vesicles : int
+        Number of vesicles available for release
+    release_probability : float
+        Probability for each available vesicle to be released
+    mini_amplitude : float
+        Mean amplitude of response evoked by a single vesicle release
+    mini_amplitude_stdev : float
+        Standard deviation of response amplitudes evoked by a single vesicle release
+    measurement_stdev : float
+        Standard deviation of response amplitude measurement errors
+
+
+    For each value in *amplitudes*, we calculate the likelihood that a synapse would evoke a response
+    of that amplitude. Likelihood is calculated as follows:
+
+    1. Given the number of vesicles available to be released (nV) and the release probability (pR), determine
+       the probability that each possible number of vesicles (nR) will be released using the binomial distribution
+       probability mass function. For example, if there are 3 vesicles available and the release probability is
+       0.1, then the possibilities are:
+           vesicles released (nR)    probability
+                                0    0.729
+                                1    0.243
+                                2    0.27
+                                3    0.001
+    2. For each possible number of released vesicles, calculate the likelihood that this possibility could
+       evoke a response of the tested amplitude. This is calculated using the Gaussian probability distribution
+       function where µ = nR * mini_amplitude and σ = sqrt(mini_amplitude_stdev^2 * nR + measurement_stdev)
+    3. The total likelihood is the sum of likelihoods for all possible values of nR.
+    """
+    amplitudes = np.array(amplitudes)
+
+    likelihood = np.zeros(len(amplitudes))
+    release_prob = stats.binom(available_vesicles, release_probability)
+
+    n_vesicles = np.arange(available_vesicles + 1)
+
+    # probability of releasing n_vesicles given available_vesicles and release_probability
+    p_n = release_prob.pmf(n_vesicles)
+
+    # expected amplitude for n_vesicles
+    amp_mean = n_vesicles * mini_amplitude
+
+    # amplitude stdev increases by sqrt(n) with number of released vesicles
+    amp_stdev = (mini_amplitude_stdev**2 * n_vesicles + measurement_stdev**2) ** 0.5
+
+    # distributions of amplitudes expected for n_vesicles
+    amp_prob = p_n[None, :] * normal_pdf(amp_mean[None, :], amp_stdev[None, :], amplitudes[:, None])
+
+    # sum all distributions across n_vesicles
+    likelihood = amp_prob.sum(axis=1)
+
+    return likelihood
+
+
+def normal_pdf(mu, sigma, x):
+    """Probability density function of normal distribution
+    """
+    return (1.0 / (2 * np.pi * sigma**2))**0.5 * np.exp(- (x-mu)**2 / (2 * sigma**2))
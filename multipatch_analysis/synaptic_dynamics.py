@@ -1,11 +1,9 @@
 import sys
 from collections import OrderedDict
 import numpy as np
-import pyqtgraph as pg
 from .connection_detection import MultiPatchSyncRecAnalyzer, EvokedResponseGroup, fit_psp
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.baseline import float_mode
-from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.fitting import PspTrain
 from neuroanalysis.synaptic_release import ReleaseModel
 from neuroanalysis.event_detection import exp_deconvolve
@@ -175,6 +173,9 @@ class RawDynamicsAnalyzer(object):
 
         Return a new PlotGrid.
         """
+        import pyqtgraph as pg
+        from neuroanalysis.ui.plot_grid import PlotGrid
+
         train_responses = self.train_responses
 
         if plot_grid is None:
@@ -252,6 +253,7 @@ class RawDynamicsAnalyzer(object):
         # Generate average first response
         avg_amp = amp_group.bsub_mean()
         if plot:
+            import pyqtgraph as pg
             amp_plot = pg.plot(title='First pulse amplitude')
             amp_plot.plot(avg_amp.time_values, avg_amp.data)
 
@@ -279,6 +281,7 @@ class RawDynamicsAnalyzer(object):
         avg_kinetic.t0 = 0
         
         if plot:
+            import pyqtgraph as pg
             kin_plot = pg.plot(title='Kinetics')
             kin_plot.plot(avg_kinetic.time_values, avg_kinetic.data)
         else:
@@ -491,6 +494,7 @@ class RawDynamicsAnalyzer(object):
             model, fit = self._last_model_fit
         spike_sets = self.spike_sets
         
+        from neuroanalysis.ui.plot_grid import PlotGrid
         rel_plots = PlotGrid()
         rel_plots.set_shape(2, 1)
         ind_plot = rel_plots[0, 0]
@@ -1,7 +1,25 @@
-import os, sys, glob
+"""
+Local cache of files from the synphys raw data repository.
+
+Files are copied from config.synphys_data into config.cache_path the first time they are
+requested (when config.grow_cache is enabled). A manifest of cached files is kept in an SQLite
+file inside the cache, so that cache hits never need to touch the network share, and so that
+several processes (for example, database import workers) can share one cache. Files can be
+downloaded ahead of time in background threads with prefetch(), and the least recently used
+files are removed whenever the cache grows beyond config.cache_size_limit bytes.
+
+"""
+from __future__ import print_function
+
+import os, sys, glob, time, socket, sqlite3, threading
 from collections import OrderedDict
-import config
-from .util import sync_file
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import config
+from .util import chunk_copy
 
 
 _cache = None
@@ -14,15 +32,68 @@ def get_cache():
 
 class SynPhysCache(object):
     """Maintains a local cache of files from the synphys raw data repository.
+
+    Parameters
+    ----------
+    local_path : str | None
+        Location of the cache (default is config.cache_path). If None, files are always read
+        from the remote path.
+    remote_path : str | None
+        Location of the raw data repository (default is config.synphys_data).
+    max_size : float | None
+        Maximum total size of cached files in bytes (default is config.cache_size_limit; None
+        for unlimited). Least recently used files are removed to stay under this limit.
+    grow : bool | None
+        Whether files that are not yet cached should be copied into the cache (default is
+        config.grow_cache).
+    prefetch_workers : int
+        Number of background threads used to download files requested with prefetch().
+    prefetch_limit : int
+        Prefetching pauses while this many prefetched files are waiting to be used.
+    prefetch_expire : float
+        Prefetched files that have not been used after this many seconds no longer count
+        toward *prefetch_limit*.
     """
-    def __init__(self, local_path=config.cache_path, remote_path=config.synphys_data):
+    def __init__(self, local_path=None, remote_path=None, max_size=None, grow=None, prefetch_workers=2, prefetch_limit=20, prefetch_expire=1800):
+        if local_path is None:
+            local_path = config.cache_path
+        if remote_path is None:
+            remote_path = config.synphys_data
+        if max_size is None:
+            max_size = config.cache_size_limit
+        if grow is None:
+            grow = config.grow_cache
+
         # If a relative path is given, then interpret it as relative to home
-        if not os.path.isabs(local_path):
+        if local_path is not None and not os.path.isabs(local_path):
             local_path = os.path.join(os.path.dirname(__file__), '..', local_path)
 
         self.local_path = None if local_path is None else os.path.abspath(local_path)
         self.remote_path = os.path.abspath(remote_path)
-        
+        self.max_size = max_size
+        self.grow = grow
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_limit = prefetch_limit
+        self.prefetch_expire = prefetch_expire
+
+        self._manifest = None
+        self._manifest_pid = None
+        self._prefetch_queue = queue.Queue()
+        self._prefetch_threads = []
+        self._prefetched = []
+        self._lock = threading.Lock()
+
+    @property
+    def manifest(self):
+        if self.local_path is None:
+            return None
+        # sqlite connections must not be shared with forked child processes
+        if self._manifest is None or self._manifest_pid != os.getpid():
+            self._mkdir(self.local_path)
+            self._manifest = CacheManifest(os.path.join(self.local_path, 'cache_manifest.sqlite'))
+            self._manifest_pid = os.getpid()
+        return self._manifest
+
     def list_experiments(self):
         yamls = self.list_pip_yamls()
         site_dirs = sorted([os.path.dirname(yml) for yml in yamls], reverse=True)
@@ -35,29 +106,212 @@ class SynPhysCache(object):
     def list_pip_yamls(self):
         return glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', 'pipettes.yml'))
 
-    def get_cache(self, filename):
+    def get_cache(self, filename, check_remote=False):
+        """Return the local path to a cached copy of *filename*, downloading it first if needed.
+
+        Files already listed in the manifest are returned without accessing the remote copy,
+        unless *check_remote* is True, in which case the file is downloaded again if the remote
+        copy has changed. If the file is not cached and the cache is not allowed to grow, the
+        remote path is returned.
+        """
         if self.local_path is None:
             return os.path.join(self.remote_path, filename)
-        
-        filename = os.path.abspath(filename)
-        if not filename.startswith(self.remote_path):
-            raise Exception("Requested file %s is not inside %s" % (filename, self.remote_path))
 
-        rel_filename = filename[len(self.remote_path):].lstrip(os.sep)
-        path, _ = os.path.split(rel_filename)
-        
-        local_path = os.path.join(self.local_path, path)
+        rel_filename = self._rel_filename(filename)
         local_filename = os.path.join(self.local_path, rel_filename)
-        
-        if config.grow_cache:
-            self._mkdir(local_path)
-            sync_file(filename, local_filename)        
-        
+
+        rec = self.manifest.get(rel_filename)
+        if rec is None and self._adopt(rel_filename):
+            rec = self.manifest.get(rel_filename)
+        if rec is not None and os.path.isfile(local_filename):
+            if not check_remote or not self._is_stale(rel_filename, rec):
+                self.manifest.touch(rel_filename)
+                return local_filename
+
+        if self.grow:
+            self._download(rel_filename, force=rec is not None)
+            self.manifest.touch(rel_filename)
+            self.evict()
+
         if os.path.exists(local_filename):
             return local_filename
         else:
-            return filename
-        
+            return os.path.join(self.remote_path, rel_filename)
+
+    def prefetch(self, filenames):
+        """Download *filenames* into the cache in background threads, in the order given.
+
+        Use this to hint which files will be needed soon (for example, the NWB files of
+        experiments waiting to be imported). Files that are already cached are skipped.
+        Background threads exit once the queue is empty and are restarted by the next call.
+        """
+        if self.local_path is None or not self.grow:
+            return
+        for filename in filenames:
+            self._prefetch_queue.put(self._rel_filename(filename))
+        with self._lock:
+            while len(self._prefetch_threads) < self.prefetch_workers:
+                thread = threading.Thread(target=self._prefetch_loop)
+                thread.daemon = True
+                thread.start()
+                self._prefetch_threads.append(thread)
+
+    def stop_prefetch(self):
+        """Discard any files waiting to be prefetched and stop the background threads.
+        """
+        with self._lock:
+            threads = self._prefetch_threads
+            self._prefetch_threads = []
+            try:
+                while True:
+                    self._prefetch_queue.get(block=False)
+                    self._prefetch_queue.task_done()
+            except queue.Empty:
+                pass
+        for thread in threads:
+            thread.join()
+
+    def wait_for_prefetch(self):
+        """Block until all files requested with prefetch() have been downloaded.
+        """
+        self._prefetch_queue.join()
+
+    def _prefetch_loop(self):
+        thread = threading.current_thread()
+        while True:
+            # checking the queue while holding the lock guarantees that prefetch() starts a
+            # new thread if files are added after this one exits
+            with self._lock:
+                if thread not in self._prefetch_threads:
+                    return
+                try:
+                    rel_filename = self._prefetch_queue.get(block=False)
+                except queue.Empty:
+                    self._prefetch_threads.remove(thread)
+                    return
+            try:
+                # don't run too far ahead of the files actually being used
+                while self._n_waiting() >= self.prefetch_limit:
+                    if thread not in self._prefetch_threads:
+                        return
+                    time.sleep(1)
+                if self.manifest.get(rel_filename) is None and not self._adopt(rel_filename):
+                    self._download(rel_filename)
+                    with self._lock:
+                        self._prefetched.append((rel_filename, time.time()))
+                    self.evict()
+            except Exception:
+                print("Error prefetching %s:" % rel_filename)
+                sys.excepthook(*sys.exc_info())
+            finally:
+                self._prefetch_queue.task_done()
+
+    def _n_waiting(self):
+        """Return the number of prefetched files that have not been requested yet.
+
+        Files that were prefetched more than *prefetch_expire* seconds ago are assumed to be
+        unwanted and are no longer counted.
+        """
+        now = time.time()
+        with self._lock:
+            entries = self._prefetched[:]
+        waiting = []
+        for entry in entries:
+            path, prefetch_time = entry
+            if now - prefetch_time > self.prefetch_expire:
+                continue
+            rec = self.manifest.get(path)
+            if rec is not None and rec['n_access'] == 0:
+                waiting.append(entry)
+        with self._lock:
+            self._prefetched = [e for e in self._prefetched if e in waiting or e not in entries]
+        return len(waiting)
+
+    def cache_size(self):
+        """Return the total size in bytes of all files in the cache.
+        """
+        return self.manifest.total_size()
+
+    def evict(self):
+        """Remove least recently used files until the cache is no larger than max_size.
+        """
+        if self.max_size is None:
+            return
+        excess = self.manifest.total_size() - self.max_size
+        if excess <= 0:
+            return
+        for rel_filename, size in self.manifest.lru():
+            local_filename = os.path.join(self.local_path, rel_filename)
+            if os.path.isfile(local_filename):
+                try:
+                    os.remove(local_filename)
+                except OSError:
+                    # file may be open in another process (windows); try again next time
+                    continue
+            self.manifest.remove(rel_filename)
+            excess -= size
+            if excess <= 0:
+                break
+
+    def _rel_filename(self, filename):
+        filename = os.path.abspath(filename)
+        if not filename.startswith(self.remote_path):
+            raise Exception("Requested file %s is not inside %s" % (filename, self.remote_path))
+        return filename[len(self.remote_path):].lstrip(os.sep)
+
+    def _is_stale(self, rel_filename, rec):
+        stat = os.stat(os.path.join(self.remote_path, rel_filename))
+        return stat.st_mtime > rec['remote_mtime'] or stat.st_size != rec['size']
+
+    def _adopt(self, rel_filename):
+        """Add a file that is in the cache folder but not in the manifest (for example, one
+        cached before the manifest existed) if it is up to date with the remote copy, using the
+        same rule as util.sync_file.
+
+        Return True if the file was added to the manifest.
+        """
+        local_filename = os.path.join(self.local_path, rel_filename)
+        if not os.path.isfile(local_filename):
+            return False
+        try:
+            remote_stat = os.stat(os.path.join(self.remote_path, rel_filename))
+        except OSError:
+            return False
+        local_stat = os.stat(local_filename)
+        if local_stat.st_mtime < remote_stat.st_mtime or local_stat.st_size != remote_stat.st_size:
+            return False
+        self.manifest.add(rel_filename, remote_stat.st_size, remote_stat.st_mtime)
+        return True
+
+    def _download(self, rel_filename, force=False):
+        """Copy one file into the cache and add it to the manifest.
+
+        If another thread or process is already downloading the same file, wait for it to finish
+        instead (unless it appears to have stalled).
+        """
+        remote_filename = os.path.join(self.remote_path, rel_filename)
+        local_filename = os.path.join(self.local_path, rel_filename)
+        while not self.manifest.claim(rel_filename):
+            time.sleep(0.5)
+            if not force and self.manifest.get(rel_filename) is not None:
+                return
+        try:
+            if not force and self.manifest.get(rel_filename) is not None and os.path.isfile(local_filename):
+                return
+            self._mkdir(os.path.dirname(local_filename))
+            stat = os.stat(remote_filename)
+            # use a unique temporary name so that concurrent downloads can never collide
+            tmp_filename = local_filename + '.%s-%d-%d.partial' % (socket.gethostname(), os.getpid(), threading.current_thread().ident)
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            chunk_copy(remote_filename, tmp_filename)
+            if os.path.exists(local_filename):
+                os.remove(local_filename)
+            os.rename(tmp_filename, local_filename)
+            self.manifest.add(rel_filename, stat.st_size, stat.st_mtime)
+        finally:
+            self.manifest.release(rel_filename)
+
     def _mkdir(self, path):
         if not os.path.isdir(path):
             root, _ = os.path.split(path)
@@ -66,6 +320,79 @@ class SynPhysCache(object):
             os.mkdir(path)
 
 
+class CacheManifest(object):
+    """Record of the files held in a SynPhysCache, stored in an SQLite file.
+
+    Tracks the size, remote modification time, and access history of every cached file, as well
+    as which files are currently being downloaded. Safe to use from multiple threads and processes.
+    """
+    def __init__(self, filename, claim_timeout=3600):
+        self.filename = filename
+        self.claim_timeout = claim_timeout
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._db.executescript("""
+                create table if not exists files (
+                    path text primary key, size integer, remote_mtime real,
+                    last_access real, n_access integer
+                );
+                create table if not exists downloads (
+                    path text primary key, owner text, time real
+                );
+            """)
+            self._db.commit()
+
+    def _execute(self, query, args=()):
+        with self._lock:
+            cur = self._db.execute(query, args)
+            rows = cur.fetchall()
+            self._db.commit()
+        return rows
+
+    def get(self, path):
+        rows = self._execute("select size, remote_mtime, last_access, n_access from files where path=?", (path,))
+        if len(rows) == 0:
+            return None
+        return dict(zip(['size', 'remote_mtime', 'last_access', 'n_access'], rows[0]))
+
+    def add(self, path, size, remote_mtime):
+        self._execute("insert or replace into files (path, size, remote_mtime, last_access, n_access) values (?, ?, ?, ?, 0)",
+                      (path, size, remote_mtime, time.time()))
+
+    def touch(self, path):
+        self._execute("update files set last_access=?, n_access=n_access+1 where path=?", (time.time(), path))
+
+    def remove(self, path):
+        self._execute("delete from files where path=?", (path,))
+
+    def total_size(self):
+        return self._execute("select coalesce(sum(size), 0) from files")[0][0]
+
+    def lru(self):
+        """Return (path, size) for all files, least recently accessed first.
+        """
+        return self._execute("select path, size from files order by last_access asc")
+
+    def claim(self, path):
+        """Mark *path* as being downloaded by this process.
+
+        Returns False if another download of the same file is already in progress. Claims older
+        than *claim_timeout* seconds are assumed to be abandoned and are taken over.
+        """
+        owner = '%s:%d:%d' % (socket.gethostname(), os.getpid(), threading.current_thread().ident)
+        now = time.time()
+        with self._lock:
+            self._db.execute("delete from downloads where path=? and time<?", (path, now - self.claim_timeout))
+            cur = self._db.execute("insert or ignore into downloads (path, owner, time) values (?, ?, ?)", (path, owner, now))
+            claimed = cur.rowcount == 1
+            self._db.commit()
+        return claimed
+
+    def release(self, path):
+        self._execute("delete from downloads where path=?", (path,))
+
+
 def dir_timestamp(path):
     """Get the timestamp from an index file.
 
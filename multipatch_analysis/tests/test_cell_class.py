@@ -0,0 +1,106 @@
+import itertools
+import numpy as np
+from multipatch_analysis.cell_class import CellClass, classify_cells, classify_pairs
+
+
+class Morpho(object):
+    def __init__(self, pyramidal):
+        self.pyramidal = pyramidal
+
+
+class Cell(object):
+    def __init__(self, cre_type, target_layer, pyramidal):
+        self.cre_type = cre_type
+        self.target_layer = target_layer
+        self.morphology = Morpho(pyramidal)
+
+
+class Pair(object):
+    def __init__(self, pre_cell, post_cell):
+        self.pre_cell = pre_cell
+        self.post_cell = post_cell
+
+
+def test_classify():
+    cells = [
+        Cell('sst', '2/3', False),
+        Cell('pvalb', '2/3', False),
+        Cell('unknown', '2/3', True),
+        Cell('sst', '5', None),
+        Cell('tlx3', '5', True),
+    ]
+    pairs = [Pair(a, b) for a, b in itertools.permutations(cells, 2)]
+    cell_classes = [
+        CellClass(cre_type='sst'),
+        CellClass(cre_type='sst', target_layer='2/3'),
+        CellClass(pyramidal=True),
+        CellClass(target_layer='5'),
+    ]
+
+    cell_groups = classify_cells(cell_classes, pairs=pairs)
+    assert list(cell_groups.keys()) == cell_classes
+    for cell_class, group in cell_groups.items():
+        assert group == set([c for c in cells if c in cell_class])
+
+    # pair buckets must match a brute-force scan over every class combination
+    pair_groups = classify_pairs(pairs, cell_groups)
+    assert list(pair_groups.keys()) == list(itertools.product(cell_classes, cell_classes))
+    for (pre_class, post_class), class_pairs in pair_groups.items():
+        expected = [p for p in pairs if p.pre_cell in cell_groups[pre_class] and p.post_cell in cell_groups[post_class]]
+        assert class_pairs == expected
+
+
+def test_classify_sql():
+    # the cell and morphology tables are created in an in-memory sqlite database;
+    # postgres JSONB columns are stored as text
+    import sqlalchemy
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.ext.compiler import compiles
+    from sqlalchemy.dialects.postgresql import JSONB
+    from multipatch_analysis.database import database as db
+    from multipatch_analysis.morphology import Morphology
+    from multipatch_analysis.cell_class import classify_cell_ids, cell_columns, class_membership
+
+    compiles(JSONB, 'sqlite')(lambda element, compiler, **kw: 'TEXT')
+    engine = sqlalchemy.create_engine('sqlite://')
+    for table in [db.Cell.__table__, Morphology.__table__]:
+        table.create(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    cell_params = [
+        ('sst', '2/3', False),
+        ('pvalb', '2/3', False),
+        ('unknown', '2/3', True),
+        ('sst', '5', None),
+        ('tlx3', '5', True),
+        ('tlx3', None, True),
+        ('pvalb', '5', False),
+    ]
+    for cre_type, target_layer, pyramidal in cell_params:
+        cell = db.Cell(cre_type=cre_type, target_layer=target_layer)
+        session.add(Morphology(cell=cell, pyramidal=pyramidal))
+    session.commit()
+
+    cell_classes = [
+        CellClass(cre_type='sst'),
+        CellClass(cre_type='sst', target_layer='2/3'),
+        CellClass(pyramidal=True),
+        CellClass(pyramidal=False, target_layer='2/3'),
+        CellClass(target_layer=None),
+        CellClass(cre_type='pvalb'),
+        CellClass(),
+    ]
+
+    # membership computed by the database must match CellClass.match on the same cells
+    cells = session.query(db.Cell).order_by(db.Cell.id).all()
+    columns = cell_columns(cells, ['cre_type', 'target_layer', 'pyramidal'])
+    membership = class_membership(cell_classes, columns, len(cells))
+    cell_ids = classify_cell_ids(cell_classes, session)
+    assert list(cell_ids.keys()) == cell_classes
+    for j, cell_class in enumerate(cell_classes):
+        expected = [cells[i].id for i in np.flatnonzero(membership[:, j])]
+        assert sorted(cell_ids[cell_class]) == expected, cell_class
+
+    # classify_cells(session=...) returns the same groups of Cell instances as classify_cells(cells=...)
+    cell_groups = classify_cells(cell_classes, session=session)
+    assert cell_groups == classify_cells(cell_classes, cells=cells)
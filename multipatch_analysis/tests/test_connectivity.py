@@ -0,0 +1,84 @@
+import datetime, itertools
+from collections import OrderedDict
+from multipatch_analysis.cell_class import CellClass
+from multipatch_analysis import connectivity
+from multipatch_analysis.connectivity import MatrixCache
+
+
+class Cell(object):
+    def __init__(self, cre_type, target_layer):
+        self.cre_type = cre_type
+        self.target_layer = target_layer
+
+
+class Pair(object):
+    def __init__(self, pre_cell, post_cell):
+        self.pre_cell = pre_cell
+        self.post_cell = post_cell
+
+
+class Session(object):
+    n_expired = 0
+    def expire_all(self):
+        self.n_expired += 1
+
+
+class Query(object):
+    def __init__(self, pairs):
+        self.pairs = pairs
+    def all(self):
+        return list(self.pairs)
+
+
+def test_matrix_cache(monkeypatch):
+    cells = [Cell('sst', '2/3'), Cell('pvalb', '2/3'), Cell('tlx3', '5')]
+    pairs = [Pair(a, b) for a, b in itertools.permutations(cells, 2)]
+    queries = []
+    def query_pairs(session=None, **filters):
+        queries.append(filters)
+        return Query(pairs)
+    monkeypatch.setattr(connectivity, 'query_pairs', query_pairs)
+
+    # (pair count, max pair id, pair created, pair modified, strength count, max strength id, ...)
+    created = datetime.datetime(2018, 1, 1)
+    version = [(6, 6, created, None, 6, 6, created, None)]
+    monkeypatch.setattr(connectivity, 'data_version', lambda session: version[0])
+
+    analyzed = []
+    def analysis_func(pair_groups):
+        analyzed.append(list(pair_groups.keys()))
+        return OrderedDict([(k, len(v)) for k, v in pair_groups.items()])
+
+    session = Session()
+    cache = MatrixCache(analysis_func)
+    sst, pv = CellClass(cre_type='sst'), CellClass(cre_type='pvalb')
+    filters = {'project_name': ('mouse V1 coarse matrix',)}
+
+    cell_groups, results = cache.get_results([sst, pv], filters, session)
+    assert cell_groups[sst] == set([cells[0]])
+    assert list(results.values()) == [0, 1, 1, 0]
+    assert len(queries) == 1 and len(analyzed) == 1
+
+    # unchanged filters and data are served from the cache
+    cache.get_results([sst, pv], filters, session)
+    assert len(queries) == 1 and len(analyzed) == 1
+
+    # a new class only requires analyzing the elements that involve it
+    l5 = CellClass(target_layer='5')
+    cell_groups, results = cache.get_results([sst, pv, l5], filters, session)
+    assert len(queries) == 1
+    assert len(analyzed[-1]) == 5
+    assert results[(l5, sst)] == 1
+
+    # rebuilding connection_strength restarts its ids, so counts and max ids can be unchanged;
+    # the creation time of the new rows must still invalidate the cache
+    rebuilt = created + datetime.timedelta(days=1)
+    version[0] = (6, 6, created, None, 6, 6, rebuilt, None)
+    cache.get_results([sst, pv, l5], filters, session)
+    assert len(queries) == 2
+    assert session.n_expired == 2
+    assert len(analyzed[-1]) == 9
+
+    # so do filter changes
+    cache.get_results([sst, pv, l5], {'project_name': ('human coarse matrix',)}, session)
+    assert len(queries) == 3
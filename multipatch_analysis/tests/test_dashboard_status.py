@@ -0,0 +1,84 @@
+import os, sys, time
+from multipatch_analysis.dashboard_status import DashboardStatusStore, site_signature, record_complete, pass_color, fail_color
+
+
+def test_site_signature(tmpdir):
+    site_path = os.path.join(str(tmpdir), '2018.01.01_000', 'slice_000', 'site_000')
+    os.makedirs(site_path)
+    for path in [site_path, os.path.dirname(site_path), os.path.dirname(os.path.dirname(site_path))]:
+        open(os.path.join(path, '.index'), 'w').write('.: {}\n')
+    sig = site_signature(site_path)
+    assert sig[2] is None
+    assert site_signature(site_path) == sig
+
+    # new files in the site folder change the signature
+    open(os.path.join(site_path, 'pipettes.yml'), 'w').write('{}')
+    os.utime(site_path, (time.time() + 10,) * 2)
+    sig2 = site_signature(site_path)
+    assert sig2[2] is not None
+    assert sig2 != sig
+
+
+def test_status_store(tmpdir):
+    filename = os.path.join(str(tmpdir), 'status.sqlite')
+    store = DashboardStatusStore(filename)
+    assert store.site('/data/site_000') is None
+    store.set_site('/data/site_000', [1.0, None, 3.0], 1500000000.123)
+    assert store.site('/data/site_000') == ([1.0, None, 3.0], 1500000000.123)
+
+    try:
+        raise ValueError("LIMS unavailable")
+    except ValueError:
+        err = sys.exc_info()
+    rec = {'experiment': object(), 'item': object(), 'timestamp': '1500000000.123', 'rig': 'mp1',
+           'description': ('no LIMS spec info', (255, 200, 200)), 'DB': True, 'error': err}
+    assert store.last_check(1500000000.123) is None
+    store.save_record(1500000000.123, '/data/site_000', rec)
+    assert time.time() - store.last_check(1500000000.123)[0] < 10
+
+    # records survive reopening the store; live objects are dropped and errors are formatted
+    store = DashboardStatusStore(filename)
+    records = store.records()
+    assert len(records) == 1
+    ts, site_path, saved, checked = records[0]
+    assert ts == 1500000000.123
+    assert site_path == '/data/site_000'
+    assert 'experiment' not in saved and 'item' not in saved
+    assert saved['description'] == rec['description']
+    assert 'LIMS unavailable' in saved['error']
+
+
+def complete_record():
+    return {'timestamp': '1500000000.123', 'error': None, 'primary': '-', 'archive': True, 'NAS': True,
+            'backup': True, 'description': 'sim1', 'submitted': True, 'data': True, '20x': True,
+            'connections': (2, pass_color), 'site.mosaic': True, 'DB': True, 'LIMS': True,
+            '63x': '-', 'cell map': '-'}
+
+
+def test_record_complete():
+    assert record_complete(complete_record())
+
+    # any failing, unchecked, or errored stage makes the record incomplete
+    for field, val in [('DB', False), ('NAS', 'MISSING'), ('LIMS', 'FAILED'), ('connections', False),
+                       ('description', ('no LIMS spec info', fail_color)),
+                       ('cell map', ('Incomplete', (255, 255, 102))), ('error', 'Traceback...')]:
+        rec = complete_record()
+        rec[field] = val
+        assert not record_complete(rec), field
+    rec = complete_record()
+    del rec['DB']
+    assert not record_complete(rec)
+
+
+def test_last_check(tmpdir):
+    store = DashboardStatusStore(os.path.join(str(tmpdir), 'status.sqlite'))
+    assert store.last_check(1500000000.123) is None
+    store.save_record(1500000000.123, '/data/site_001', complete_record())
+    checked, complete = store.last_check(1500000000.123)
+    assert complete is True
+    assert time.time() - checked < 10
+
+    rec = complete_record()
+    rec['DB'] = False
+    store.save_record(1500000000.123, '/data/site_001', rec)
+    assert store.last_check(1500000000.123)[1] is False
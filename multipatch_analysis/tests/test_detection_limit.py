@@ -0,0 +1,107 @@
+import numpy as np
+import scipy.stats
+from neuroanalysis.fitting import Psp
+from multipatch_analysis.database import database as db
+from multipatch_analysis.pulse_response_strength import analyze_response_strength
+from multipatch_analysis import detection_limit
+
+
+class Record(object):
+    """Stands in for a background record returned by baseline_query().
+    """
+    def __init__(self, data):
+        self.data = data
+        self.clamp_mode = 'ic'
+        self.ex_qc_pass = True
+        self.in_qc_pass = True
+
+
+class Classifier(object):
+    def predict(self, recs):
+        return np.zeros(len(recs), dtype=[('prediction', float), ('confidence', float)])
+
+
+def simulate_response(fg_recs, amp, rtime, seed):
+    """Per-record simulation: add a randomly scaled and delayed PSP to each record and run the
+    full response strength analysis on the result.
+    """
+    rng = np.random.RandomState(seed)
+    sample_rate = db.default_sample_rate
+    t = np.arange(0, 15e-3, 1.0 / sample_rate)
+    template = Psp.psp_func(t, xoffset=0, yoffset=0, rise_time=rtime, decay_tau=15e-3, amp=1, rise_power=2)
+
+    n = len(fg_recs)
+    r_amps = scipy.stats.binom.rvs(p=0.2, n=24, size=n, random_state=rng) * scipy.stats.norm.rvs(scale=0.3, loc=1, size=n, random_state=rng)
+    r_amps *= amp / r_amps.mean()
+    r_latency = rng.normal(size=n, scale=200e-6, loc=13e-3)
+    results = []
+    for k, rec in enumerate(fg_recs):
+        data = rec.data.copy()
+        start = int(r_latency[k] * sample_rate)
+        length = len(data) - start
+        data[start:] += template[:length] * r_amps[k]
+        result = analyze_response_strength(Record(data), 'baseline')
+        result['data'] = data
+        results.append(result)
+    return results
+
+
+def test_simulate_detection_parity(monkeypatch):
+    sample_rate = db.default_sample_rate
+    rng = np.random.RandomState(0)
+    fg_recs = [Record(rng.normal(size=int(25e-3 * sample_rate), scale=100e-6) - 65e-3) for i in range(5)]
+    amps = [0, 200e-6, 1e-3]
+    rtime = 1e-3
+    n_trials = 3
+
+    # capture the simulated records passed to the connectivity analysis
+    fg_tables = []
+    def analyze_pair_connectivity(amps, sign):
+        fg_tables.append(amps[('ic', 'fg')].copy())
+        return {}
+    monkeypatch.setattr(detection_limit, 'analyze_pair_connectivity', analyze_pair_connectivity)
+
+    results = detection_limit.simulate_detection(fg_recs, None, Classifier(), amps, rtime, n_trials=n_trials)
+    assert [r['amp'] for r in results] == amps
+    assert len(fg_tables) == len(amps) * n_trials
+
+    # simulated amplitudes agree with the per-record analysis to within 1% of the largest
+    # amplitude; latencies are compared in samples and may differ where two samples in the
+    # response window are nearly equal
+    atol = 0.01 * max(amps)
+    latency_match = []
+    for a, amp in enumerate(amps):
+        for i in range(n_trials):
+            table = fg_tables[a * n_trials + i]
+            expected = simulate_response(fg_recs, amp, rtime, seed=i)
+            for j, exp in enumerate(expected):
+                assert np.allclose(table['data'][j], exp['data'])
+                assert np.isclose(table['crosstalk'][j], exp['crosstalk'], atol=1e-9)
+                for key in ['pos_amp', 'neg_amp', 'pos_dec_amp', 'neg_dec_amp']:
+                    assert abs(table[key][j] - exp[key]) <= atol, (amp, i, j, key)
+                for key in ['pos_dec_latency', 'neg_dec_latency']:
+                    latency_match.append(abs(table[key][j] - exp[key]) <= 1.5 / sample_rate)
+    assert np.mean(latency_match) >= 0.95
+
+
+def test_simulate_detection_threshold(monkeypatch):
+    sample_rate = db.default_sample_rate
+    rng = np.random.RandomState(0)
+    fg_recs = [Record(rng.normal(size=int(25e-3 * sample_rate), scale=100e-6)) for i in range(3)]
+    monkeypatch.setattr(detection_limit, 'analyze_pair_connectivity', lambda amps, sign: {})
+
+    class ThresholdClassifier(object):
+        # confidence increases with each amplitude that is simulated
+        n_calls = 0
+        def predict(self, recs):
+            self.n_calls += 1
+            pred = np.zeros(len(recs), dtype=[('prediction', float), ('confidence', float)])
+            pred['confidence'] = 0.3 * self.n_calls
+            return pred
+
+    classifier = ThresholdClassifier()
+    results = detection_limit.simulate_detection(fg_recs, None, classifier, [0, 1e-4, 2e-4, 4e-4, 8e-4], 1e-3, n_trials=2, threshold=0.5)
+
+    # simulation stops after the first amplitude whose confidence crosses the threshold
+    assert [r['amp'] for r in results] == [0, 1e-4]
+    assert classifier.n_calls == 2
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import numpy as np
+from neuroanalysis.data import Trace
+from multipatch_analysis.synaptic_dynamics import RawDynamicsAnalyzer
+from multipatch_analysis.dynamics import analyze_pair_dynamics
+
+
+dt = 1e-4
+stim_params = (50., 250e-3, -70e-3)
+ind_offsets = [i * 20e-3 for i in range(8)]
+rec_offsets = [ind_offsets[-1] + 250e-3 + i * 20e-3 for i in range(4)]
+ind_amps = np.array([1.0, 0.8, 0.6, 0.5, 0.45, 0.4, 0.4, 0.4]) * 1e-3
+rec_amps = np.array([0.9, 0.7, 0.6, 0.5]) * 1e-3
+
+
+class SyntheticDynamicsAnalyzer(RawDynamicsAnalyzer):
+    """Uses precomputed deconvolved trains instead of averaging recorded train responses, and
+    records the arguments passed to measure_train_amps_from_deconv.
+    """
+    def __init__(self, train_responses, pulse_offsets):
+        self.synthetic_deconv = OrderedDict()
+        self.amp_sign_args = []
+        RawDynamicsAnalyzer.__init__(self, OrderedDict(), train_responses, pulse_offsets, method='deconv')
+
+    def _get_deconvolved_trains(self):
+        self._deconvolved_trains = self.synthetic_deconv
+
+    def measure_train_amps_from_deconv(self, amp_sign=None, plot_grid=None):
+        self.amp_sign_args.append(amp_sign)
+        return RawDynamicsAnalyzer.measure_train_amps_from_deconv(self, amp_sign=amp_sign, plot_grid=plot_grid)
+
+
+class Obj(object):
+    def __init__(self, **kwds):
+        self.__dict__.update(kwds)
+
+
+def deconvolved_train(offsets, amps, sign, pre_pad):
+    """Return a trace with a peak 1 ms after each pulse, followed by a smaller peak of the
+    opposite sign that would be picked up if the wrong amp_sign were used.
+    """
+    data = np.zeros(int((pre_pad + offsets[-1] - offsets[0] + 50e-3) / dt))
+    for offset, amp in zip(offsets, amps):
+        i = int(round((pre_pad + offset - offsets[0] + 1e-3) / dt))
+        data[i] = sign * amp
+        data[i + 20] = -sign * amp * 0.5
+    return Trace(data, dt=dt)
+
+
+def synthetic_analyzer(sign):
+    pulse_offsets = {stim_params: ind_offsets + rec_offsets}
+    # only the number of sweeps in each group is used
+    train_responses = {stim_params: ([None] * 5, [None] * 5)}
+    analyzer = SyntheticDynamicsAnalyzer(train_responses, pulse_offsets)
+    analyzer.synthetic_deconv[stim_params] = (
+        deconvolved_train(ind_offsets, ind_amps, sign, analyzer.pre_pad),
+        deconvolved_train(rec_offsets, rec_amps, sign, analyzer.pre_pad),
+    )
+    return analyzer
+
+
+def test_analyze_pair_dynamics():
+    for synapse_type, sign in [('ex', 1), ('in', -1)]:
+        analyzer = synthetic_analyzer(sign)
+        pair = Obj(connection_strength=Obj(synapse_type=synapse_type))
+        records = analyze_pair_dynamics(pair, analyzer=analyzer)
+
+        amp_sign = '+' if sign > 0 else '-'
+        assert analyzer.amp_sign_args == [{'amp_sign': amp_sign}]
+        assert len(records) == 1
+        rec = records[0]
+        assert rec['induction_frequency'] == stim_params[0]
+        assert rec['recovery_delay'] == stim_params[1]
+        assert rec['holding_potential'] == stim_params[2]
+        assert rec['n_sweeps'] == 5
+        assert rec['amp_sign'] == amp_sign
+        assert np.allclose(rec['pulse_offsets'], ind_offsets + rec_offsets)
+        assert np.allclose(rec['induction_amps'], sign * ind_amps)
+        assert np.allclose(rec['recovery_amps'], sign * rec_amps)
+        assert np.isclose(rec['paired_pulse_ratio'], 0.8)
+        assert np.isclose(rec['induction_ratio'], 0.4)
+        assert np.isclose(rec['recovery_ratio'], 0.9)
+
+
+def test_analyze_pair_dynamics_no_trains():
+    analyzer = SyntheticDynamicsAnalyzer({}, {})
+    pair = Obj(connection_strength=Obj(synapse_type='ex'))
+    assert analyze_pair_dynamics(pair, analyzer=analyzer) == []
+    assert analyzer.amp_sign_args == []
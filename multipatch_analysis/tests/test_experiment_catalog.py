@@ -0,0 +1,68 @@
+import os, time, datetime
+from multipatch_analysis import experiment_catalog
+from multipatch_analysis.experiment_catalog import ExperimentCatalog, CatalogExperiment
+
+
+class FakeExperiment(object):
+    """Stands in for Experiment; records how many times sites were parsed.
+    """
+    n_loaded = 0
+
+    def __init__(self, yml_file):
+        FakeExperiment.n_loaded += 1
+        self.source_id = (yml_file, None)
+        self.timestamp = 1500000000 + len(yml_file) + os.path.getmtime(yml_file) % 1000
+        self.uid = '%0.2f' % self.timestamp
+        self.date = datetime.date.fromtimestamp(self.timestamp)
+        self.connections = None
+        self.yml_text = open(yml_file).read()
+
+    @property
+    def connections_probed(self):
+        return 0
+
+
+def make_site(root, name, text):
+    site_path = os.path.join(root, 'expt_' + name, 'slice_000', 'site_000')
+    if not os.path.isdir(site_path):
+        os.makedirs(site_path)
+    yml_file = os.path.join(site_path, 'pipettes.yml')
+    open(yml_file, 'w').write(text)
+    return yml_file
+
+
+def test_catalog(tmpdir, monkeypatch):
+    monkeypatch.setattr(experiment_catalog, 'Experiment', FakeExperiment)
+    data_path = os.path.join(str(tmpdir), 'data')
+    cache_path = os.path.join(str(tmpdir), 'cache')
+    ymls = [make_site(data_path, name, name) for name in 'abc']
+    assert experiment_catalog.find_sites(data_path) == ymls
+
+    catalog = ExperimentCatalog(cache_path)
+    loaded, errs = catalog.update(ymls, workers=1)
+    assert len(loaded) == 3 and errs == []
+    assert FakeExperiment.n_loaded == 3
+
+    # reopening the catalog does not parse or unpickle any experiments
+    catalog = ExperimentCatalog(cache_path)
+    expts = catalog.experiments()
+    assert FakeExperiment.n_loaded == 3
+    assert all([isinstance(ex, CatalogExperiment) and not ex.loaded for ex in expts])
+    assert sorted([ex.source_id[0] for ex in expts]) == ymls
+    assert expts[0].yml_text in 'abc'
+    assert expts[0].loaded
+
+    # only modified sites are reloaded; removed sites are dropped
+    time.sleep(0.01)
+    open(ymls[1], 'w').write('b2')
+    os.utime(ymls[1], (time.time() + 10, time.time() + 10))
+    loaded, errs = catalog.update(ymls[1:], workers=1)
+    assert [rec['source_id'][0] for rec in loaded] == [ymls[1]]
+    assert FakeExperiment.n_loaded == 4
+    assert sorted(catalog.records.keys()) == ymls[1:]
+    assert not os.path.exists(catalog.expt_file(ymls[0]))
+
+    catalog = ExperimentCatalog(cache_path)
+    expts = {ex.source_id[0]: ex for ex in catalog.experiments()}
+    assert expts[ymls[1]].yml_text == 'b2'
+    assert expts[ymls[2]].yml_text == 'c'
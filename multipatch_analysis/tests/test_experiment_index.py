@@ -0,0 +1,108 @@
+import datetime
+import itertools
+import numpy as np
+from multipatch_analysis.experiment_index import ExperimentIndex
+
+
+class Cell(object):
+    def __init__(self, target_layer, cre_type, position):
+        self.target_layer = target_layer
+        self.cre_type = cre_type
+        self.position = position
+
+    def distance(self, cell):
+        if self.position is None or cell.position is None:
+            return np.nan
+        return np.linalg.norm(np.array(self.position) - np.array(cell.position))
+
+
+class Experiment(object):
+    def __init__(self, n, cells, connections, solution, organism, rig, age):
+        self.timestamp = 1500000000.0 + n * 86400
+        self.date = datetime.date.fromtimestamp(self.timestamp)
+        self.source_id = ('expt_%d/pipettes.yml' % n, None)
+        self.region = 'V1'
+        self.cells = cells
+        self.cre_types = sorted(set([c.cre_type for c in cells.values()]))
+        self.target_layers = sorted(set([c.target_layer for c in cells.values()]))
+        self.expt_info = {'solution': solution, 'temperature': '34C'} if solution is not None else {}
+        self.lims_record = {'organism': organism}
+        self.rig_name = rig
+        self.age = age
+        self.connections = connections
+        self.connections_probed = None if connections is None else list(itertools.permutations(cells.keys(), 2))
+
+
+def make_expts():
+    rng = np.random.RandomState(0)
+    types = [('2/3', 'sst'), ('2/3', 'pvalb'), ('5', 'tlx3'), ('5', 'sst')]
+    expts = []
+    for n in range(12):
+        cells = {}
+        for i in range(1, 5):
+            layer, cre = types[rng.randint(len(types))]
+            cells[i] = Cell(layer, cre, None if i == 4 else tuple(rng.uniform(0, 100e-6, size=3)))
+        pairs = list(itertools.permutations(cells.keys(), 2))
+        connections = None if n == 3 else [p for p in pairs if rng.uniform() < 0.3]
+        expts.append(Experiment(n, cells, connections,
+            solution=[None, '2mM Ca', '1.3mM Ca'][n % 3], organism=['mouse', 'human'][n % 2],
+            rig='mp%d' % (n % 4), age=30 + n))
+    return expts
+
+
+def test_select():
+    expts = make_expts()
+    index = ExperimentIndex(expts)
+
+    def check(expected, **kwds):
+        inds = index.select(**kwds)
+        assert [expts[i] for i in inds] == [ex for ex in expts if expected(ex)]
+
+    check(lambda ex: True)
+    check(lambda ex: ex.date >= expts[4].date and ex.date <= expts[8].date, start=expts[4].date, stop=expts[8].date)
+    check(lambda ex: 'tlx3' in ex.cre_types or 'pvalb' in ex.cre_types, cre_type=['tlx3', 'pvalb'])
+    check(lambda ex: '5' in ex.target_layers, target_layer=['5'])
+    check(lambda ex: ex.expt_info.get('solution') == '1.3mM Ca', calcium='Low')
+    check(lambda ex: ex.lims_record['organism'] == 'human' and ex.rig_name == 'mp1', organism='human', rig='mp1')
+    check(lambda ex: 33 <= ex.age <= 36 and 'solution' in ex.expt_info, age='36-33', temp=34)
+    check(lambda ex: False, region='VISp')
+
+
+def test_connectivity():
+    expts = make_expts()
+    index = ExperimentIndex(expts)
+    analyzed = [ex for ex in expts if ex.connections is not None]
+
+    # compare against a brute-force count over every probed pair
+    pre_types = [('2/3', None), (None, 'tlx3')]
+    post_types = [('5', 'sst')]
+    connected, probed = index.count_connections(pre_types, post_types)
+    expected = []
+    for ex in analyzed:
+        for i, j in ex.connections_probed:
+            ci, cj = ex.cells[i], ex.cells[j]
+            pre_ok = any([(l is None or ci.target_layer == l) and (c is None or ci.cre_type == c) for l, c in pre_types])
+            post_ok = any([(l is None or cj.target_layer == l) and (c is None or cj.cre_type == c) for l, c in post_types])
+            if pre_ok and post_ok and np.isfinite(ci.distance(cj)):
+                expected.append(((i, j) in ex.connections, ci.distance(cj)))
+    assert len(expected) > 0
+    assert connected == [e[0] for e in expected]
+    assert np.allclose(probed, [e[1] for e in expected])
+
+    connected, probed = index.count_connections(connection_types=[('sst', 'sst')])
+    n_expected = sum([sum([ex.cells[i].cre_type == ex.cells[j].cre_type == 'sst' and np.isfinite(ex.cells[i].distance(ex.cells[j]))
+                           for i, j in ex.connections_probed]) for ex in analyzed])
+    assert len(connected) == n_expected
+
+    summary = index.connectivity_summary()
+    assert sum([v['connected'] + v['unconnected'] for v in summary.values()]) == sum([len(ex.connections_probed) for ex in analyzed])
+    for k, v in summary.items():
+        assert v['connected'] == len(v['cdist']) == len(v['connected_pairs'])
+        for ts, i, j in v['probed_pairs']:
+            ex = [e for e in analyzed if e.timestamp == ts][0]
+            ci, cj = ex.cells[i], ex.cells[j]
+            assert k == ((ci.target_layer, ci.cre_type), (cj.target_layer, cj.cre_type))
+            assert ((ts, i, j) in v['connected_pairs']) == ((i, j) in ex.connections)
+
+    sst_summary = index.connectivity_summary(cre_type=('sst', 'sst'))
+    assert set(sst_summary.keys()) == set([k for k in summary if k[0][1] == k[1][1] == 'sst'])
@@ -0,0 +1,124 @@
+import os
+import pytest
+from multipatch_analysis import lims, lims_cache
+from multipatch_analysis.lims_cache import LimsCache, LocalLims
+
+
+schema = """
+    create table organisms (id integer primary key, name text);
+    create table ages (id integer primary key, days integer);
+    create table genders (id integer primary key, name text);
+    create table donors (id integer primary key, organism_id integer, age_id integer, gender_id integer,
+                         date_of_birth text, full_genotype text, weight real);
+    create table plane_of_sections (id integer primary key, name text);
+    create table tissue_processings (id integer primary key, section_thickness_um real, instructions text,
+                                     plane_of_section_id integer);
+    create table flipped_specimens (id integer primary key, name text);
+    create table specimens (id integer primary key, name text, donor_id integer, tissue_processing_id integer,
+                            flipped_specimen_id integer, histology_well_name text, carousel_well_name text,
+                            parent_id integer);
+
+    insert into organisms values (1, 'Mus musculus');
+    insert into ages values (1, 45);
+    insert into genders values (1, 'M');
+    insert into donors values (1, 1, 1, 1, '2018-01-01', 'Sst-IRES-Cre/wt;Ai14/wt', 20.0);
+    insert into plane_of_sections values (1, 'coronal');
+    insert into tissue_processings values (1, 350, 'V1', 1);
+    insert into flipped_specimens values (1, 'flipped'), (2, 'not flipped');
+    insert into specimens values (101, 'Sst-IRES-Cre;Ai14-401234.03.01', 1, 1, 1, null, null, 10);
+    insert into specimens values (102, 'Sst-IRES-Cre;Ai14-401234.04.02', 1, 1, 2, null, null, 10);
+"""
+
+
+@pytest.fixture
+def local_lims(tmpdir, monkeypatch):
+    backend = LocalLims()
+    backend.db.executescript(schema)
+    monkeypatch.setattr(lims, 'lims', backend)
+    monkeypatch.setattr(lims_cache.config, 'lims_cache', True)
+    monkeypatch.setattr(lims_cache, '_cache', LimsCache(os.path.join(str(tmpdir), 'lims_cache.sqlite')))
+    return backend
+
+
+def test_specimen_info_cache(local_lims):
+    name1 = 'Sst-IRES-Cre;Ai14-401234.03.01'
+    name2 = 'Sst-IRES-Cre;Ai14-401234.04.02'
+
+    # batch lookup uses one query for all specimens; unknown specimens map to None
+    info = lims.specimen_info_many([name1, ' ' + name2, 'missing-specimen.01.01'])
+    assert local_lims.n_queries == 1
+    assert list(info.keys()) == [name1, name2, 'missing-specimen.01.01']
+    assert info['missing-specimen.01.01'] is None
+    assert info[name1]['organism'] == 'mouse'
+    assert info[name1]['exposed_surface'] == 'anterior'
+    assert info[name2]['exposed_surface'] == 'posterior'
+    assert info[name2]['hemisphere'] == 'right'
+    assert info[name2]['thickness'] == 350e-6
+
+    # individual lookups are served from the cache
+    assert lims.specimen_info(name2) == info[name2]
+    assert lims.specimen_info(specimen_name=name1 + ' ') == info[name1]
+    lims.specimen_info_many([name1, name2])
+    assert local_lims.n_queries == 1
+
+    # invalidated entries are queried again
+    lims.specimen_info.invalidate(name1)
+    assert lims.specimen_info(name1) == info[name1]
+    assert local_lims.n_queries == 2
+
+    # other functions are cached by argument
+    assert lims.specimen_id_from_name(name2) == 102
+    assert lims.specimen_id_from_name(name2) == 102
+    assert sorted(lims.child_specimens(10)) == [101, 102]
+    assert sorted(lims.child_specimens(10)) == [101, 102]
+    assert local_lims.n_queries == 4
+
+    lims.clear_cache()
+    assert lims.specimen_id_from_name(name2) == 102
+    assert local_lims.n_queries == 5
+
+
+def test_cache_ttl(tmpdir):
+    cache = LimsCache(os.path.join(str(tmpdir), 'lims_cache.sqlite'))
+    cache.set('func', 'key', {'a': 1})
+    assert cache.get('func', 'key', ttl=100) == (True, {'a': 1})
+    assert cache.get('func', 'key', ttl=-1) == (False, None)
+    assert cache.get('func', 'other_key', ttl=100) == (False, None)
+
+    # entries persist across connections
+    cache2 = LimsCache(cache.filename)
+    assert cache2.get('func', 'key', ttl=100) == (True, {'a': 1})
+    cache2.invalidate('func')
+    assert cache.get('func', 'key', ttl=100) == (False, None)
+
+
+def test_cache_empty(local_lims):
+    # specimens without cell clusters yet are queried again on the next call
+    local_lims.db.executescript("""
+        create table specimen_types (id integer primary key, name text);
+        create table specimen_types_specimens (specimen_id integer, specimen_type_id integer);
+        insert into specimen_types values (1, 'CellCluster');
+    """)
+    assert lims.cell_cluster_ids(101) == []
+    assert lims.cell_cluster_ids(101) == []
+    assert local_lims.n_queries == 2
+
+    local_lims.db.executescript("""
+        insert into specimens values (201, 'cluster', 1, 1, 1, null, null, 101);
+        insert into specimen_types_specimens values (201, 1);
+    """)
+    assert lims.cell_cluster_ids(101) == [201]
+    assert lims.cell_cluster_ids(101) == [201]
+    assert local_lims.n_queries == 3
+
+
+def test_cache_reconnect_after_fork(tmpdir):
+    cache = LimsCache(os.path.join(str(tmpdir), 'lims_cache.sqlite'))
+    cache.set('func', 'key', 1)
+    db = cache.db
+    assert cache.db is db
+
+    # pretend this is a forked child process
+    cache._pid = -1
+    assert cache.db is not db
+    assert cache.get('func', 'key', ttl=100) == (True, 1)
@@ -0,0 +1,101 @@
+import os
+import numpy as np
+from multipatch_analysis import pair_classifier, config
+from multipatch_analysis.pair_classifier import PairClassifier, feature_matrix
+
+
+def synthetic_records(n=400, n_syn=80, seed=0):
+    """Return records similar to those from query_all_pairs(), where the first *n_syn* pairs
+    are connected and have larger feature values.
+    """
+    features = PairClassifier(use_vc_features=True).features
+    fields = ['id', 'synapse', 'ic_n_samples', 'ic_crosstalk_mean'] + features
+    recs = np.zeros(n, dtype=[(f, float) for f in fields])
+    rng = np.random.RandomState(seed)
+    recs['id'] = np.arange(n)
+    recs['synapse'][:n_syn] = 1
+    recs['ic_n_samples'] = 500
+    recs['ic_crosstalk_mean'] = 10e-6
+    for f in features:
+        recs[f] = rng.normal(size=n) + 3 * recs['synapse']
+    # records that fail QC or have missing features are ignored for training
+    recs['ic_n_samples'][-10:] = 50
+    recs[features[0]][-20:-10] = np.nan
+    return recs
+
+
+def test_feature_matrix():
+    recs = synthetic_records(n=20, n_syn=5)
+    features = ['ic_fit_amp', 'vc_fit_amp', 'ic_latency_mean']
+    x = feature_matrix(recs, features)
+    assert x.shape == (20, 3)
+    assert x.dtype == float
+    np.testing.assert_array_equal(x, np.array([tuple(r) for r in recs[features]], dtype=float))
+    assert feature_matrix(recs[:0], features).shape == (0, 3)
+
+
+def test_save_load(tmpdir, monkeypatch):
+    recs = synthetic_records()
+    clf = PairClassifier(seed=0, use_vc_features=False)
+    clf.data_version = [400, 400]
+    clf.fit(recs)
+
+    filename = os.path.join(str(tmpdir), 'classifier.pkl')
+    clf.save(filename)
+    assert not os.path.exists(filename + '.tmp')
+    clf2 = PairClassifier.load(filename)
+    assert clf2.seed == 0
+    assert clf2.use_vc_features is False
+    assert clf2.features == clf.features
+    assert clf2.data_version == [400, 400]
+    assert clf2.prob_threshold == clf.prob_threshold
+    pred, pred2 = clf.predict(recs), clf2.predict(recs)
+    np.testing.assert_array_equal(pred['prediction'], pred2['prediction'])
+    np.testing.assert_allclose(pred['confidence'], pred2['confidence'])
+
+    # classifiers saved by an incompatible version of the module are not loaded
+    monkeypatch.setattr(pair_classifier, 'classifier_version', pair_classifier.classifier_version + 1)
+    assert PairClassifier.load(filename) is None
+
+
+def test_update_pair_classifier(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'cache_path', os.path.join(str(tmpdir), 'cache'))
+    recs = synthetic_records()
+    monkeypatch.setattr(pair_classifier, 'query_all_pairs', lambda session: recs)
+    version = [[400, 400]]
+    monkeypatch.setattr(pair_classifier, 'data_version', lambda session: version[0])
+
+    trained = []
+    train = pair_classifier.train_pair_classifier
+    def train_pair_classifier(**kwds):
+        clf = train(**kwds)
+        trained.append(clf)
+        return clf
+    monkeypatch.setattr(pair_classifier, 'train_pair_classifier', train_pair_classifier)
+
+    cfg = {'seed': 0, 'use_vc_features': True}
+    update = lambda **kwds: pair_classifier.update_pair_classifier(configs=[cfg], n_jobs=1, session='session', **kwds)
+
+    assert pair_classifier.load_pair_classifier(**cfg) is None
+    update()
+    assert len(trained) == 1
+    assert pair_classifier.load_pair_classifier(**cfg).data_version == [400, 400]
+
+    # up to date; not retrained
+    update()
+    assert len(trained) == 1
+
+    # stale data version triggers retraining
+    version[0] = [401, 401]
+    update()
+    assert len(trained) == 2
+    assert pair_classifier.load_pair_classifier(**cfg).data_version == [401, 401]
+
+    update(rebuild=True)
+    assert len(trained) == 3
+
+    # so does a saved classifier from an older version of the module
+    monkeypatch.setattr(pair_classifier, 'classifier_version', pair_classifier.classifier_version + 1)
+    update()
+    assert len(trained) == 4
+    assert pair_classifier.load_pair_classifier(**cfg) is not None
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from multipatch_analysis.parameter_space import ParameterSpace
+
+
+result_dtype = [('sum', float), ('product', float)]
+
+def evaluate(params):
+    return (params['a'] + params['b'] + params['c'], params['a'] * params['b'] * params['c'])
+
+
+def test_parameter_space(tmpdir):
+    params = {'a': np.arange(7), 'b': np.linspace(0, 1, 13), 'c': 2.0}
+    space = ParameterSpace(params)
+    assert space.shape == (7, 13)
+    assert params['c'] == 2.0  # input dict is not modified
+
+    # in-memory, single process
+    result = space.run(evaluate, result_dtype, workers=1, chunk_size=10)
+    a, b = np.meshgrid(params['a'], params['b'], indexing='ij')
+    assert np.allclose(result['sum'], a + b + 2)
+    assert np.allclose(result['product'], a * b * 2)
+
+    # memory-mapped, multiprocess
+    cache_file = os.path.join(str(tmpdir), 'search.npy')
+    space = ParameterSpace(params)
+    space.run(evaluate, result_dtype, cache_file=cache_file, workers=2, chunk_size=10)
+    assert isinstance(space.result, np.memmap)
+    assert np.all(space.result == result)
+
+    # reload results without re-running
+    loaded, frac_done = ParameterSpace.load(cache_file)
+    assert frac_done == 1.0
+    assert loaded.param_order == space.param_order
+    assert loaded.static_params == {'c': 2.0}
+    assert np.all(loaded.result == result)
+    del loaded
+
+    # resume: clear out some results and mark them incomplete; only those should be recomputed
+    evaluated = np.load(cache_file[:-4] + '_evaluated.npy', mmap_mode='r+')
+    evaluated.reshape(-1)[30:40] = False
+    evaluated.flush()
+    del evaluated
+    space.result.reshape(-1)[30:40] = 0
+    space.result.flush()
+
+    calls = []
+    def counting_evaluate(params):
+        calls.append(params)
+        return evaluate(params)
+    space = ParameterSpace(params)
+    space.run(counting_evaluate, result_dtype, cache_file=cache_file, workers=1, chunk_size=10)
+    assert len(calls) == 10
+    assert np.all(space.result == result)
+
+
+def test_adaptive_search():
+    # smooth, single-peaked score over a 4D grid
+    params = {'a': np.linspace(-1, 1, 21), 'b': np.linspace(-1, 1, 21), 'c': np.linspace(-1, 1, 17), 'd': np.linspace(-1, 1, 9)}
+    peak = {'a': 0.3, 'b': -0.6, 'c': 0.5, 'd': 0.0}
+    dtype = [('score', float)]
+    def score(p):
+        return (-sum([(p[k] - peak[k])**2 for k in peak]),)
+
+    full = ParameterSpace(params)
+    full.run(score, dtype, workers=1)
+    best_full = np.nanmax(full.result['score'])
+
+    space = ParameterSpace(params)
+    space.run_adaptive(score, dtype, 'score', workers=1)
+    assert np.nanmax(space.result['score']) == best_full
+    assert space.n_evaluations == space.evaluated.sum()
+    assert space.n_evaluations < space.result.size // 4
+    assert np.all(np.isnan(space.result['score'][~space.evaluated]))
+    assert np.all(space.result['score'][space.evaluated] == full.result['score'][space.evaluated])
+    # history records best score after each round of evaluation
+    assert space.search_history[-1] == (space.n_evaluations, best_full)
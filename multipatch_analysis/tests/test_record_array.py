@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from multipatch_analysis.record_array import join_struct_arrays
+
+
+def test_join_struct_arrays():
+    a = np.empty(3, dtype=[('id', int), ('name', object), ('vec', float, (2,))])
+    a['id'] = [1, 2, 3]
+    a['name'] = ['sst', None, 'pvalb']
+    a['vec'] = np.arange(6).reshape(3, 2)
+    b = np.empty(3, dtype=[('prediction', float), ('confidence', float)])
+    b['prediction'] = [1, 0, np.nan]
+    b['confidence'] = [0.9, 0.1, np.nan]
+
+    c = join_struct_arrays([a, b])
+    assert c.dtype.names == ('id', 'name', 'vec', 'prediction', 'confidence')
+    assert c.dtype['name'] == object
+    assert list(c['id']) == [1, 2, 3]
+    assert list(c['name']) == ['sst', None, 'pvalb']
+    assert np.all(c['vec'] == a['vec'])
+    assert np.all(c['confidence'][:2] == [0.9, 0.1])
+    assert np.isnan(c['prediction'][2])
+
+    with pytest.raises(ValueError):
+        join_struct_arrays([a, a])
+    with pytest.raises(ValueError):
+        join_struct_arrays([a, b[:2]])
@@ -0,0 +1,47 @@
+import numpy as np
+from multipatch_analysis.stochastic_release import StochasticReleaseModel
+
+
+def reference_likelihood(model, spike_times, amplitudes):
+    """Spike-by-spike implementation of StochasticReleaseModel.measure_likelihood, evaluating
+    the binomial pmf separately for every spike.
+    """
+    result = np.empty(len(spike_times), dtype=model.result_dtype)
+    pre_spike_state = np.empty(len(spike_times), dtype=model.state_dtype)
+    post_spike_state = np.empty(len(spike_times), dtype=model.state_dtype)
+    state = {'available_vesicle': model.n_release_sites}
+    previous_t = spike_times[0]
+    for i,t in enumerate(spike_times):
+        amplitude = amplitudes[i]
+        dt = t - previous_t
+        previous_t = t
+        recovery = np.exp(-dt / model.recovery_tau)
+        state['available_vesicle'] = state['available_vesicle'] * recovery + model.n_release_sites * (1.0 - recovery)
+        pre_spike_state[i]['available_vesicle'] = state['available_vesicle']
+        expected_amplitude = state['available_vesicle'] * model.release_probability * model.mini_amplitude
+        likelihood = model.likelihood([amplitude], state)[0]
+        state['available_vesicle'] -= amplitude / model.mini_amplitude
+        post_spike_state[i]['available_vesicle'] = state['available_vesicle']
+        result[i] = (t, amplitude, expected_amplitude, likelihood)
+    return result, pre_spike_state, post_spike_state
+
+
+def test_likelihood_kernel_parity():
+    rng = np.random.RandomState(0)
+    spike_times = np.cumsum(rng.exponential(0.05, size=300))
+    
+    for n_sites, p, mini_amp, mini_stdev, tau in [(20, 0.1, 50e-6, 20e-6, 100e-3), (1, 0.9, 1e-3, 1e-4, 2e-5), (64, 0.01, 0.3, 0.1, 20)]:
+        model = StochasticReleaseModel()
+        model.n_release_sites = n_sites
+        model.release_probability = p
+        model.mini_amplitude = mini_amp
+        model.mini_amplitude_stdev = mini_stdev
+        model.recovery_tau = tau
+        amplitudes = rng.binomial(n_sites, p, size=len(spike_times)) * mini_amp + rng.normal(scale=model.measurement_stdev, size=len(spike_times))
+
+        expected = reference_likelihood(model, spike_times, amplitudes)
+        measured = model.measure_likelihood(spike_times, amplitudes)
+        for exp, meas in zip(expected, measured):
+            assert exp.dtype == meas.dtype
+            for field in exp.dtype.names:
+                assert np.allclose(exp[field], meas[field], rtol=1e-9, atol=0)
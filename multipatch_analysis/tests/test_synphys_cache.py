@@ -0,0 +1,127 @@
+import os, time
+from multipatch_analysis.synphys_cache import SynPhysCache
+
+
+def make_remote(root, n_files=5, size=1000):
+    files = []
+    for i in range(n_files):
+        site_path = os.path.join(root, '2018.01.%02d_000' % (i+1), 'slice_000', 'site_000')
+        os.makedirs(site_path)
+        filename = os.path.join(site_path, 'data_%d.nwb' % i)
+        open(filename, 'wb').write(bytes(bytearray([i]) * size))
+        files.append(filename)
+    return files
+
+
+def test_synphys_cache(tmpdir):
+    remote_path = os.path.join(str(tmpdir), 'remote')
+    local_path = os.path.join(str(tmpdir), 'local')
+    files = make_remote(remote_path)
+    cache = SynPhysCache(local_path=local_path, remote_path=remote_path, max_size=3500, grow=True)
+
+    # first request downloads the file
+    local_file = cache.get_cache(files[0])
+    assert local_file == os.path.join(local_path, os.path.relpath(files[0], remote_path))
+    assert open(local_file, 'rb').read() == open(files[0], 'rb').read()
+    assert cache.cache_size() == 1000
+
+    # cache hits do not touch the remote file
+    os.rename(files[0], files[0] + '.moved')
+    assert cache.get_cache(files[0]) == local_file
+    os.rename(files[0] + '.moved', files[0])
+
+    # changed remote files are only noticed when requested
+    open(files[0], 'wb').write(b'x' * 1000)
+    os.utime(files[0], (os.stat(local_file).st_mtime + 10,) * 2)
+    assert open(cache.get_cache(files[0]), 'rb').read() != b'x' * 1000
+    assert open(cache.get_cache(files[0], check_remote=True), 'rb').read() == b'x' * 1000
+
+    # a new cache instance reads the same manifest
+    cache = SynPhysCache(local_path=local_path, remote_path=remote_path, max_size=3500, grow=True)
+    for f in files[1:3]:
+        cache.get_cache(f)
+    assert cache.cache_size() == 3000
+
+    # least recently used files are evicted to stay under max_size
+    cache.get_cache(files[0])
+    cache.get_cache(files[3])
+    assert cache.cache_size() == 3000
+    assert cache.manifest.get(os.path.relpath(files[1], remote_path)) is None
+    assert not os.path.exists(os.path.join(local_path, os.path.relpath(files[1], remote_path)))
+    assert cache.manifest.get(os.path.relpath(files[0], remote_path)) is not None
+
+    # prefetched files are downloaded in the background
+    cache.max_size = None
+    cache.prefetch(files)
+    cache.wait_for_prefetch()
+    cache.stop_prefetch()
+    assert cache.cache_size() == 5000
+    for f in files:
+        assert cache.manifest.get(os.path.relpath(f, remote_path)) is not None
+
+    # caches that are not allowed to grow return remote paths for files they don't have
+    local_path2 = os.path.join(str(tmpdir), 'local2')
+    cache = SynPhysCache(local_path=local_path2, remote_path=remote_path, grow=False)
+    assert cache.get_cache(files[0]) == files[0]
+    cache.prefetch(files)
+    assert cache.cache_size() == 0
+
+
+def test_adopt_unlisted_files(tmpdir, monkeypatch):
+    # files cached before the manifest existed are added to it instead of being downloaded again
+    import shutil
+    from multipatch_analysis import synphys_cache
+    remote_path = os.path.join(str(tmpdir), 'remote')
+    local_path = os.path.join(str(tmpdir), 'local')
+    files = make_remote(remote_path, n_files=3)
+    for f in files:
+        local_file = os.path.join(local_path, os.path.relpath(f, remote_path))
+        os.makedirs(os.path.dirname(local_file))
+        shutil.copy2(f, local_file)
+    # the remote copy of one file has changed since it was cached
+    open(files[2], 'wb').write(b'y' * 1000)
+    os.utime(files[2], (os.stat(files[2]).st_mtime + 10,) * 2)
+
+    copied = []
+    orig_chunk_copy = synphys_cache.chunk_copy
+    def chunk_copy(src, dst):
+        copied.append(src)
+        return orig_chunk_copy(src, dst)
+    monkeypatch.setattr(synphys_cache, 'chunk_copy', chunk_copy)
+
+    cache = SynPhysCache(local_path=local_path, remote_path=remote_path, grow=True)
+    assert cache.manifest.get(os.path.relpath(files[0], remote_path)) is None
+    assert cache.get_cache(files[0]) == os.path.join(local_path, os.path.relpath(files[0], remote_path))
+    assert copied == []
+    assert cache.manifest.get(os.path.relpath(files[0], remote_path))['n_access'] == 1
+
+    # prefetching also adopts up-to-date files, and downloads stale ones
+    cache.prefetch(files)
+    cache.wait_for_prefetch()
+    assert copied == [files[2]]
+    assert open(cache.get_cache(files[2]), 'rb').read() == b'y' * 1000
+    assert cache.cache_size() == 3000
+
+
+def test_prefetch_unused_files(tmpdir):
+    # prefetched files that are never used must not stall prefetching
+    remote_path = os.path.join(str(tmpdir), 'remote')
+    local_path = os.path.join(str(tmpdir), 'local')
+    files = make_remote(remote_path, n_files=3)
+    cache = SynPhysCache(local_path=local_path, remote_path=remote_path, grow=True,
+                         prefetch_workers=1, prefetch_limit=1, prefetch_expire=0)
+    cache.prefetch(files)
+    cache.wait_for_prefetch()
+    assert cache.cache_size() == 3000
+
+    # threads exit once the queue is empty, and are started again as needed
+    for i in range(50):
+        if len(cache._prefetch_threads) == 0:
+            break
+        time.sleep(0.1)
+    assert cache._prefetch_threads == []
+    files2 = make_remote(os.path.join(remote_path, 'more'), n_files=1)
+    cache.prefetch(files2)
+    cache.wait_for_prefetch()
+    assert cache.cache_size() == 4000
+    cache.stop_prefetch()
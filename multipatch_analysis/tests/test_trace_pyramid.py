@@ -0,0 +1,98 @@
+import os, time
+import numpy as np
+import pytest
+from multipatch_analysis.trace_pyramid import TracePyramid, PyramidCache
+
+
+def test_trace_pyramid(tmpdir):
+    data = np.random.RandomState(0).normal(size=100000)
+    data[54321] = 100
+    data[12345] = -100
+    dt = 20e-6
+    pyr = TracePyramid(data, dt, t0=1.0, factor=8, min_size=512)
+    assert [len(l[0]) for l in pyr.levels] == [12500, 1563, 196]
+    assert pyr.value_range() == (-100, 100)
+
+    # full range at low resolution uses a decimated level and keeps every peak
+    t, y = pyr.query(None, None, n_pixels=1000)
+    assert len(y) == 2 * 1563
+    assert y.max() == 100 and y.min() == -100
+    assert t[0] == 1.0
+    assert np.all(np.diff(t) >= 0)
+
+    # each bin holds the min and max of the samples it covers
+    t, y = pyr.query(1.0, 1.0 + 10000 * dt, n_pixels=100)
+    bs = pyr.bin_size(pyr.choose_level(10001, 100))
+    assert bs == 64
+    for i in range(0, len(y), 2):
+        i0 = int(round((t[i] - 1.0) / dt))
+        assert y[i] == data[i0:i0+bs].min()
+        assert y[i+1] == data[i0:i0+bs].max()
+
+    # zoomed in far enough, original samples are returned
+    t, y = pyr.query(1.0 + 54300 * dt, 1.0 + 54400 * dt, n_pixels=1000)
+    assert np.all(y == data[54299:54402])
+    assert np.allclose(t, 1.0 + np.arange(54299, 54402) * dt)
+
+    # decimated levels can be written and memory-mapped back; the original data are not stored
+    path = os.path.join(str(tmpdir), 'pyr')
+    pyr.save(path)
+    assert not os.path.exists(os.path.join(path, 'data.npy'))
+    pyr2 = TracePyramid.load(path, data)
+    assert isinstance(pyr2.levels[0][0], np.memmap)
+    with pytest.raises(ValueError):
+        TracePyramid.load(path, data[:-1])
+    for args in [(None, None, 1000), (1.2, 1.5, 300), (1.0 + 54300 * dt, 1.0 + 54400 * dt, 1000)]:
+        t1, y1 = pyr.query(*args)
+        t2, y2 = pyr2.query(*args)
+        assert np.all(t1 == t2) and np.all(y1 == y2)
+
+
+def test_pyramid_cache(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), 'data.nwb')
+    open(src, 'wb').write(b'x' * 100)
+    cache = PyramidCache(os.path.join(str(tmpdir), 'cache'))
+    data = np.arange(5000.)
+    builds = []
+    orig_build = TracePyramid._build
+    def build(data, factor, min_size):
+        builds.append(1)
+        return orig_build(data, factor, min_size)
+    monkeypatch.setattr(TracePyramid, '_build', staticmethod(build))
+
+    pyr = cache.get(src, (1, 2), data, 1e-3)
+    pyr = cache.get(src, (1, 2), data, 1e-3)
+    assert len(builds) == 1
+    assert pyr.data is data
+
+    # other recordings in the same file and modified files get their own pyramids
+    cache.get(src, (1, 3), data, 1e-3)
+    assert len(builds) == 2
+    open(src, 'wb').write(b'x' * 101)
+    cache.get(src, (1, 2), data, 1e-3)
+    assert len(builds) == 3
+
+
+def test_pyramid_cache_eviction(tmpdir):
+    src = os.path.join(str(tmpdir), 'data.nwb')
+    open(src, 'wb').write(b'x' * 100)
+    cache = PyramidCache(os.path.join(str(tmpdir), 'cache'))
+    data = np.random.RandomState(0).normal(size=50000)
+    for i in range(3):
+        cache.get(src, (i,), data, 1e-3)
+    entries = cache.entries()
+    assert len(entries) == 3
+    size = entries[0][1]
+
+    # reading a pyramid marks it as recently used
+    for i, (atime, _, path) in enumerate(sorted(entries)):
+        os.utime(os.path.join(path, 'meta.json'), (time.time() - 100 + i,) * 2)
+    first = cache._load(sorted(entries)[0][2], data)
+    assert first is not None
+
+    # adding a pyramid beyond the size limit removes the least recently used ones
+    cache.max_size = 2.5 * size
+    cache.get(src, (3,), data, 1e-3)
+    remaining = sorted(e[2] for e in cache.entries())
+    assert len(remaining) == 2
+    assert sorted(entries)[0][2] in remaining
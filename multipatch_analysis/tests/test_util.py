@@ -0,0 +1,237 @@
+import os, sys, time, json, hashlib, functools
+import numpy as np
+import pytest
+from multipatch_analysis import util
+
+
+def make_file(filename, size, seed=0):
+    data = np.random.RandomState(seed).randint(0, 256, size=size).astype('uint8').tobytes()
+    open(filename, 'wb').write(data)
+    return data
+
+
+def file_digest(data, block_size):
+    blocks = [hashlib.sha1(data[i:i+block_size]).hexdigest() for i in range(0, max(len(data), 1), block_size)]
+    return hashlib.sha1(''.join(blocks).encode('ascii')).hexdigest()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_transfer_file(tmpdir, workers):
+    src = os.path.join(str(tmpdir), 'src.dat')
+    dst = os.path.join(str(tmpdir), 'dst.dat')
+    block_size = 1000
+    data = make_file(src, 10500)
+
+    digest = util.transfer_file(src, dst, block_size=block_size, workers=workers, parallel_threshold=0)
+    assert open(dst, 'rb').read() == data
+    assert digest == file_digest(data, block_size)
+    assert not os.path.exists(dst + '.blocks')
+
+    # simulate an interrupted copy: only some blocks were written, and one of them is corrupt
+    os.remove(dst)
+    with open(dst, 'wb') as fh:
+        fh.truncate(len(data))
+        fh.write(data[:4000])
+    blocks = {i: hashlib.sha1(data[i*block_size:(i+1)*block_size]).hexdigest() for i in range(4)}
+    with open(dst, 'r+b') as fh:
+        fh.seek(1500)
+        fh.write(b'\0' * 10)
+    header = {'src_size': len(data), 'src_mtime': os.stat(src).st_mtime, 'block_size': block_size}
+    json.dump({'header': header, 'blocks': blocks}, open(dst + '.blocks', 'w'))
+
+    digest = util.transfer_file(src, dst, block_size=block_size, workers=workers, parallel_threshold=0)
+    assert open(dst, 'rb').read() == data
+    assert digest == file_digest(data, block_size)
+
+
+def test_transfer_file_verify(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), 'src.dat')
+    dst = os.path.join(str(tmpdir), 'dst.dat')
+    data = make_file(src, 5000)
+
+    # corrupt one block as it is written
+    orig_open = open
+    class CorruptingFile(object):
+        def __init__(self, fh):
+            self.fh = fh
+        def write(self, chunk):
+            if self.fh.tell() == 2000:
+                chunk = b'\0' * len(chunk)
+            return self.fh.write(chunk)
+        def __getattr__(self, name):
+            return getattr(self.fh, name)
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return self.fh.__exit__(*args)
+    def corrupting_open(filename, mode='r'):
+        fh = orig_open(filename, mode)
+        return CorruptingFile(fh) if mode == 'r+b' else fh
+    monkeypatch.setattr(util, 'open', corrupting_open, raising=False)
+    with pytest.raises(IOError):
+        util.transfer_file(src, dst, block_size=1000)
+    assert sorted(json.load(open(dst + '.blocks'))['blocks'].keys()) == ['0', '1', '3', '4']
+
+    # the next attempt copies only the corrupt block again
+    monkeypatch.setattr(util, 'open', orig_open, raising=False)
+    assert util.transfer_file(src, dst, block_size=1000) == file_digest(data, 1000)
+    assert open(dst, 'rb').read() == data
+
+
+def test_reraise():
+    def fail():
+        raise ValueError("copy failed")
+    try:
+        fail()
+    except ValueError:
+        exc_info = sys.exc_info()
+    with pytest.raises(ValueError) as err:
+        util.reraise(exc_info)
+    assert err.traceback[-1].name == 'fail'
+
+
+def test_safe_copy_resume(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), 'src.dat')
+    dst = os.path.join(str(tmpdir), 'dst.dat')
+    data = make_file(src, 5000)
+    old_data = make_file(dst, 100, seed=1)
+    os.utime(dst, (0, 0))
+
+    # fail partway through the copy; the partial file is kept and the destination is untouched
+    orig_sha1 = hashlib.sha1
+    calls = []
+    def failing_sha1(data=b''):
+        calls.append(len(data))
+        if len(calls) == 3:
+            raise IOError("network error")
+        return orig_sha1(data)
+    monkeypatch.setattr(util.hashlib, 'sha1', failing_sha1)
+    with pytest.raises(IOError):
+        util.transfer_file(src, dst + '.partial', block_size=1000)
+    monkeypatch.setattr(util.hashlib, 'sha1', orig_sha1)
+    assert os.path.exists(dst + '.partial')
+    assert len(json.load(open(dst + '.partial.blocks'))['blocks']) == 2
+    assert open(dst, 'rb').read() == old_data
+
+    # the next sync resumes the copy (only the remaining blocks are hashed) and archives the old version
+    calls = []
+    def counting_sha1(data=b''):
+        calls.append(len(data))
+        return orig_sha1(data)
+    monkeypatch.setattr(util.hashlib, 'sha1', counting_sha1)
+    monkeypatch.setattr(util, 'transfer_file', functools.partial(util.transfer_file, block_size=1000))
+    assert util.sync_file(src, dst) == 'update'
+    # 2 verified + 3 copied + 3 read back blocks, plus the file digest
+    assert len(calls) == 9
+    assert open(dst, 'rb').read() == data
+    assert not os.path.exists(dst + '.partial')
+    assert not os.path.exists(dst + '.partial.blocks')
+    archived = util.archived_versions(dst)
+    assert len(archived) == 1
+    assert open(archived[0][1], 'rb').read() == old_data
+
+
+def test_sync_dir_manifest(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), 'src')
+    dst = os.path.join(str(tmpdir), 'dst')
+    os.makedirs(os.path.join(src, 'sub'))
+    make_file(os.path.join(src, 'a.dat'), 100)
+    make_file(os.path.join(src, 'b.dat'), 200, seed=1)
+    make_file(os.path.join(src, 'sub', 'c.dat'), 300, seed=2)
+
+    util.sync_dir(src, dst, archive_deleted=True)
+    for name in ['a.dat', 'b.dat', os.path.join('sub', 'c.dat')]:
+        assert open(os.path.join(dst, name), 'rb').read() == open(os.path.join(src, name), 'rb').read()
+    manifest = util.read_sync_manifest(dst)
+    assert sorted(manifest['files'].keys()) == ['a.dat', 'b.dat']
+    assert manifest['dirs'] == ['sub']
+    assert manifest['files']['a.dat'][0] == 100
+    assert manifest['files']['a.dat'][2] is not None
+    assert list(util.read_sync_manifest(os.path.join(dst, 'sub'))['files'].keys()) == ['c.dat']
+
+    # unchanged files are skipped without looking at the destination
+    synced = []
+    orig_sync_file = util.sync_file
+    def sync_file(src, dst, **kwds):
+        synced.append(os.path.basename(src))
+        return orig_sync_file(src, dst, **kwds)
+    monkeypatch.setattr(util, 'sync_file', sync_file)
+    util.sync_dir(src, dst, archive_deleted=True)
+    assert synced == []
+
+    # modified and deleted files are still handled
+    make_file(os.path.join(src, 'a.dat'), 150, seed=3)
+    os.remove(os.path.join(src, 'b.dat'))
+    util.sync_dir(src, dst, archive_deleted=True)
+    assert synced == ['a.dat']
+    assert open(os.path.join(dst, 'a.dat'), 'rb').read() == open(os.path.join(src, 'a.dat'), 'rb').read()
+    assert not os.path.exists(os.path.join(dst, 'b.dat'))
+    assert len(util.archived_versions(os.path.join(dst, 'b.dat'))) == 1
+    assert len(util.archived_versions(os.path.join(dst, 'a.dat'))) == 1
+    assert sorted(util.read_sync_manifest(dst)['files'].keys()) == ['a.dat']
+
+    # without the manifest every file is compared with the destination
+    synced[:] = []
+    util.sync_dir(src, dst, archive_deleted=True, use_manifest=False)
+    assert sorted(synced) == ['a.dat', 'c.dat']
+
+
+def test_sync_dir_signatures(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), 'src')
+    dst = os.path.join(str(tmpdir), 'dst')
+    os.makedirs(os.path.join(src, 'sub', 'subsub'))
+    make_file(os.path.join(src, 'a.dat'), 100)
+    make_file(os.path.join(src, 'sub', 'subsub', 'c.dat'), 300, seed=2)
+    signatures = util.SyncSignatureStore(os.path.join(str(tmpdir), 'signatures.sqlite'))
+
+    util.sync_dir(src, dst, signatures=signatures)
+    assert open(os.path.join(dst, 'sub', 'subsub', 'c.dat'), 'rb').read() == open(os.path.join(src, 'sub', 'subsub', 'c.dat'), 'rb').read()
+    assert signatures.get(src)[:2] == (util.dir_signature(src), ['sub'])
+
+    # unchanged folders are not listed again; recorded subfolders are still visited
+    listed = []
+    orig_listdir = os.listdir
+    def listdir(path):
+        listed.append(path)
+        return orig_listdir(path)
+    monkeypatch.setattr(util.os, 'listdir', listdir)
+    util.sync_dir(src, dst, signatures=signatures)
+    assert listed == []
+
+    # adding a file changes the signature of its folder only
+    make_file(os.path.join(src, 'sub', 'subsub', 'd.dat'), 50, seed=4)
+    os.utime(os.path.join(src, 'sub', 'subsub'), (time.time() + 10,) * 2)
+    util.sync_dir(src, dst, signatures=signatures)
+    assert listed == [os.path.join(src, 'sub', 'subsub')]
+    assert os.path.exists(os.path.join(dst, 'sub', 'subsub', 'd.dat'))
+
+    # old signatures are not trusted
+    listed[:] = []
+    util.sync_dir(src, dst, signatures=signatures, max_signature_age=-1)
+    assert sorted(listed) == sorted([src, os.path.join(src, 'sub'), os.path.join(src, 'sub', 'subsub')])
+
+
+def test_destination_limiter():
+    import threading
+    limiter = util.DestinationLimiter(2, key=lambda dest: dest.split('/')[1])
+    active = {}
+    peak = {}
+    lock = threading.Lock()
+    gate = threading.Event()
+
+    def job(dest):
+        with limiter(dest):
+            key = dest.split('/')[1]
+            with lock:
+                active[key] = active.get(key, 0) + 1
+                peak[key] = max(peak.get(key, 0), active[key])
+            gate.wait(0.2)
+            with lock:
+                active[key] -= 1
+
+    threads = [threading.Thread(target=job, args=('/%s/%d' % (d, i),)) for d in 'xy' for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak == {'x': 2, 'y': 2}
@@ -0,0 +1,279 @@
+"""
+Multi-resolution min/max envelopes for displaying long recordings.
+
+Plotting every sample of many 50 kHz sweeps is slow, and only a few thousand points can be
+distinguished on screen anyway. A TracePyramid stores a recording along with successively
+decimated copies in which each bin holds the minimum and maximum of *factor* bins from the level
+below. Viewers ask for the visible time range and their width in pixels (see TracePyramid.query)
+and get back the coarsest level that still shows every peak.
+
+The decimated levels of pyramids built from raw recordings can be stored in config.cache_path
+(next to the cached NWB files; see PyramidCache) so that they only need to be computed once per
+recording. The original samples are always read from the recording itself.
+
+"""
+from __future__ import print_function, division
+
+import os, json, shutil, hashlib, threading
+import numpy as np
+
+from . import config
+
+
+class TracePyramid(object):
+    """Min/max decimation pyramid for a regularly sampled trace.
+
+    Parameters
+    ----------
+    data : array
+        Sample values. Level 0 of the pyramid refers to this array (it is not copied).
+    dt : float
+        Sample interval.
+    t0 : float
+        Time of the first sample.
+    factor : int
+        Number of bins from the previous level that are combined into each bin of the next.
+    min_size : int
+        Decimation stops once a level has fewer than this many bins.
+    """
+    def __init__(self, data, dt, t0=0.0, factor=8, min_size=512, levels=None):
+        self.data = data
+        self.dt = dt
+        self.t0 = t0
+        self.factor = factor
+        if levels is None:
+            levels = self._build(np.asarray(data), factor, min_size)
+        self.levels = levels
+
+    @staticmethod
+    def _build(data, factor, min_size):
+        levels = []
+        mins = maxs = data
+        while len(mins) > min_size:
+            n = int(np.ceil(len(mins) / factor))
+            pad = n * factor - len(mins)
+            if pad > 0:
+                # repeat the last value so that padding never changes the envelope
+                mins = np.concatenate([mins, np.repeat(mins[-1:], pad)])
+                maxs = np.concatenate([maxs, np.repeat(maxs[-1:], pad)])
+            mins = mins.reshape(n, factor).min(axis=1)
+            maxs = maxs.reshape(n, factor).max(axis=1)
+            levels.append((mins, maxs))
+        return levels
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def t_stop(self):
+        return self.t0 + len(self.data) * self.dt
+
+    def bin_size(self, level):
+        """Return the number of samples in each bin of *level* (0 is the original data).
+        """
+        return self.factor ** level
+
+    def choose_level(self, n_samples, n_pixels):
+        """Return the coarsest level that still has at least one bin per pixel when
+        *n_samples* are displayed across *n_pixels*.
+        """
+        samples_per_pixel = n_samples / max(n_pixels, 1)
+        level = 0
+        while level < len(self.levels) and self.bin_size(level + 1) <= samples_per_pixel:
+            level += 1
+        return level
+
+    def query(self, start=None, stop=None, n_pixels=1000):
+        """Return (time, values) arrays to display the range *start*..*stop* (in seconds) at a
+        width of *n_pixels*.
+
+        When the range contains fewer than *factor* samples per pixel, the original samples are
+        returned. Otherwise the min and max of each bin are returned in alternating order, both
+        at the start time of the bin. One extra bin is included at each end so that lines leave
+        the visible range correctly.
+        """
+        n = len(self.data)
+        i0 = 0 if start is None else int(np.floor((start - self.t0) / self.dt))
+        i1 = n if stop is None else int(np.ceil((stop - self.t0) / self.dt)) + 1
+        i0 = min(max(i0, 0), n)
+        i1 = min(max(i1, i0), n)
+
+        level = self.choose_level(i1 - i0, n_pixels)
+        if level == 0:
+            i0 = max(i0 - 1, 0)
+            i1 = min(i1 + 1, n)
+            t = self.t0 + np.arange(i0, i1) * self.dt
+            return t, np.asarray(self.data[i0:i1])
+
+        bs = self.bin_size(level)
+        mins, maxs = self.levels[level - 1]
+        j0 = max(i0 // bs - 1, 0)
+        j1 = min(-(-i1 // bs) + 1, len(mins))
+        y = np.empty(2 * (j1 - j0), dtype=mins.dtype)
+        y[0::2] = mins[j0:j1]
+        y[1::2] = maxs[j0:j1]
+        t = self.t0 + np.repeat(np.arange(j0, j1), 2) * bs * self.dt
+        return t, y
+
+    def value_range(self):
+        """Return the (min, max) of the entire trace.
+        """
+        if len(self.levels) > 0:
+            mins, maxs = self.levels[-1]
+        else:
+            mins = maxs = np.asarray(self.data)
+        if len(mins) == 0:
+            return (0.0, 0.0)
+        return (float(np.nanmin(mins)), float(np.nanmax(maxs)))
+
+    def save(self, path):
+        """Write the decimated levels of the pyramid to a new folder at *path*.
+
+        The original data are not written; they must be supplied again to load(). The folder
+        is written under a temporary name and renamed when complete, so readers never see a
+        partial pyramid.
+        """
+        tmp = path + '.%d.tmp' % os.getpid()
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for i, (mins, maxs) in enumerate(self.levels):
+            np.save(os.path.join(tmp, 'min_%d.npy' % (i+1)), mins)
+            np.save(os.path.join(tmp, 'max_%d.npy' % (i+1)), maxs)
+        meta = {'dt': self.dt, 't0': self.t0, 'factor': self.factor, 'n_levels': len(self.levels),
+                'n_samples': len(self.data)}
+        json.dump(meta, open(os.path.join(tmp, 'meta.json'), 'w'))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process saved the same pyramid first
+            shutil.rmtree(tmp)
+
+    @classmethod
+    def load(cls, path, data, mmap_mode='r'):
+        """Read a pyramid written by save(), using *data* as the original samples. By default,
+        the decimated levels are memory-mapped so that only the parts that are displayed are
+        read from disk.
+        """
+        meta = json.load(open(os.path.join(path, 'meta.json')))
+        if meta['n_samples'] != len(data):
+            raise ValueError("Pyramid at %s was built from %d samples, not %d" % (path, meta['n_samples'], len(data)))
+        levels = []
+        for i in range(meta['n_levels']):
+            mins = np.load(os.path.join(path, 'min_%d.npy' % (i+1)), mmap_mode=mmap_mode)
+            maxs = np.load(os.path.join(path, 'max_%d.npy' % (i+1)), mmap_mode=mmap_mode)
+            levels.append((mins, maxs))
+        return cls(data, meta['dt'], t0=meta['t0'], factor=meta['factor'], levels=levels)
+
+
+class PyramidCache(object):
+    """Stores the decimated levels of TracePyramids built from recordings in a folder on disk.
+
+    Each pyramid is identified by the file it was read from (including its size and
+    modification time, so that pyramids are rebuilt if the file changes) and any other
+    values needed to find the recording within the file, such as sweep ID and channel.
+
+    If *max_size* is given, the least recently used pyramids are removed whenever the total
+    size of the cache grows beyond *max_size* bytes.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._building = {}
+
+    def key(self, filename, *parts):
+        st = os.stat(filename)
+        desc = [os.path.abspath(filename), st.st_size, st.st_mtime] + [str(p) for p in parts]
+        return hashlib.sha1(json.dumps(desc).encode('utf8')).hexdigest()
+
+    def get(self, filename, parts, data, dt, t0=0.0):
+        """Return a pyramid for the recording *data* (sampled at *dt*, starting at *t0*) that was
+        read from *filename* and is identified within the file by *parts*.
+
+        If the pyramid is not cached yet, it is built and its decimated levels are saved for
+        next time.
+        """
+        key = self.key(filename, *parts)
+        path = os.path.join(self.path, key[:2], key)
+        pyramid = self._load(path, data)
+        if pyramid is not None:
+            return pyramid
+
+        # make sure the same pyramid is not built twice by different threads
+        with self._lock:
+            lock = self._building.setdefault(key, threading.Lock())
+        with lock:
+            pyramid = self._load(path, data)
+            if pyramid is not None:
+                return pyramid
+            pyramid = TracePyramid(data, dt, t0=t0)
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+            pyramid.save(path)
+        with self._lock:
+            self._building.pop(key, None)
+        if self.max_size is not None:
+            self.evict(self.max_size)
+        return pyramid
+
+    def _load(self, path, data):
+        if not os.path.exists(path):
+            return None
+        try:
+            pyramid = TracePyramid.load(path, data)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        # record the access time for eviction
+        os.utime(os.path.join(path, 'meta.json'), None)
+        return pyramid
+
+    def entries(self):
+        """Return a list of (last_access_time, size, path) for all cached pyramids.
+        """
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, key)
+                try:
+                    files = [os.path.join(path, f) for f in os.listdir(path)]
+                    size = sum(os.path.getsize(f) for f in files)
+                    atime = os.path.getmtime(os.path.join(path, 'meta.json'))
+                except OSError:
+                    # pyramid being written or removed
+                    continue
+                entries.append((atime, size, path))
+        return entries
+
+    def evict(self, max_size):
+        """Remove least recently used pyramids until the cache is no larger than *max_size* bytes.
+        """
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for atime, size, path in entries:
+            if total <= max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_pyramid_cache():
+    """Return the PyramidCache kept in config.cache_path, limited to config.pyramid_cache_size bytes.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PyramidCache(os.path.join(config.cache_path, 'trace_pyramids'), max_size=config.pyramid_cache_size)
+    return _cache
@@ -1,13 +1,15 @@
 from __future__ import print_function
-import os, sys, datetime, re, glob, traceback, time, atexit, threading
+import os, sys, datetime, re, glob, traceback, time, atexit, threading, itertools
 try:
     import queue
 except ImportError:
     import Queue as queue
 from pprint import pprint
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import numpy as np
 from .. import config, lims
+from ..dashboard_status import get_store, site_signature, pass_color, fail_color
+from ..util import DestinationLimiter
 from ..experiment import Experiment
 from ..database import database
 from ..genotypes import Genotype
@@ -20,12 +22,17 @@ import pyqtgraph.console
 from pyqtgraph.Qt import QtGui, QtCore
 
 
-fail_color = (255, 200, 200)
-pass_color = (200, 255, 200)
-
-
 class Dashboard(QtGui.QWidget):
-    def __init__(self, limit=0, no_thread=False, filter_defaults=None):
+    """Displays the pipeline status of all experiments found in the server and rig data paths.
+
+    Results of previous checks are loaded from a DashboardStatusStore at startup. Pollers
+    rescan each data source every *poll_interval* seconds (and immediately when a recent
+    folder changes); *n_checkers* threads then check experiments that are new, have changed,
+    or are incomplete, and recheck complete experiments after *recheck_interval* seconds. At most *source_limit*
+    experiments from the same data source are checked at once.
+    """
+    def __init__(self, limit=0, no_thread=False, filter_defaults=None, n_checkers=6, source_limit=2,
+                 poll_interval=3600, recheck_interval=24*3600, status_store=None):
         QtGui.QWidget.__init__(self)
 
         # fields displayed in ui
@@ -56,15 +63,17 @@ class Dashboard(QtGui.QWidget):
         self.hidden_fields = [
             ('experiment', object),
             ('lims_slice_name', object),
-            ('item', object),
+            ('colors', object),
+            ('search', 'U500'),
             ('error', object),
+            ('site_path', object),
         ]
 
         # maps field name : index (column number)
         self.field_indices = {self.visible_fields[i][0]:i for i in range(len(self.visible_fields))}
 
         self.records = GrowingArray(dtype=self.visible_fields + self.hidden_fields)
-        self.records_by_expt = {}  # maps expt:index
+        self.records_by_ts = {}  # maps expt timestamp:index
 
         self.selected = None
 
@@ -106,12 +115,16 @@ class Dashboard(QtGui.QWidget):
         self.right_splitter = QtGui.QSplitter(QtCore.Qt.Vertical)
         self.splitter.addWidget(self.right_splitter)
 
-        self.expt_tree = pg.TreeWidget()
+        self.expt_model = ExperimentModel(self.records, [f[0] for f in self.visible_fields])
+        self.expt_tree = QtGui.QTreeView()
+        self.expt_tree.setModel(self.expt_model)
+        self.expt_tree.setRootIsDecorated(False)
+        self.expt_tree.setUniformRowHeights(True)
+        self.expt_tree.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
         self.expt_tree.setSortingEnabled(True)
-        self.expt_tree.setColumnCount(len(self.visible_fields))
-        self.expt_tree.setHeaderLabels([f[0] for f in self.visible_fields])
+        self.expt_tree.sortByColumn(0, QtCore.Qt.DescendingOrder)
         self.right_splitter.addWidget(self.expt_tree)
-        self.expt_tree.itemSelectionChanged.connect(self.tree_selection_changed)
+        self.expt_tree.selectionModel().selectionChanged.connect(self.tree_selection_changed)
 
         console_text = """
         Variables:
@@ -176,6 +189,18 @@ class Dashboard(QtGui.QWidget):
         
         # Queue of experiments to be checked
         self.expt_queue = queue.PriorityQueue()
+        self.status_store = get_store() if status_store is None else status_store
+
+        # start with the results of previous checks
+        self._incoming_checker_records = deque()
+        for ts, site_path, rec, checked in self.status_store.records():
+            rec['experiment'] = None
+            rec['site_path'] = site_path
+            self._incoming_checker_records.append(rec)
+
+        # watch recently modified folders so that pollers can react to changes right away
+        self.watcher = QtCore.QFileSystemWatcher()
+        self.watcher.directoryChanged.connect(self.watched_dir_changed)
 
         # collect a list of all data sources to search
         search_paths = [config.synphys_data]
@@ -190,8 +215,10 @@ class Dashboard(QtGui.QWidget):
             if not os.path.exists(search_path):
                 print("Ignoring search path:", search_path)
                 continue
-            poll_thread = PollThread(self.expt_queue, search_path, limit=limit)
+            poll_thread = PollThread(self.expt_queue, search_path, self.status_store, limit=limit,
+                                     interval=poll_interval, recheck_interval=recheck_interval)
             poll_thread.update.connect(self.poller_update)
+            poll_thread.watch.connect(self.watch_paths)
             if no_thread:
                 poll_thread.poll()  # for local debugging
             else:
@@ -199,15 +226,15 @@ class Dashboard(QtGui.QWidget):
             self.pollers.append(poll_thread)
 
         # Checkers pull experiments off of the queue and check their status
-        self._incoming_checker_records = []
+        self.source_limiter = DestinationLimiter(source_limit, key=lambda source: source)
+        self.checkers = []
         if no_thread:
-            self.checker = ExptCheckerThread(self.expt_queue)
+            self.checker = ExptCheckerThread(self.expt_queue, self.source_limiter, self.status_store)
             self.checker.update.connect(self.checker_update)
             self.checker.run(block=False)            
         else:
-            self.checkers = []
-            for i in range(3):
-                self.checkers.append(ExptCheckerThread(self.expt_queue))
+            for i in range(n_checkers):
+                self.checkers.append(ExptCheckerThread(self.expt_queue, self.source_limiter, self.status_store))
                 self.checkers[-1].update.connect(self.checker_update)
                 self.checkers[-1].start()
 
@@ -220,6 +247,8 @@ class Dashboard(QtGui.QWidget):
 
         self.handle_checker_record_timer = QtCore.QTimer()
         self.handle_checker_record_timer.timeout.connect(self.handle_all_checker_records)
+        if len(self._incoming_checker_records) > 0:
+            self.handle_checker_record_timer.start(0)
 
     def poll_toggled(self):
         if self.poll_btn.isChecked():
@@ -230,7 +259,7 @@ class Dashboard(QtGui.QWidget):
     def start_polling(self):
         for poller in self.pollers:
             poller.enable_polling = True
-            poller.waker.set()
+            poller.request_poll()
 
     def stop_polling(self):
         for poller in self.pollers:
@@ -238,17 +267,43 @@ class Dashboard(QtGui.QWidget):
 
         # empty out the queue
         while self.expt_queue.qsize() > 0:
-            self.expt_queue.get()
+            try:
+                self.expt_queue.get(block=False)
+            except queue.Empty:
+                break
+
+    def watch_paths(self, paths):
+        """Start watching folders for changes (called by pollers).
+        """
+        watched = set(self.watcher.directories())
+        new_paths = [p for p in paths if p not in watched and os.path.isdir(p)]
+        if len(new_paths) > 0:
+            self.watcher.addPaths(new_paths)
+
+    def watched_dir_changed(self, path):
+        for poller in self.pollers:
+            poller.request_poll(path)
 
     def contextMenuEvent(self, event):
         self.menu.popup(event.globalPos())
 
     def tree_selection_changed(self):
-        sel = self.expt_tree.selectedItems()[0]
-        rec = self.records[sel.index]
+        sel = self.expt_tree.selectionModel().selectedRows()
+        if len(sel) == 0:
+            return
+        rec = self.records[self.expt_model.record_index(sel[0].row())]
         self.console.localNamespace['sel'] = rec
         self.selected = rec
         expt = rec['experiment']
+        if expt is None:
+            # record was loaded from the status store; load the experiment now
+            try:
+                expt = ExperimentMetadata(path=rec['site_path'])
+            except Exception:
+                print("Error loading experiment from %s:" % rec['site_path'])
+                traceback.print_exc()
+                return
+            rec['experiment'] = expt
         self.console.localNamespace['expt'] = expt
         self.expt_actions.experiment = expt
 
@@ -282,7 +337,11 @@ class Dashboard(QtGui.QWidget):
         err = rec['error']
         if err is not None:
             msg.append("Error checking experiment:")
-            msg.extend([line.rstrip() for line in traceback.format_exception(*err)])
+            if isinstance(err, str):
+                # formatted traceback from the status store
+                msg.extend(err.rstrip().split('\n'))
+            else:
+                msg.extend([line.rstrip() for line in traceback.format_exception(*err)])
 
         msg = '\n'.join(msg)
         print(msg)
@@ -297,7 +356,7 @@ class Dashboard(QtGui.QWidget):
         # self.long_status.showMessage(msg)
 
     def update_status(self):
-        self.status.showMessage("%d sites in queue" % self.expt_queue.qsize())
+        self.status.showMessage("%d sites in queue (%d checkers)" % (self.expt_queue.qsize(), len(self.checkers)))
 
     def checker_update(self, rec):
         """Received an update from a worker thread describing information about an experiment
@@ -309,34 +368,41 @@ class Dashboard(QtGui.QWidget):
     def handle_all_checker_records(self):
         recs = self._incoming_checker_records
         count = 0
+        update_filter = False
         while len(recs) > 0:
-            rec = recs.pop(0)
-            self.handle_checker_record(rec)
+            rec = recs.popleft()
+            update_filter = self.handle_checker_record(rec) or update_filter
             count += 1
-            if count > 2:
+            if count >= 500:
                 # yield to the event loop
-                return
-        self.handle_checker_record_timer.stop()
+                break
+        if len(recs) == 0:
+            self.handle_checker_record_timer.stop()
+
+        if update_filter:
+            self.filter.setFields(self.filter_fields)
+        self.filter_items()
 
     def handle_checker_record(self, rec):
-        expt = rec['experiment']
-        if expt in self.records_by_expt:
-            # use old record / item
-            index = self.records_by_expt[expt]
-            item = self.records[index]['item']
+        """Update the dashboard record for an experiment.
+
+        Return True if the record introduced new values for any filter field.
+        """
+        ts = round(float(rec['timestamp']), 3)
+        if ts in self.records_by_ts:
+            # use old record
+            index = self.records_by_ts[ts]
+            if rec.get('experiment') is None:
+                rec['experiment'] = self.records[index]['experiment']
         else:
-            # add new record / item
-            item = pg.TreeWidgetItem()
-            self.expt_tree.addTopLevelItem(item)
-            rec['item'] = item
-            index = self.records.add_record({})
-            item.index = index
+            # add new record
+            index = self.records.add_record({'colors': [None] * len(self.visible_fields)})
 
         record = self.records[index]
-        record['item'] = item
-        self.records_by_expt[expt] = index
+        self.records_by_ts[ts] = index
+        colors = record['colors']
 
-        # update item/record fields
+        # update record fields
         update_filter = False
         for field, val in rec.items():
             if field in self.field_indices and isinstance(val, tuple):
@@ -363,15 +429,11 @@ class Dashboard(QtGui.QWidget):
             # update this field in the record
             record[field] = val
             
-            # update this field in the tree item
             try:
                 i = self.field_indices[field]
             except KeyError:
                 continue
-
-            item.setText(i, display_val)
-            if color is not None:
-                item.setBackgroundColor(i, pg.mkColor(color))
+            colors[i] = color
 
             # update filter fields
             filter_field = self.filter_fields.get(field)
@@ -379,34 +441,31 @@ class Dashboard(QtGui.QWidget):
                 filter_field['values'][display_val] = True
                 update_filter = True
 
-        if update_filter:
-            self.filter.setFields(self.filter_fields)
+        # text matched by the search box
+        ts = record['timestamp']
+        search = [str(ts), str(np.round(ts, 2))]
+        for field in ('lims_slice_name', 'description', 'path'):
+            if record[field] is not None:
+                search.append(str(record[field]))
+        record['search'] = '\n'.join(search)
 
-        self.filter_items(self.records[index:index+1])
+        return update_filter
 
     def filter_changed(self, *args):
-        self.filter_items(self.records)
+        self.filter_items()
 
     def search_text_changed(self):
-        self.filter_items(self.records)
+        self.filter_items()
 
-    def filter_items(self, records):
-        search = str(self.search_text.text()).strip()
+    def filter_items(self):
+        """Show only records that pass the filter and contain the search text.
+        """
+        records = self.records
         mask = self.filter.generateMask(records)
-        for i,rec in enumerate(records):
-            hidden = not mask[i]
-            if search != '':
-                search_hit = False
-                if rec['lims_slice_name'] is not None and search in rec['lims_slice_name']:
-                    search_hit = True
-                elif search in str(rec['timestamp']) or search in str(np.round(rec['timestamp'], 2)):
-                    search_hit = True
-                elif rec['description'] is not None and search in rec['description']:
-                    search_hit = True
-                elif rec['path'] is not None and search in rec['path']:
-                    search_hit = True
-                hidden = hidden or not search_hit
-            rec['item'].setHidden(hidden)
+        search = str(self.search_text.text()).strip()
+        if search != '' and len(records) > 0:
+            mask &= np.char.find(records['search'], search) >= 0
+        self.expt_model.set_mask(mask)
 
     def quit(self):
         for t in self.pollers:
@@ -426,14 +485,19 @@ class Dashboard(QtGui.QWidget):
         self.quit()
 
     def reload_clicked(self, *args):
-        expt = self.selected['experiment']
-        self.expt_queue.put((-expt.timestamp, expt))
+        rec = self.selected
+        self.expt_queue.put(queue_item(0, float(rec['timestamp']), None, rec['site_path'], rec['experiment']))
 
     def console_toggled(self):
         self.console.setVisible(self.console_btn.isChecked())
 
 
 class GrowingArray(object):
+    """Structured array that grows as records are added.
+
+    Indexing by field name returns a column view of all records, so columns can be
+    filtered and sorted with vectorized numpy operations.
+    """
     def __init__(self, dtype, init_size=1000):
         self.size = 0
         self._data = np.empty(init_size, dtype=dtype)
@@ -461,106 +525,354 @@ class GrowingArray(object):
 
     def _grow(self, size):
         if size > len(self._data):
-            self._data = np.resize(self._data, len(self._data)*2)
+            # (np.resize would fill the new rows with copies of existing records)
+            data = np.empty(max(size, len(self._data)*2), dtype=self._data.dtype)
+            data[:len(self._data)] = self._data
+            self._data = data
         self._view = self._data[:size]
         self.size = size
 
 
+class ExperimentModel(QtCore.QAbstractTableModel):
+    """Presents the visible fields of dashboard records (a GrowingArray) to a view.
+
+    Only records that pass the mask given to set_mask() are exposed as rows, in the order set
+    by sort(). Filtering and sorting operate on whole columns of the record array, and the view
+    only requests data for the cells it draws, so the cost of an update does not depend on how
+    many items are displayed.
+    """
+    def __init__(self, records, fields):
+        QtCore.QAbstractTableModel.__init__(self)
+        self.records = records
+        self.fields = fields
+        self.rows = np.zeros(0, dtype=int)  # record index for each row
+        self.mask = None
+        self.sort_column = None
+        self.sort_order = QtCore.Qt.AscendingOrder
+        self._brushes = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.fields)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.fields[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            field = self.fields[index.column()]
+            val = self.records[self.rows[index.row()]][field]
+            if field == 'timestamp':
+                return '%0.3f' % val
+            return str(val)
+        elif role == QtCore.Qt.BackgroundRole:
+            color = self.records[self.rows[index.row()]]['colors'][index.column()]
+            if color is None:
+                return None
+            key = color if isinstance(color, str) else tuple(color)
+            if key not in self._brushes:
+                self._brushes[key] = pg.mkBrush(color)
+            return self._brushes[key]
+        return None
+
+    def record_index(self, row):
+        """Return the index in the record array of the record displayed in *row*.
+        """
+        return int(self.rows[row])
+
+    def set_mask(self, mask):
+        """Display only records where the boolean array *mask* is True.
+
+        This is also used to refresh the view after records are added or changed.
+        """
+        self.mask = mask
+        self._update_rows()
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self._update_rows()
+
+    def _update_rows(self):
+        n = len(self.records)
+        if self.mask is None:
+            rows = np.arange(n)
+        else:
+            rows = np.nonzero(self.mask[:n])[0]
+        if self.sort_column is not None and len(rows) > 0:
+            keys = self.records[self.fields[self.sort_column]][rows]
+            order = np.argsort(keys, kind='mergesort')
+            if self.sort_order == QtCore.Qt.DescendingOrder:
+                order = order[::-1]
+            rows = rows[order]
+
+        self.layoutAboutToBeChanged.emit()
+        # keep selection and current item on the same records
+        old_indexes = self.persistentIndexList()
+        old_records = [self.rows[i.row()] for i in old_indexes]
+        self.rows = rows
+        if len(old_indexes) > 0:
+            new_row = -np.ones(n, dtype=int)
+            new_row[rows] = np.arange(len(rows))
+            new_indexes = []
+            for i, rec in zip(old_indexes, old_records):
+                row = new_row[rec]
+                new_indexes.append(self.index(row, i.column()) if row >= 0 else QtCore.QModelIndex())
+            self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
+
+_queue_counter = itertools.count()
+
+def queue_item(priority, timestamp, source, site_path, expt=None):
+    """Return an item for the experiment check queue.
+
+    Items are checked in order of *priority* (lower first), then newest first. *source* is the
+    data source the site was found in (used to limit concurrent checks per source), and *expt*
+    is an ExperimentMetadata instance if one is already loaded.
+    """
+    return (priority, -timestamp, next(_queue_counter), source, site_path, expt)
+
+
 class PollThread(QtCore.QThread):
     """Used to check in the background for changes to experiment status.
+
+    Sites whose folders have not changed since they were last seen (see site_signature) and
+    whose last check passed every stage (see record_complete) are only queued again once that
+    check is older than *recheck_interval*; this avoids loading metadata for every site on every
+    poll. Incomplete experiments are queued on every poll, because LIMS, DB, and backup status
+    can change without touching the site folders. A full poll runs every *interval* seconds,
+    and request_poll() triggers an earlier poll of just the folders that changed.
     """
     update = QtCore.Signal(object, object)  # search_path, status_message
-    known_expts = {}
+    watch = QtCore.Signal(object)  # list of folders to watch for changes
+    known_expts = {}  # maps timestamp: time last queued, shared by all pollers
     known_expts_lock = threading.Lock()
 
-    def __init__(self, expt_queue, search_path, limit=0, interval=3600):
+    # number of recent day folders watched for changes
+    watch_days = 3
+
+    def __init__(self, expt_queue, search_path, status_store, limit=0, interval=3600, recheck_interval=24*3600):
         QtCore.QThread.__init__(self)
         self.expt_queue = expt_queue
         self.search_path = search_path
+        self.status_store = status_store
         self.limit = limit
         self.interval = interval
+        self.recheck_interval = recheck_interval
         self._stop = False
         self.waker = threading.Event()
         self.enable_polling = True   # set False to temporarily disable polling
+        self._dirty_days = set()
+        self._full_poll = True
+        self._dirty_lock = threading.Lock()
         
     def stop(self):
         self._stop = True
         self.waker.set()
 
+    def request_poll(self, path=None):
+        """Request a poll of the day folder containing *path*, or of all folders if *path* is None.
+
+        Paths outside of this poller's search path are ignored.
+        """
+        with self._dirty_lock:
+            if path is None:
+                self._full_poll = True
+            else:
+                rel = os.path.relpath(os.path.abspath(path), os.path.abspath(self.search_path))
+                if rel.startswith('..'):
+                    return
+                day = rel.split(os.sep)[0]
+                # a change in the root folder may be a new day; check the most recent days
+                self._dirty_days.add(None if day == '.' else day)
+        self.waker.set()
+
     def run(self):
+        next_full_poll = 0
         while True:
             try:
-                # check for new experiments hourly
-                self.poll()
-                self.waker.wait(self.interval)
+                with self._dirty_lock:
+                    full_poll = self._full_poll or time.time() >= next_full_poll
+                    days = self._dirty_days
+                    self._full_poll = False
+                    self._dirty_days = set()
+                if full_poll:
+                    # check for new experiments hourly
+                    self.poll()
+                    next_full_poll = time.time() + self.interval
+                elif len(days) > 0:
+                    self.poll(days=days)
+                self.waker.wait(max(0, next_full_poll - time.time()))
+                self.waker.clear()
                 if self._stop:
                     return
             except Exception:
                 sys.excepthook(*sys.exc_info())
                 
-    def poll(self):
-        # Find all available site paths across all data sources
+    def poll(self, days=None):
+        """Queue experiments in this poller's search path that need to be checked.
+
+        If *days* is given, only search the named day folders (None in *days* means the
+        most recent folders).
+        """
         count = 0
         path = self.search_path
 
         self.update.emit(path, "Updating...")
         root_dh = getDirHandle(path)
+        all_days = sorted(os.listdir(root_dh.name()), reverse=True)
+        if days is None:
+            day_names = all_days
+        else:
+            day_names = set([d for d in days if d is not None])
+            if None in days:
+                day_names.update(all_days[:self.watch_days])
+            day_names = sorted(day_names, reverse=True)
 
         # iterate over all expt sites in this path
-        for day_name in sorted(os.listdir(root_dh.name()), reverse=True):
+        for day_name in day_names:
+            new_expts = []
             for expt_path in glob.iglob(os.path.join(root_dh.name(), day_name, 'slice_*', 'site_*')):
                 if self._stop or not self.enable_polling:
                     return
 
-                try:
-                    expt = ExperimentMetadata(path=expt_path)
-                    ts = expt.timestamp
-                except:
-                    print ('Error loading %s, ignoring and moving on...' % expt_path)    
-                    continue
-                # Couldn't get timestamp; show an error message
-                if ts is None:
-                    print("Error getting timestamp for %s" % expt)
+                item = self.check_site(expt_path)
+                if item is None:
                     continue
+                new_expts.append(item)
+                count += 1
+                if self.limit > 0 and count >= self.limit:
+                    break
 
-                with self.known_expts_lock:
-                    now = time.time()
-                    if ts in self.known_expts:
-                        expt, last_update = self.known_expts[ts]
-                        if now - last_update < self.interval:
-                            # We've already seen this expt recently; skip
-                            continue
-                    self.known_expts[ts] = (expt, now)
+            # fetch LIMS records for the whole day in one query so that checkers read them from the cache
+            self.prefetch_lims([new_item[5] for new_item in new_expts if new_item[5] is not None])
 
-                # Add this expt to the queue to be checked
-                self.expt_queue.put((-ts, expt))
+            # Add these expts to the queue to be checked
+            for item in new_expts:
+                self.expt_queue.put(item)
+
+            if self.limit > 0 and count >= self.limit:
+                return
+
+        # watch the most recent folders for new or changed experiments
+        watch = [path]
+        for day_name in all_days[:self.watch_days]:
+            day_path = os.path.join(path, day_name)
+            watch.append(day_path)
+            watch.extend(glob.glob(os.path.join(day_path, 'slice_*')))
+            watch.extend(glob.glob(os.path.join(day_path, 'slice_*', 'site_*')))
+        self.watch.emit(watch)
 
-                count += 1
-                if self.limit > 0 and count >= self.limit:
-                    return
         self.update.emit(path, "Finished")
 
+    def check_site(self, expt_path):
+        """Return a queue item for the site at *expt_path*, or None if it does not need to be checked.
+        """
+        signature = site_signature(expt_path)
+        known = self.status_store.site(expt_path)
+        expt = None
+        if known is not None and known[0] == signature:
+            ts = known[1]
+            modified = False
+        else:
+            try:
+                expt = ExperimentMetadata(path=expt_path)
+                ts = expt.timestamp
+            except:
+                print ('Error loading %s, ignoring and moving on...' % expt_path)    
+                return None
+            # Couldn't get timestamp; show an error message
+            if ts is None:
+                print("Error getting timestamp for %s" % expt)
+                return None
+            self.status_store.set_site(expt_path, signature, ts)
+            modified = known is not None
+
+        with self.known_expts_lock:
+            now = time.time()
+            last_queued = self.known_expts.get(ts)
+            if not modified and last_queued is not None and now - last_queued < self.interval:
+                # We've already seen this expt recently; skip
+                return None
+            last_check = self.status_store.last_check(ts)
+            checked = None if last_check is None else last_check[0]
+            if not modified and last_check is not None and last_check[1] and now - checked < self.recheck_interval:
+                # Nothing has changed since the last check, and there is nothing left to do
+                return None
+            self.known_expts[ts] = now
+
+        # new and modified experiments are checked first
+        priority = 0 if (modified or checked is None) else 1
+        return queue_item(priority, ts, self.search_path, expt_path, expt)
+
+    def prefetch_lims(self, expts):
+        names = []
+        for expt in expts:
+            try:
+                names.append(expt.specimen_name)
+            except Exception:
+                continue
+        if len(names) == 0:
+            return
+        try:
+            lims.specimen_info_many(names)
+        except Exception:
+            # checkers will report LIMS errors for individual experiments
+            pass
+
 
 class ExptCheckerThread(QtCore.QThread):
+    """Pulls experiments off of the queue, checks their status, and saves the results to the status store.
+
+    *limiter* is shared by all checkers and limits the number of experiments from the same data
+    source that are checked at once.
+    """
     update = QtCore.Signal(object)
 
-    def __init__(self, expt_queue):
+    def __init__(self, expt_queue, limiter, status_store):
         QtCore.QThread.__init__(self)
         self.expt_queue = expt_queue
+        self.limiter = limiter
+        self.status_store = status_store
         self._stop = False
 
     def stop(self):
         self._stop = True
-        self.expt_queue.put(('stop', None))
+        self.expt_queue.put(queue_item(-1, 0, None, None))
 
     def run(self, block=True):
         while True:
-            ts, expt = self.expt_queue.get(block=block)
-            if self._stop or ts == 'stop':
+            try:
+                priority, neg_ts, _, source, site_path, expt = self.expt_queue.get(block=block)
+            except queue.Empty:
                 return
-            rec = expt.check()
+            if self._stop or site_path is None:
+                return
+            with self.limiter(source or site_path):
+                rec = self.check(site_path, expt)
+            rec.setdefault('timestamp', '%0.3f' % -neg_ts)
+            rec['site_path'] = site_path
+            try:
+                self.status_store.save_record(-neg_ts, site_path, rec)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
             self.update.emit(rec)
 
+    def check(self, site_path, expt):
+        if expt is None:
+            try:
+                expt = ExperimentMetadata(path=site_path)
+            except Exception:
+                return {'experiment': None, 'error': sys.exc_info()}
+        return expt.check()
+
 
 class ExperimentMetadata(Experiment):
     """Handles reading experiment metadata from several possible locations.
@@ -1,3 +1,4 @@
+import os, sys
 import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -11,6 +12,91 @@ from neuroanalysis.spike_detection import detect_evoked_spike
 from neuroanalysis import fitting
 from neuroanalysis.baseline import float_mode
 from neuroanalysis.stats import ragged_mean
+from ..trace_pyramid import TracePyramid, get_pyramid_cache
+
+
+class PyramidCurveItem(pg.PlotCurveItem):
+    """Curve that displays a TracePyramid, reading only as much of the pyramid as is needed
+    for the visible range and the width of the view.
+    """
+    def __init__(self, pyramid, **kwds):
+        self.pyramid = pyramid
+        self._last_query = None
+        pg.PlotCurveItem.__init__(self, **kwds)
+        t, y = pyramid.query(n_pixels=1000)
+        self.setData(t, y)
+
+    def viewRangeChanged(self):
+        vb = self.getViewBox()
+        if vb is None:
+            return
+        x0, x1 = vb.viewRange()[0]
+        query = (x0, x1, max(int(vb.width()), 1))
+        if query == self._last_query:
+            return
+        self._last_query = query
+        t, y = self.pyramid.query(*query)
+        self.setData(t, y)
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        # auto-range to the whole trace, not just the part that is currently loaded
+        if frac < 1.0 or orthoRange is not None:
+            return pg.PlotCurveItem.dataBounds(self, ax, frac, orthoRange)
+        if ax == 0:
+            return (self.pyramid.t0, self.pyramid.t_stop)
+        return self.pyramid.value_range()
+
+
+def sweep_pyramid(sweep, channel, trace):
+    """Return a TracePyramid for the raw *trace* recorded on *channel* of *sweep*, read from
+    the pyramid cache if possible.
+    """
+    data = trace.data
+    t0 = trace.time_values[0]
+    filename = getattr(getattr(sweep, '_nwb', None), 'filename', None)
+    sweep_id = getattr(sweep, 'key', None)
+    if filename is None or sweep_id is None or not os.path.isfile(filename):
+        return TracePyramid(data, trace.dt, t0=t0)
+    try:
+        return get_pyramid_cache().get(filename, (sweep_id, channel), data, trace.dt, t0=t0)
+    except (IOError, OSError):
+        return TracePyramid(data, trace.dt, t0=t0)
+
+
+class PairAnalysisWorker(QtCore.QThread):
+    """Detects pulses and spikes and filters the postsynaptic trace of each sweep in the
+    background, emitting results one sweep at a time.
+
+    If a sweep cannot be analyzed, the error is reported and None is emitted as its result so
+    that the remaining sweeps are still displayed.
+    """
+    sweep_ready = QtCore.Signal(object, object, object)  # generation, sweep index, result
+    all_ready = QtCore.Signal(object)  # generation
+
+    def __init__(self, generation, view, sweeps, pre, post):
+        QtCore.QThread.__init__(self)
+        self.generation = generation
+        self.view = view
+        self.sweeps = sweeps
+        self.pre = pre
+        self.post = post
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+
+    def run(self):
+        for i, sweep in enumerate(self.sweeps):
+            if self._stop:
+                return
+            try:
+                result = self.view.analyze_sweep(sweep, self.pre, self.post)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+                result = None
+            self.sweep_ready.emit(self.generation, i, result)
+        if not self._stop:
+            self.all_ready.emit(self.generation)
 
 
 class PairView(QtGui.QWidget):
@@ -23,6 +109,10 @@ class PairView(QtGui.QWidget):
         self.current_event_set = None
         self.event_sets = []
 
+        self.worker = None
+        self.generation = 0
+        self.sweep_results = []
+
         QtGui.QWidget.__init__(self, parent)
 
         self.layout = QtGui.QGridLayout()
@@ -103,12 +193,14 @@ class PairView(QtGui.QWidget):
 
     def _update_plots(self):
         sweeps = self.sweeps
+        self.stop_worker()
         self.current_event_set = None
         self.event_table.clear()
         
         # clear all plots
         self.pre_plot.clear()
         self.post_plot.clear()
+        self.response_plots.clear()
 
         pre = self.params['pre']
         post = self.params['post']
@@ -122,50 +214,94 @@ class PairView(QtGui.QWidget):
         for ch, mode, plot in [(pre, pre_mode, self.pre_plot), (post, post_mode, self.post_plot)]:
             units = 'A' if mode == 'vc' else 'V'
             plot.setLabels(left=("Channel %d" % ch, units), bottom=("Time", 's'))
+
+        # Pulse detection, filtering, and spike detection are done in a background thread;
+        # traces are plotted as each sweep is finished, and the average responses are
+        # analyzed once all sweeps are done.
+        self.generation += 1
+        self.sweep_results = [None] * len(sweeps)
+        self.worker = PairAnalysisWorker(self.generation, self, sweeps, pre, post)
+        self.worker.sweep_ready.connect(self._sweep_ready)
+        self.worker.all_ready.connect(self._all_sweeps_ready)
+        self.worker.start()
+
+    def stop_worker(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker.wait()
+            self.worker = None
+
+    def analyze_sweep(self, sweep, pre, post):
+        """Detect pulses and evoked spikes in *sweep*, filter the postsynaptic trace, and build
+        display pyramids for both traces.
+
+        This is called from a PairAnalysisWorker thread.
+        """
+        pre_trace = sweep[pre]['primary']
+        post_trace = sweep[post]['primary']
         
-        # Iterate over selected channels of all sweeps, plotting traces one at a time
-        # Collect information about pulses and spikes
-        pulses = []
-        spikes = []
-        post_traces = []
-        for i,sweep in enumerate(sweeps):
-            pre_trace = sweep[pre]['primary']
-            post_trace = sweep[post]['primary']
-            
-            # Detect pulse times
-            stim = sweep[pre]['command'].data
-            sdiff = np.diff(stim)
-            on_times = np.argwhere(sdiff > 0)[1:, 0]  # 1: skips test pulse
-            off_times = np.argwhere(sdiff < 0)[1:, 0]
-            pulses.append(on_times)
-
-            # filter data
-            post_filt = self.artifact_remover.process(post_trace, list(on_times) + list(off_times))
-            post_filt = self.baseline_remover.process(post_filt)
-            post_filt = self.filter.process(post_filt)
-            post_traces.append(post_filt)
-            
-            # plot raw data
-            color = pg.intColor(i, hues=len(sweeps)*1.3, sat=128)
-            color.setAlpha(128)
-            for trace, plot in [(pre_trace, self.pre_plot), (post_filt, self.post_plot)]:
-                plot.plot(trace.time_values, trace.data, pen=color, antialias=False)
-
-            # detect spike times
-            spike_inds = []
-            spike_info = []
-            for on, off in zip(on_times, off_times):
-                spike = detect_evoked_spike(sweep[pre], [on, off])
-                spike_info.append(spike)
-                if spike is None:
-                    spike_inds.append(None)
-                else:
-                    spike_inds.append(spike['rise_index'])
-            spikes.append(spike_info)
-                    
-            dt = pre_trace.dt
-            vticks = pg.VTickGroup([x * dt for x in spike_inds if x is not None], yrange=[0.0, 0.2], pen=color)
-            self.pre_plot.addItem(vticks)
+        # Detect pulse times
+        stim = sweep[pre]['command'].data
+        sdiff = np.diff(stim)
+        on_times = np.argwhere(sdiff > 0)[1:, 0]  # 1: skips test pulse
+        off_times = np.argwhere(sdiff < 0)[1:, 0]
+
+        # filter data
+        post_filt = self.artifact_remover.process(post_trace, list(on_times) + list(off_times))
+        post_filt = self.baseline_remover.process(post_filt)
+        post_filt = self.filter.process(post_filt)
+
+        # detect spike times
+        spike_info = []
+        for on, off in zip(on_times, off_times):
+            spike_info.append(detect_evoked_spike(sweep[pre], [on, off]))
+
+        return {
+            'pulses': on_times,
+            'spikes': spike_info,
+            'post_trace': post_filt,
+            'dt': pre_trace.dt,
+            'pre_pyramid': sweep_pyramid(sweep, pre, pre_trace),
+            'post_pyramid': TracePyramid(post_filt.data, post_filt.dt, t0=post_filt.time_values[0]),
+        }
+
+    def _sweep_ready(self, generation, i, result):
+        if generation != self.generation:
+            return
+        self.sweep_results[i] = result
+        if result is None:
+            return
+
+        # plot raw data
+        color = pg.intColor(i, hues=len(self.sweep_results)*1.3, sat=128)
+        color.setAlpha(128)
+        for pyramid, plot in [(result['pre_pyramid'], self.pre_plot), (result['post_pyramid'], self.post_plot)]:
+            plot.addItem(PyramidCurveItem(pyramid, pen=color, antialias=False))
+
+        dt = result['dt']
+        spike_inds = [sp['rise_index'] for sp in result['spikes'] if sp is not None]
+        vticks = pg.VTickGroup([x * dt for x in spike_inds], yrange=[0.0, 0.2], pen=color)
+        self.pre_plot.addItem(vticks)
+
+    def _all_sweeps_ready(self, generation):
+        if generation != self.generation:
+            return
+        self._update_responses()
+
+    def _update_responses(self):
+        sweeps = self.sweeps
+        pre = self.params['pre']
+        post = self.params['post']
+        post_mode = sweeps[0][post].clamp_mode
+
+        # sweeps that failed to analyze were reported by the worker; skip them here
+        results = [r for r in self.sweep_results if r is not None]
+        if len(results) == 0:
+            return
+        pulses = [r['pulses'] for r in results]
+        spikes = [r['spikes'] for r in results]
+        post_traces = [r['post_trace'] for r in results]
+        dt = results[-1]['dt']
 
         # Iterate over spikes, plotting average response
         all_responses = []
@@ -174,7 +310,6 @@ class PairView(QtGui.QWidget):
         fit = None
         
         npulses = max(map(len, pulses))
-        self.response_plots.clear()
         self.response_plots.set_shape(1, npulses+1) # 1 extra for global average
         self.response_plots.setYLink(self.response_plots[0,0])
         for i in range(1, npulses+1):
@@ -187,7 +322,7 @@ class PairView(QtGui.QWidget):
             # get the chunk of each sweep between spikes
             responses = []
             all_responses.append(responses)
-            for j, sweep in enumerate(sweeps):
+            for j in range(len(results)):
                 # get the current spike
                 if i >= len(spikes[j]):
                     continue
@@ -5,6 +5,145 @@ import numpy as np
 import scipy.ndimage as ndimage
 
 
+class TrialFrames(object):
+    """Camera frames recorded in one trial, read on demand from a frames.ma file.
+
+    The file is opened without reading its data (HDF5 files are read through h5py, older
+    MetaArray files are memory-mapped), so only the frames and pixels requested with read()
+    are loaded. Frame indices are relative to the start set by crop().
+    """
+    def __init__(self, file_handle):
+        self.file_handle = file_handle
+        self._array = None
+        self.start = 0
+        self.n_frames = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = self.file_handle.read(readAllData=False, mmap=True)
+        return self._array
+
+    @property
+    def time_values(self):
+        return self.array.xvals('Time')
+
+    @property
+    def frame_shape(self):
+        return self.array._data.shape[1:]
+
+    def crop(self, t_start, t_stop):
+        """Limit frames to those recorded from *t_start* up to (not including) *t_stop*.
+        """
+        tvals = self.time_values
+        self.start = np.searchsorted(tvals, t_start)
+        self.n_frames = np.searchsorted(tvals, t_stop) - self.start
+
+    def read(self, start, stop, x=slice(None), y=slice(None)):
+        """Return frames *start* to *stop*, cropped to the pixel ranges *x* and *y*.
+        """
+        return np.asarray(self.array._data[self.start+start:self.start+stop, x, y])
+
+
+class DifferenceFrames(object):
+    """Frame-by-frame difference between two trials (see TrialFrames).
+    """
+    def __init__(self, trial1, trial2):
+        self.trials = (trial1, trial2)
+
+    @property
+    def time_values(self):
+        return self.trials[0].time_values
+
+    @property
+    def frame_shape(self):
+        return self.trials[0].frame_shape
+
+    @property
+    def start(self):
+        return self.trials[0].start
+
+    @property
+    def n_frames(self):
+        return min([t.n_frames for t in self.trials])
+
+    def crop(self, t_start, t_stop):
+        for t in self.trials:
+            t.crop(t_start, t_stop)
+
+    def read(self, start, stop, x=slice(None), y=slice(None)):
+        return self.trials[0].read(start, stop, x, y).astype('float') - self.trials[1].read(start, stop, x, y)
+
+
+class ImageSequence(object):
+    """Camera frames for all trials of a task sequence, organized as one row of trials per
+    value of the first sequence parameter.
+
+    Trials that end before *min_duration* are dropped, and the rest are cropped to
+    *t_start*..*t_stop* and to the same number of frames. Only file metadata is read until
+    frames are requested.
+    """
+    def __init__(self, rows, t_start=0, t_stop=200e-3, min_duration=150e-3):
+        # cull out truncated recordings :(
+        rows = [[t for t in row if t.time_values[-1] > min_duration] for row in rows]
+        for row in rows:
+            for t in row:
+                t.crop(t_start, t_stop)
+
+        # crop
+        self.n_frames = min([min([t.n_frames for t in row]) for row in rows])
+        self.rows = rows
+        first = rows[0][0]
+        self.time_values = first.time_values[first.start:first.start+self.n_frames]
+        self.frame_shape = first.frame_shape
+
+    def roi_traces(self, row, x, y):
+        """Return an array (trials, frames) with the mean of pixels *x*, *y* in each frame of each trial in *row*.
+        """
+        return np.array([t.read(0, self.n_frames, x, y).mean(axis=(1, 2)) for t in self.rows[row]])
+
+    def window_mean(self, row, start, stop):
+        """Return the mean image over frames *start* to *stop* of all trials in *row*.
+        """
+        return np.mean([t.read(start, stop).mean(axis=0) for t in self.rows[row]], axis=0)
+
+    def trial_dff(self, row, trial, base, test, signal_rgn, background_rgn):
+        """Return the change in fluorescence of one trial between the *base* and *test* frame
+        ranges, measured in *signal_rgn* relative to *background_rgn* (both (x, y) pixel slices).
+        """
+        t = self.rows[row][trial]
+        baseline1 = t.read(base[0], base[1], *signal_rgn).mean()
+        signal1 = t.read(test[0], test[1], *signal_rgn).mean()
+        baseline2 = t.read(base[0], base[1], *background_rgn).mean()
+        signal2 = t.read(test[0], test[1], *background_rgn).mean()
+        return ((signal1-signal2) - (baseline1-baseline2)) / (baseline1-baseline2)
+
+
+class DffWorker(QtCore.QThread):
+    """Computes the dF/F of every trial in an ImageSequence in the background, emitting each
+    result as soon as it is available.
+    """
+    new_result = QtCore.Signal(object, object, object, object)  # generation, row, trial, dff
+
+    def __init__(self, generation, sequence, base, test, signal_rgn, background_rgn):
+        QtCore.QThread.__init__(self)
+        self.generation = generation
+        self.sequence = sequence
+        self.args = (base, test, signal_rgn, background_rgn)
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+
+    def run(self):
+        for i, row in enumerate(self.sequence.rows):
+            for j in range(len(row)):
+                if self._stop:
+                    return
+                dff = self.sequence.trial_dff(i, j, *self.args)
+                self.new_result.emit(self.generation, i, j, dff)
+
+
 class VImagingAnalyzer(QtGui.QWidget):
     def __init__(self):
         QtGui.QWidget.__init__(self)
@@ -53,6 +192,14 @@ class VImagingAnalyzer(QtGui.QWidget):
         
         self.plt3 = self.gw.addPlot(row=4, col=0)
         self.plt3.setLabels(left="dF / F", bottom="trial")
+
+        self.sequence = None
+        self.dff_worker = None
+        self.dff_generation = 0
+        self.dff_results = []
+        self.dff_plot_timer = QtCore.QTimer()
+        self.dff_plot_timer.setSingleShot(True)
+        self.dff_plot_timer.timeout.connect(self.plot_sequence_analysis)
         
         self.show()
 
@@ -63,22 +210,24 @@ class VImagingAnalyzer(QtGui.QWidget):
     def _load_data(self, seqDir):
         man = getManager()
         model = man.dataModel
+        self.stop_dff_worker()
 
-        # read all image data
-        self.img_data = model.buildSequenceArray(
+        # open image data; frames are read only as they are needed
+        img_files = model.buildSequenceArray(
             seqDir, 
-            lambda dh: dh['Camera']['frames.ma'].read(),
+            lambda dh: TrialFrames(dh['Camera']['frames.ma']),
             join=False).asarray()
         seqParams = list(model.listSequenceParams(seqDir).items())
-        if self.img_data.ndim == 1:
-            self.img_data = self.img_data[np.newaxis, :]
+        if img_files.ndim == 1:
+            img_files = img_files[np.newaxis, :]
             seqParams.insert(0, (None, [0]))
 
         transpose = seqParams[0][0] == ('protocol', 'repetitions')
         if transpose:
-            self.img_data = np.swapaxes(self.img_data, 0, 1)
+            img_files = np.swapaxes(img_files, 0, 1)
             seqParams = seqParams[::-1]
         self.seqParams = seqParams
+        rows = [list(row) for row in img_files]
 
         if seqParams[0][0] is None:
             self.seqColors = [pg.mkColor('w')]
@@ -88,27 +237,11 @@ class VImagingAnalyzer(QtGui.QWidget):
                 # Special case: add in difference between two sequence trials
                 seqParams[0] = (seqParams[0][0], list(seqParams[0][1]) + [np.mean(seqParams[0][1])])
                 nSeq = 3
-                img_data = np.empty((3,) + self.img_data.shape[1:], dtype=self.img_data.dtype)
-                img_data[:2] = self.img_data
-                for i in range(img_data.shape[1]):
-                    minlen = min(self.img_data[0,i].shape[0], self.img_data[1,i].shape[0])
-                    img_data[2,i] = self.img_data[0,i][:minlen].copy()
-                    img_data[2,i]._data = self.img_data[0,i][:minlen].asarray().astype('float') - self.img_data[1,i][:minlen].asarray()
-                self.img_data = img_data
-                
+                rows.append([DifferenceFrames(t1, t2) for t1, t2 in zip(rows[0], rows[1])])
                 
             self.seqColors = [pg.intColor(i, nSeq*1.6) for i in range(nSeq)]
 
-        # cull out truncated recordings :(
-        self.img_data = [[d['Time':0:200e-3] for d in row if d.xvals('Time')[-1] > 150e-3] for row in self.img_data]
-
-        # crop / concatenate
-        img_len = min([min([d.shape[0] for d in row]) for row in self.img_data])
-        self.img_data = [[d[:img_len] for d in row] for row in self.img_data]
-        self.img_arrays = [np.concatenate([d.asarray()[np.newaxis, ...] for d in row], axis=0) for row in self.img_data]
-
-        # average
-        self.img_mean = [img_arr.mean(axis=0) for img_arr in self.img_arrays]
+        self.sequence = ImageSequence(rows)
 
         for p in self.clamp_plots:
             self.plt2.removeItem(p)
@@ -145,13 +278,13 @@ class VImagingAnalyzer(QtGui.QWidget):
             self.clamp_mode = None
             self.plt2.hide()
 
-        self.img_t = self.img_data[0][0].xvals('Time')
+        self.img_t = self.sequence.time_values
 
-        self.img1.setImage(self.img_mean[-1].mean(axis=0))
+        # show the mean baseline image of the last row; this only reads frames in the baseline region
+        self.time_rgn_changed(None)
+        self.img1.setImage(self.base_img)
 
         self.roi_changed(None)
-        self.time_rgn_changed(None)
-        self.update_sequence_analysis()
 
     def roi_changed(self, roi):
         if self.ignore_roi_change:
@@ -176,19 +309,24 @@ class VImagingAnalyzer(QtGui.QWidget):
             self.plt1.removeItem(item)
 
         
-        for i, img_data in enumerate(self.img_arrays):
+        if self.sequence is None:
+            return
+
+        # read only the pixels inside each ROI
+        rgn1 = self.roi_region(roi1)
+        rgn2 = self.roi_region(roi2)
+        n_rows = len(self.sequence.rows)
+        for i in range(n_rows):
             color = self.seqColors[i]
             color2 = pg.mkColor(color)
             color2.setAlpha(40)
 
-            rgn1 = roi1.getArrayRegion(img_data, self.img1, axes=(2, 3)).mean(axis=2).mean(axis=2)
-            rgn2 = roi2.getArrayRegion(img_data, self.img1, axes=(2, 3)).mean(axis=2).mean(axis=2)
-            dif = rgn1 - rgn2
+            dif = self.sequence.roi_traces(i, *rgn1) - self.sequence.roi_traces(i, *rgn2)
             
             difmean = dif.mean(axis=0)
             baseline = np.median(difmean[:10])
             # plot individual examples only for last parameter
-            if i == len(self.img_arrays)-1:
+            if i == n_rows-1:
                 for j in range(dif.shape[0]):
                     offset = baseline - np.median(dif[j, :10])
                     self.plt1_items.append(self.plt1.plot(self.img_t, dif[j] + offset, pen=color2, antialias=True))
@@ -198,16 +336,28 @@ class VImagingAnalyzer(QtGui.QWidget):
             
         self.update_sequence_analysis()
         
+    def roi_region(self, roi):
+        """Return (x, y) slices covering the image pixels inside the bounding box of *roi*.
+        """
+        rect = roi.mapRectToItem(self.img1, roi.boundingRect())
+        slices = []
+        for start, stop, size in [(rect.left(), rect.right(), self.sequence.frame_shape[0]),
+                                  (rect.top(), rect.bottom(), self.sequence.frame_shape[1])]:
+            start = int(np.clip(np.floor(start), 0, size-1))
+            stop = int(np.clip(np.ceil(stop), start+1, size))
+            slices.append(slice(start, stop))
+        return tuple(slices)
+
     def time_rgn_changed(self, rgn):
-        img_data = self.img_arrays[-1]
-        img_t = self.img_data[-1][0].xvals('Time')
-        
-        base_starti, base_stopi, test_starti, test_stopi = self.time_indices(img_t)
+        if self.sequence is None:
+            return
+        base_starti, base_stopi, test_starti, test_stopi = self.time_indices(self.img_t)
 
-        base = img_data[:, base_starti:base_stopi].mean(axis=0).mean(axis=0)
-        test = img_data[:, test_starti:test_stopi].mean(axis=0).mean(axis=0)
+        # only frames inside the time regions are read
+        self.base_img = self.sequence.window_mean(-1, base_starti, base_stopi)
+        test = self.sequence.window_mean(-1, test_starti, test_stopi)
 
-        dff = ndimage.median_filter(test - base, 10)
+        dff = ndimage.median_filter(test - self.base_img, 10)
         self.img2.setImage(dff)
 
     def time_indices(self, time_vals):
@@ -222,38 +372,49 @@ class VImagingAnalyzer(QtGui.QWidget):
         return base_starti, base_stopi, test_starti, test_stopi
 
     def update_sequence_analysis(self):
+        """Start computing the dF/F of each trial in the background; the plot is updated as results arrive.
+        """
+        if self.sequence is None:
+            return
+        self.stop_dff_worker()
+
+        base_starti, base_stopi, test_starti, test_stopi = self.time_indices(self.img_t)
+        roi1, roi2 = self.rois   # roi1 is signal, roi2 is background
+
+        # Use the temporal profile in roi2 in order to remove changes in LED brightness over time
+        # Then use the difference between baseline and test time regions to determine change in fluorescence
+        self.dff_generation += 1
+        self.dff_results = [[None] * len(row) for row in self.sequence.rows]
+        self.dff_worker = DffWorker(self.dff_generation, self.sequence, (base_starti, base_stopi),
+                                    (test_starti, test_stopi), self.roi_region(roi1), self.roi_region(roi2))
+        self.dff_worker.new_result.connect(self.dff_result_ready)
+        self.dff_worker.start()
+
+    def stop_dff_worker(self):
+        if self.dff_worker is not None:
+            self.dff_worker.stop()
+            self.dff_worker.wait()
+            self.dff_worker = None
+
+    def dff_result_ready(self, generation, row, trial, dff):
+        if generation != self.dff_generation:
+            # result from a worker that has since been replaced
+            return
+        self.dff_results[row][trial] = dff
+        if not self.dff_plot_timer.isActive():
+            self.dff_plot_timer.start(200)
+
+    def plot_sequence_analysis(self):
         xvals = []
         yvals = []
         brushes = []
         avg_x = []
         avg_y = []
 
-        noise_values = []
-
-        for i in range(len(self.img_data)):
-
-            img_data = self.img_arrays[i]
-            img_t = self.img_data[i][0].xvals('Time')
-            base_starti, base_stopi, test_starti, test_stopi = self.time_indices(img_t)
-            
-            base = img_data[:, base_starti:base_stopi]
-            base_mean = base.mean(axis=1)
-            test = img_data[:, test_starti:test_stopi]
-            test_mean = test.mean(axis=1)
-            
-            roi1, roi2 = self.rois   # roi1 is signal, roi2 is background
-            base_rgn1 = roi1.getArrayRegion(base_mean, self.img1, axes=(1, 2))
-            base_rgn2 = roi2.getArrayRegion(base_mean, self.img1, axes=(1, 2))
-            test_rgn1 = roi1.getArrayRegion(test_mean, self.img1, axes=(1, 2))
-            test_rgn2 = roi2.getArrayRegion(test_mean, self.img1, axes=(1, 2))
-
-            # Use the temporal profile in roi2 in order to remove changes in LED brightness over time
-            # Then use the difference between baseline and test time regions to determine change in fluorescence
-            baseline1 = base_rgn1.mean(axis=1).mean(axis=1)
-            signal1 = test_rgn1.mean(axis=1).mean(axis=1)
-            baseline2 = base_rgn2.mean(axis=1).mean(axis=1)
-            signal2 = test_rgn2.mean(axis=1).mean(axis=1)
-            dff = ((signal1-signal2) - (baseline1-baseline2)) / (baseline1-baseline2)
+        for i, results in enumerate(self.dff_results):
+            dff = np.array([r for r in results if r is not None])
+            if len(dff) == 0:
+                continue
 
             x = self.seqParams[0][1][i]
             xvals.extend([x] * len(dff))
@@ -272,9 +433,9 @@ class VImagingAnalyzer(QtGui.QWidget):
             self.plt3.plot(avg_x, avg_y, pen='w', antialias=True)
     
     def closeEvent(self, ev):
-        self.img_data = None
-        self.img_arrays = None
-        self.img_mean = None
+        self.stop_dff_worker()
+        self.sequence = None
+        self.base_img = None
         self.clamp_data = None
         self.clamp_mode = None
 
@@ -1,5 +1,5 @@
 from __future__ import print_function
-import os, sys, time, datetime, logging.handlers, re
+import os, sys, time, datetime, logging.handlers, re, json, hashlib, threading, sqlite3
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -14,7 +14,8 @@ def datetime_to_timestamp(d):
     return time.mktime(d.timetuple()) + d.microsecond * 1e-6
 
 
-def sync_dir(source_path, dest_path, test=False, log_file=None, depth=0, archive_deleted=False):
+def sync_dir(source_path, dest_path, test=False, log_file=None, depth=0, archive_deleted=False, workers=1, use_manifest=True,
+             signatures=None, max_signature_age=7*24*3600):
     """Safely duplicate a directory structure
     
     All files/folders are recursively synchronized from source_path to dest_path.
@@ -35,12 +36,28 @@ def sync_dir(source_path, dest_path, test=False, log_file=None, depth=0, archive
     archive_deleted : bool
         If True, then files that have been deleted from the source path will be archived in the 
         destination path. If False, then such files are simply left in place.
+    workers : int
+        Number of threads used to copy each large file (see transfer_file).
+    use_manifest : bool
+        If True, each destination folder keeps a manifest of the source files it was last
+        synchronized from (see read_sync_manifest). Files whose size and modification time
+        match the manifest are skipped without touching the destination, which avoids one
+        stat per file on slow network shares. Set to False to compare every file directly
+        (for example, if the destination may have been modified by something else).
+    signatures : SyncSignatureStore | None
+        If given, the signature of each source folder (see dir_signature) is recorded after it
+        is synchronized. Folders whose signature has not changed since then are not listed
+        again; only their recorded subfolders are visited. Files that are modified in place
+        without changing their folder are therefore only found once the recorded signature is
+        older than *max_signature_age* seconds.
     """
     log_handler = None
     if log_file is not None and test is False:
         log_file = os.path.abspath(log_file)
         log_handler = logging.handlers.TimedRotatingFileHandler(log_file, when='W0', backupCount=50)
         log_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        # only log messages from this sync, in case several are running in other threads
+        log_handler.addFilter(ThreadLogFilter())
         logger.addHandler(log_handler)
         log_handler.setLevel(logging.INFO)
     
@@ -55,18 +72,53 @@ def sync_dir(source_path, dest_path, test=False, log_file=None, depth=0, archive
             mkdir(dest_path, test=test)
             assert os.path.isdir(dest_path), 'Destination path "%s" does not exist.' % dest_path
 
-        for child in os.listdir(source_path):
+        if signatures is not None:
+            # read the signature before listing, so that changes made during the sync are found next time
+            signature = dir_signature(source_path)
+            rec = signatures.get(source_path)
+            if rec is not None and rec[0] == signature and time.time() - rec[2] < max_signature_age and os.path.isdir(dest_path):
+                logger.debug("skip folder (unchanged since last sync): %s => %s", source_path, dest_path)
+                for child in rec[1]:
+                    sync_dir(os.path.join(source_path, child), os.path.join(dest_path, child), test=test, depth=depth+1,
+                             archive_deleted=archive_deleted, workers=workers, use_manifest=use_manifest,
+                             signatures=signatures, max_signature_age=max_signature_age)
+                return
+
+        manifest = read_sync_manifest(dest_path) if use_manifest else None
+        recorded = {} if manifest is None else manifest['files']
+        files = {}
+        dirs = []
+        children = [child for child in os.listdir(source_path) if child != sync_manifest_name]
+        for child in children:
             src_name = os.path.join(source_path, child)
             dst_name = os.path.join(dest_path, child)
             if os.path.isdir(src_name):
-                sync_dir(src_name, dst_name, test=test, depth=depth+1, archive_deleted=archive_deleted)
-            else:
-                sync_file(src_name, dst_name, test=test)
+                dirs.append(child)
+                sync_dir(src_name, dst_name, test=test, depth=depth+1, archive_deleted=archive_deleted,
+                         workers=workers, use_manifest=use_manifest, signatures=signatures,
+                         max_signature_age=max_signature_age)
+                continue
+
+            src_stat = os.stat(src_name)
+            entry = [src_stat.st_size, src_stat.st_mtime, None]
+            rec = recorded.get(child)
+            if rec is not None and rec[:2] == entry[:2]:
+                logger.debug("skip file (unchanged since last sync): %s => %s", src_name, dst_name)
+                files[child] = rec
+                continue
+            status, entry[2] = sync_file(src_name, dst_name, test=test, workers=workers, return_digest=True)
+            files[child] = entry
 
         # check for deleted files
         if archive_deleted:
-            for child in os.listdir(dest_path):
-                src_name = os.path.join(source_path, child)
+            if manifest is None:
+                candidates = os.listdir(dest_path) if os.path.isdir(dest_path) else []
+            else:
+                # anything not synced from the source was already checked when the manifest was written
+                candidates = [child for child in list(recorded.keys()) + manifest['dirs']
+                              if os.path.exists(os.path.join(dest_path, child))]
+            children = set(children)
+            for child in candidates:
                 dst_name = os.path.join(dest_path, child)
                 
                 # log files are expected to exist only in destination 
@@ -76,9 +128,19 @@ def sync_dir(source_path, dest_path, test=False, log_file=None, depth=0, archive
                 # don't compare archived versions
                 if archived_filename(dst_name) is not None:
                     continue
+
+                # incomplete copies are resumed on the next sync
+                if is_partial_file(dst_name) or child.startswith(sync_manifest_name):
+                    continue
                     
-                if not os.path.exists(src_name):
+                if child not in children:
                     archive_file(dst_name, test=test)
+
+        new_manifest = {'files': files, 'dirs': sorted(dirs)}
+        if use_manifest and test is False and new_manifest != manifest:
+            write_sync_manifest(dest_path, new_manifest)
+        if signatures is not None and test is False:
+            signatures.set(source_path, signature, sorted(dirs))
     
     except BaseException as exc:
         logger.error("Error during sync_dir(%s, %s): %s", source_path, dest_path, str(exc))
@@ -90,9 +152,138 @@ def sync_dir(source_path, dest_path, test=False, log_file=None, depth=0, archive
             logger.removeHandler(log_handler)
 
 
-def sync_file(src, dst, test=False):
+sync_manifest_name = '.sync_manifest'
+
+
+def read_sync_manifest(path):
+    """Return the manifest written by write_sync_manifest() to the directory *path*, or None
+    if there is no (readable) manifest.
+
+    A manifest is a dict with keys 'files' (mapping each file name to [size, mtime, digest] of
+    the source file it was last synchronized from; digest is the value returned by transfer_file,
+    or None if the file was not copied), 'dirs' (list of synchronized subdirectory names), and
+    any other keys added by the caller.
+    """
+    filename = os.path.join(path, sync_manifest_name)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        manifest = json.load(open(filename, 'r'))
+    except ValueError:
+        logger.warning("ignoring unreadable sync manifest: %s", filename)
+        return None
+    manifest.setdefault('files', {})
+    manifest.setdefault('dirs', [])
+    return manifest
+
+
+def write_sync_manifest(path, manifest):
+    """Atomically write a sync manifest to the directory *path* (see read_sync_manifest).
+    """
+    filename = os.path.join(path, sync_manifest_name)
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as fh:
+        json.dump(manifest, fh)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_file, filename)
+
+
+def dir_signature(path):
+    """Return a value that changes when files or folders are added to, removed from, or renamed
+    in the folder *path*: the modification times of the folder and of its ACQ4 .index file (which
+    is rewritten whenever data or metadata in the folder are saved).
+
+    Only the folder itself is stat'ed, not its contents.
+    """
+    index_file = os.path.join(path, '.index')
+    return [os.path.getmtime(path), os.path.getmtime(index_file) if os.path.exists(index_file) else None]
+
+
+class SyncSignatureStore(object):
+    """Records the signature (see dir_signature) and subfolders of each source folder at the time
+    it was last synchronized, so that unchanged folders can be skipped without listing them.
+
+    Signatures are kept in an SQLite file on the machine running the sync, so checking a folder
+    only requires stat'ing the source. A single store may be shared between threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._db.execute("""
+                create table if not exists sync_signatures (
+                    path text primary key, signature text, subdirs text, time real
+                )""")
+            self._db.commit()
+
+    def get(self, path):
+        """Return (signature, subdirs, time) recorded for *path*, or None.
+        """
+        with self._lock:
+            row = self._db.execute("select signature, subdirs, time from sync_signatures where path=?", (path,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+
+    def set(self, path, signature, subdirs):
+        with self._lock:
+            self._db.execute("insert or replace into sync_signatures (path, signature, subdirs, time) values (?, ?, ?, ?)",
+                             (path, json.dumps(signature), json.dumps(list(subdirs)), time.time()))
+            self._db.commit()
+
+
+class ThreadLogFilter(logging.Filter):
+    """Logging filter that accepts only records emitted by the thread that created it.
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.thread = threading.current_thread().ident
+
+    def filter(self, record):
+        return record.thread == self.thread
+
+
+class DestinationLimiter(object):
+    """Limits the number of concurrent operations writing to the same destination.
+
+    Use as ``with limiter(dest): ...``; at most *limit* threads may be inside the block for
+    destinations that map to the same key. By default the key is the drive (or the first path
+    component on systems without drive letters) of the destination path.
+    """
+    def __init__(self, limit, key=None):
+        self.limit = limit
+        self.key = key or self.default_key
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    @staticmethod
+    def default_key(dest):
+        drive, path = os.path.splitdrive(os.path.abspath(dest))
+        if drive != '':
+            return drive.lower()
+        parts = path.strip(os.sep).split(os.sep)
+        return os.sep + parts[0]
+
+    def __call__(self, dest):
+        key = self.key(dest)
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.Semaphore(self.limit)
+            return self._semaphores[key]
+
+
+def sync_file(src, dst, test=False, workers=1, return_digest=False):
     """Safely copy *src* to *dst*, but only if *src* is newer or a different size.
+
+    See transfer_file() for a description of *workers*.
+
+    Return "skip", "update", or "copy". If *return_digest* is True, return a tuple
+    (status, digest) instead, where digest is the transfer_file() digest of the copied
+    file, or None if no copy was made.
     """
+    digest = None
     if os.path.isfile(dst):
         src_stat = os.stat(src)
         dst_stat = os.stat(dst)
@@ -100,44 +291,47 @@ def sync_file(src, dst, test=False):
         
         if up_to_date:
             logger.debug("skip file: %s => %s", src, dst)
-            return "skip"
-        
-        safe_copy(src, dst, test=test)
-        logger.info("update file: %s => %s", src, dst)
-        return "update"
+            status = "skip"
+        else:
+            digest = safe_copy(src, dst, test=test, workers=workers)
+            logger.info("update file: %s => %s", src, dst)
+            status = "update"
     else:
-        safe_copy(src, dst, test=test)
+        digest = safe_copy(src, dst, test=test, workers=workers)
         logger.info("copy file: %s => %s", src, dst)
-        return "copy"
+        status = "copy"
+
+    if return_digest:
+        return status, digest
+    return status
 
 
-def safe_copy(src, dst, test=False):
+def safe_copy(src, dst, test=False, workers=1):
     """Copy a file, but rename the destination file if it already exists.
     
     Also, the destination file is suffixed ".partial" until the copy is complete.
+    If the copy is interrupted, the partial file is kept and the next attempt
+    resumes from where it left off (see transfer_file()).
+
+    Return the digest of the copied file, or None if *test* is True.
     """
     tmp_dst = dst + '.partial'
+    digest = None
     try:
         new_name = None
-        if os.path.exists(tmp_dst):
-            if test is False:
-                os.remove(tmp_dst)
         if test is False:
-            chunk_copy(src, tmp_dst)
+            digest = transfer_file(src, tmp_dst, workers=workers)
         if os.path.exists(dst):
             new_name = archive_file(dst, test=test)
         if test is False:
             os.rename(tmp_dst, dst)
+        return digest
     except Exception:
         # Move dst file back if there was a problem during copy
         if test is False and new_name is not None and os.path.exists(new_name):
             os.rename(new_name, dst)
         logger.error("error copying file: %s => %s", src, dst)
         raise
-    finally:
-        # remove temporary file if needed
-        if test is False and os.path.isfile(tmp_dst):
-            os.remove(tmp_dst)
 
 
 archive_filename_format = '%Y-%m-%d_%H-%M-%S'
@@ -232,6 +426,146 @@ def chunk_copy(src, dst, chunk_size=100e6):
         raise
 
 
+def is_partial_file(filename):
+    """Return True if *filename* is an incomplete copy (or its block list) left by transfer_file().
+    """
+    return filename.endswith('.partial') or filename.endswith('.partial.blocks')
+
+
+def transfer_file(src, dst, block_size=64e6, workers=1, parallel_threshold=1e9, resume=True):
+    """Copy *src* to *dst* in blocks, with resume and integrity checking.
+
+    A SHA-1 digest is computed for each block as it is copied, and the digests of all completed
+    blocks are recorded in ``dst + '.blocks'``. If the transfer is interrupted, calling this
+    function again (with *resume* True) verifies the blocks already in *dst* against their
+    recorded digests and copies only the missing or corrupted blocks. A partial copy is discarded
+    if the size or modification time of *src* has changed since it was started.
+
+    Files larger than *parallel_threshold* bytes are copied by *workers* threads, each reading
+    and writing different block ranges; this is much faster than a single stream when *src* or
+    *dst* is on a high-latency network share.
+
+    Once all blocks are copied, *dst* is read back and each block is compared with the digest
+    of the source data that was written to it. Blocks that do not match are dropped from the
+    block list (so that the next attempt copies them again) and an IOError is raised. Returns the
+    file digest (SHA-1 of the concatenated block digests) as a hex string.
+    """
+    block_size = int(block_size)
+    blocks_file = dst + '.blocks'
+    src_stat = os.stat(src)
+    size = src_stat.st_size
+    n_blocks = max(1, (size + block_size - 1) // block_size)
+    header = {'src_size': size, 'src_mtime': src_stat.st_mtime, 'block_size': block_size}
+
+    # decide which blocks still need to be copied
+    digests = {}
+    if resume and os.path.isfile(dst) and os.path.isfile(blocks_file):
+        try:
+            state = json.load(open(blocks_file, 'r'))
+        except ValueError:
+            state = None
+        if state is not None and state['header'] == header:
+            recorded = {int(k): v for k, v in state['blocks'].items()}
+            with open(dst, 'rb') as fh:
+                for i, digest in recorded.items():
+                    fh.seek(i * block_size)
+                    if hashlib.sha1(fh.read(block_size)).hexdigest() == digest:
+                        digests[i] = digest
+            logger.info("resume file: %s => %s (%d/%d blocks verified)", src, dst, len(digests), n_blocks)
+    if len(digests) == 0:
+        for f in (dst, blocks_file):
+            if os.path.exists(f):
+                os.remove(f)
+        with open(dst, 'wb') as fh:
+            fh.truncate(size)
+    todo = [i for i in range(n_blocks) if i not in digests]
+
+    lock = threading.Lock()
+    start = time.time()
+    errors = []
+
+    def save_state():
+        tmp_file = blocks_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump({'header': header, 'blocks': digests}, fh)
+        if os.path.exists(blocks_file):
+            os.remove(blocks_file)
+        os.rename(tmp_file, blocks_file)
+
+    def copy_blocks(blocks):
+        try:
+            with open(src, 'rb') as src_fh:
+                with open(dst, 'r+b') as dst_fh:
+                    for i in blocks:
+                        src_fh.seek(i * block_size)
+                        data = src_fh.read(block_size)
+                        dst_fh.seek(i * block_size)
+                        dst_fh.write(data)
+                        dst_fh.flush()
+                        digest = hashlib.sha1(data).hexdigest()
+                        with lock:
+                            digests[i] = digest
+                            save_state()
+        except Exception:
+            errors.append(sys.exc_info())
+
+    def verify_blocks(blocks):
+        try:
+            with open(dst, 'rb') as dst_fh:
+                for i in blocks:
+                    dst_fh.seek(i * block_size)
+                    if hashlib.sha1(dst_fh.read(block_size)).hexdigest() != digests[i]:
+                        with lock:
+                            bad_blocks.append(i)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    def run(fn, blocks):
+        if workers > 1 and size > parallel_threshold and len(blocks) > 1:
+            # interleave block assignments so that all threads progress through the file together
+            threads = [threading.Thread(target=fn, args=(blocks[i::workers],)) for i in range(workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        else:
+            fn(blocks)
+        if len(errors) > 0:
+            reraise(errors[0])
+
+    run(copy_blocks, todo)
+
+    # read back the copied blocks to make sure they were written correctly
+    bad_blocks = []
+    run(verify_blocks, todo)
+    if len(bad_blocks) > 0:
+        for i in bad_blocks:
+            del digests[i]
+        save_state()
+        raise IOError("Verification failed for %d blocks copied from %s to %s" % (len(bad_blocks), src, dst))
+
+    if os.stat(src).st_mtime != src_stat.st_mtime or os.path.getsize(dst) != size:
+        raise Exception("Source file %s changed during copy" % src)
+
+    file_digest = hashlib.sha1(''.join([digests[i] for i in range(n_blocks)]).encode('ascii')).hexdigest()
+    os.remove(blocks_file)
+
+    dt = time.time() - start
+    copied = min(len(todo) * block_size, size)
+    logger.info("transferred %s: %0.1f MB in %0.1f s (%0.1f MB/s, %d workers)", src, copied / 1e6, dt,
+                copied / 1e6 / max(dt, 1e-6), workers if size > parallel_threshold else 1)
+    return file_digest
+
+
+def reraise(exc_info):
+    """Raise the exception described by *exc_info* (as returned by sys.exc_info()) with its
+    original traceback.
+    """
+    if sys.version_info[0] >= 3:
+        raise exc_info[1].with_traceback(exc_info[2])
+    exec("raise exc_info[0], exc_info[1], exc_info[2]")
+
+
 def mkdir(path, test=False):
     if not os.path.isdir(path):
         logger.info("mkdir: %s", path)
@@ -16,6 +16,7 @@ import pyqtgraph as pg
 import user
 
 from multipatch_analysis.experiment_list import ExperimentList, cache_file
+from multipatch_analysis.experiment_catalog import CatalogExperiment
 from multipatch_analysis import config
 
 def arg_to_date(arg):
@@ -27,7 +28,7 @@ def arg_to_date(arg):
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--reload', action='store_true', default=False, dest='reload',
-                    help='Reload all experiment data from the server.')
+                    help='Reload experiment data from the server (only sites that changed since the last reload).')
 parser.add_argument('--reload-old', action='store_true', default=False, dest='reload_old',
                     help='Reload all experiment data from old summary files.')
 parser.add_argument('--region', type=str)
@@ -49,7 +50,7 @@ parser.add_argument('--temp', type=int)
 
 args = parser.parse_args(sys.argv[1:])
 
-all_expts = ExperimentList(cache=cache_file)
+all_expts = ExperimentList(cache=cache_file, catalog=True)
 
 if args.reload:
     all_expts.load_from_server()
@@ -70,7 +71,10 @@ if len(all_expts) == 0:
     sys.exit(-1)
 
 # force cell QC to run before caching
+# (experiments in the catalog were already checked when they were loaded from the server)
 for expt in all_expts:
+    if isinstance(expt, CatalogExperiment):
+        continue
     try:
         expt.connections_probed
     except Exception as exc:
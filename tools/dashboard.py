@@ -9,11 +9,13 @@ if __name__ == '__main__':
     parser.add_argument('--no-thread', action='store_true', default=False, dest='no_thread',
                     help='Do all polling in main thread (to make debugging easier).')
     parser.add_argument('--limit', type=int, dest='limit', default=0, help="Limit the number of experiments to poll (to make testing easier).")
+    parser.add_argument('--checkers', type=int, dest='checkers', default=6, help="Number of threads used to check experiment status.")
+    parser.add_argument('--source-limit', type=int, dest='source_limit', default=2, help="Maximum number of experiments from the same data source checked at once.")
     args = parser.parse_args(sys.argv[1:])
 
     app = pg.mkQApp()
     # console = pg.dbg()
-    db = Dashboard(limit=args.limit, no_thread=args.no_thread)
+    db = Dashboard(limit=args.limit, no_thread=args.no_thread, n_checkers=args.checkers, source_limit=args.source_limit)
     db.show()
 
     if sys.flags.interactive == 0:
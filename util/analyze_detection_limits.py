@@ -0,0 +1,32 @@
+from __future__ import print_function
+import argparse, sys
+import pyqtgraph as pg 
+from multipatch_analysis.detection_limit import detection_limit_tables, init_tables, update_detection_limits
+import multipatch_analysis.database as db
+
+
+if __name__ == '__main__':
+    import user
+
+    parser = argparse.ArgumentParser(description="Estimate the minimum detectable PSP amplitude for each pair, "
+                                               "store to detection_limit table.")
+    parser.add_argument('--rebuild', action='store_true', default=False, help="Remove and rebuild tables for this analysis")
+    parser.add_argument('--workers', type=int, default=None, help="Set the number of concurrent processes during update")
+    parser.add_argument('--local', action='store_true', default=False, help="Disable concurrent processing to make debugging easier")
+    parser.add_argument('--raise-exc', action='store_true', default=False, help="Disable catching exceptions encountered during processing", dest='raise_exc')
+    parser.add_argument('--limit', type=int, default=0, help="Limit the number of pairs to process")
+    parser.add_argument('--pairs', type=lambda s: [int(x) for x in s.split(',')], default=None, help="Select specific pair IDs to analyze", )
+    
+    args = parser.parse_args(sys.argv[1:])
+    if args.rebuild:
+        args.rebuild = raw_input("Rebuild %s detection limit table? " % db.db_name) == 'y'
+
+    if args.local:
+        pg.dbg()
+
+    if args.rebuild:
+        detection_limit_tables.drop_tables()
+
+    init_tables()
+
+    update_detection_limits(limit=args.limit, pair_ids=args.pairs, parallel=not args.local, workers=args.workers, raise_exceptions=args.raise_exc)
@@ -0,0 +1,14 @@
+from __future__ import print_function
+import argparse, sys
+from multipatch_analysis.pair_classifier import update_pair_classifier
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train classifiers that predict synaptic connectivity from "
+                                                 "connection strength results, and save them to the cache path.")
+    parser.add_argument('--rebuild', action='store_true', default=False, help="Retrain classifiers even if the data have not changed")
+    parser.add_argument('--jobs', type=int, default=-1, help="Set the number of concurrent processes used for cross validation (-1 uses all cores)")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    update_pair_classifier(n_jobs=args.jobs, rebuild=args.rebuild)
@@ -1,34 +1,46 @@
-import os, sys, re, shutil, hashlib, time
+import os, sys, re, shutil, hashlib, time, sqlite3, threading, argparse
+from multiprocessing.pool import ThreadPool
 
 
-ignored_files = ['.*Thumbs.db']
+hash_cache_name = '.hash_cache.sqlite'
+
+ignored_files = ['.*Thumbs.db', '.*' + re.escape(hash_cache_name)]
 ignored_regex = [re.compile(x) for x in ignored_files]
 
 
-def conditional_delete(path1, path2):
+def conditional_delete(path1, path2, cache1=None, cache2=None, workers=4):
     """Delete *path1* only if all files that would be deleted also exist in *path2*.
 
     Return True if *path1* was deleted.
 
     This is used for recovering disk space after verifying the contents of a backup.
+    See compare_paths() for the remaining arguments.
     """
     print("Comparing %s..." % path1)
-    if not compare_paths(path1, path2):
+    if not compare_paths(path1, path2, cache1=cache1, cache2=cache2, workers=workers):
         print("    Skipping %s" % path1)
         return False
 
     print("    Removing %s..." % path1)
     shutil.rmtree(path1)
+    if cache1 is not None:
+        cache1.remove_tree(path1)
     print("    Done.")
     return True
 
 
-def conditional_delete_old(path1, path2, min_age=90):
+def conditional_delete_old(path1, path2, min_age=90, use_cache=True, workers=4):
     """Conditionally delete subdirectories from *path1* if they are older than *min_age* (in days) and
     have a valid copy in *path2*.
 
     The age of each subfolder is determined using its MTIME.
+
+    If *use_cache* is True, file hashes are cached in a HashCache at the root of both *path1*
+    and *path2*, so repeated runs only hash files that are new or have changed.
     """
+    cache1 = HashCache.open(path1) if use_cache else None
+    cache2 = HashCache.open(path2) if use_cache else None
+
     too_young = []
     deleted_paths = []
     invalid_paths = []
@@ -42,7 +54,7 @@ def conditional_delete_old(path1, path2, min_age=90):
             too_young.append(src_path)
             continue
         dst_path = os.path.join(path2, f)
-        deleted = conditional_delete(src_path, dst_path)
+        deleted = conditional_delete(src_path, dst_path, cache1=cache1, cache2=cache2, workers=workers)
         if deleted:
             deleted_paths.append(src_path)
         else:
@@ -55,11 +67,16 @@ def age_in_days(path):
     return (time.time() - os.stat(path).st_mtime) / (3600*24.)
 
 
-def compare_paths(path1, path2):
+def compare_paths(path1, path2, cache1=None, cache2=None, workers=4):
     """Return True only if all files inside the tree at *path1* also exist in the same relative 
     locations in *path2*.
+
+    Files are compared by SHA1 hash, computed by a pool of *workers* threads. If *cache1* or
+    *cache2* are given, they are HashCache instances used to avoid re-hashing unchanged files
+    in *path1* and *path2*, respectively.
     """
     match = True
+    to_hash = []
     for src_path, dirs, files in os.walk(path1):
         subpath = os.path.relpath(src_path, path1)
         dst_path = os.path.join(path2, subpath)
@@ -91,14 +108,58 @@ def compare_paths(path1, path2):
                 match = False
                 print("      Wrong size %s" % rel_file)
                 continue
-            if file_hash(src_file) != file_hash(dst_file):
-                match = False
-                print("      Hash mismatch %s" % rel_file)
-                continue
+            to_hash.append((rel_file, src_file, dst_file))
+
+    hashes = hash_files([(f[1], cache1) for f in to_hash] + [(f[2], cache2) for f in to_hash], workers=workers)
+    for rel_file, src_file, dst_file in to_hash:
+        if hashes[src_file] != hashes[dst_file]:
+            match = False
+            print("      Hash mismatch %s" % rel_file)
 
     return match
 
 
+def hash_files(files, workers=4):
+    """Return a dict mapping file names to SHA1 hashes.
+
+    *files* is a list of (filename, cache) pairs, where cache is a HashCache or None. Files
+    found in their cache are not read; the rest are hashed by a pool of *workers* threads
+    and their hashes are added to the cache.
+    """
+    hashes = {}
+    todo = []
+    for filename, cache in files:
+        stat = os.stat(filename)
+        digest = None if cache is None else cache.get(filename, stat)
+        if digest is None:
+            todo.append((filename, cache, stat))
+        else:
+            hashes[filename] = digest
+
+    def hash_one(item):
+        return item, file_hash(item[0])
+
+    if workers > 1 and len(todo) > 1:
+        pool = ThreadPool(min(workers, len(todo)))
+        try:
+            results = pool.map(hash_one, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [hash_one(item) for item in todo]
+
+    new_entries = {}
+    for (filename, cache, stat), digest in results:
+        hashes[filename] = digest
+        if cache is not None:
+            new_entries.setdefault(cache, []).append((filename, stat, digest))
+    for cache, entries in new_entries.items():
+        cache.set_many(entries)
+
+    return hashes
+
+
 def file_hash(filename, blocksize=2**24, func=hashlib.sha1):
     """Source: https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
     """
@@ -109,9 +170,77 @@ def file_hash(filename, blocksize=2**24, func=hashlib.sha1):
     return hash.hexdigest()
 
 
+class HashCache(object):
+    """Persistent cache of file hashes for all files under *root*, backed by an SQLite file.
+
+    Entries are keyed by the file path (relative to *root*), size, and modification time;
+    a cached hash is only returned if the size and mtime of the file have not changed.
+    The cache file is stored in *root* by default, so it remains valid no matter which
+    machine runs the comparison.
+    """
+    def __init__(self, root, filename=None):
+        self.root = os.path.abspath(root)
+        self.filename = filename or os.path.join(self.root, hash_cache_name)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._db.execute("""
+                create table if not exists file_hash (
+                    path text primary key, size integer, mtime real, hash text
+                )""")
+            self._db.commit()
+
+    @classmethod
+    def open(cls, root):
+        """Return a HashCache for *root*, or None (with a warning) if the cache file cannot be
+        opened; for example, on read-only storage.
+        """
+        try:
+            return cls(root)
+        except sqlite3.Error as exc:
+            print("    Not caching hashes for %s: %s" % (root, exc))
+            return None
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root).replace(os.sep, '/')
+
+    def get(self, filename, stat=None):
+        """Return the cached hash of *filename*, or None if it is not cached or has changed.
+        """
+        stat = os.stat(filename) if stat is None else stat
+        with self._lock:
+            row = self._db.execute("select size, mtime, hash from file_hash where path=?", (self._key(filename),)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime:
+            return None
+        return row[2]
+
+    def set_many(self, entries):
+        """Add a list of (filename, stat, hash) entries to the cache.
+        """
+        rows = [(self._key(f), stat.st_size, stat.st_mtime, digest) for f, stat, digest in entries]
+        with self._lock:
+            self._db.executemany("insert or replace into file_hash (path, size, mtime, hash) values (?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def remove_tree(self, path):
+        """Remove cache entries for all files under *path* (for example, after it is deleted).
+        """
+        key = self._key(path)
+        with self._lock:
+            self._db.execute("delete from file_hash where path=? or substr(path, 1, ?)=?", (key, len(key) + 1, key + '/'))
+            self._db.commit()
+
+
 if __name__ == '__main__':
-    path1, path2 = sys.argv[1:]
-    conditional_delete_old(path1, path2)
+    parser = argparse.ArgumentParser(description="Delete old subfolders of path1 that have a verified copy in path2.")
+    parser.add_argument('path1')
+    parser.add_argument('path2')
+    parser.add_argument('--min-age', type=float, default=90, help="Minimum age (days) of folders to delete")
+    parser.add_argument('--workers', type=int, default=4, help="Number of threads used to hash files")
+    parser.add_argument('--no-cache', action='store_true', default=False, help="Re-hash all files instead of using the hash caches")
+    args = parser.parse_args(sys.argv[1:])
+
+    conditional_delete_old(args.path1, args.path2, min_age=args.min_age, use_cache=not args.no_cache, workers=args.workers)
 
 
 
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import os, sys, time, glob, argparse
 import multiprocessing
+import numpy as np
 
 import pyqtgraph as pg
 pg.dbg()
@@ -46,6 +47,29 @@ def submit_expt(expt_id, raise_exc=False):
     # print(os.getpid(), expt_id, "return")
 
 
+def expts_in_db(expt_ids):
+    """Return the subset of *expt_ids* (timestamps) that have already been imported.
+
+    Uses the same 0.01 s tolerance as database.experiment_from_timestamp, but with a single query.
+    """
+    session = database.Session()
+    try:
+        imported = np.array(sorted(ts for ts, in session.query(database.Experiment.acq_timestamp).all()))
+    finally:
+        session.close()
+    if len(imported) == 0:
+        return set()
+    found = set()
+    for expt_id in expt_ids:
+        if expt_id is None:
+            continue
+        i = np.searchsorted(imported, expt_id)
+        near = imported[max(i-1, 0):i+1]
+        if np.any(np.abs(near - expt_id) < 0.01):
+            found.add(expt_id)
+    return found
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Import new experiments into the database.")
     parser.add_argument('--limit', type=int, default=None)
@@ -75,6 +99,17 @@ if __name__ == '__main__':
     print("Found %d cached experiments, will import %d." % 
           (len(all_expts), len(selected_expts)))
     print(selected_expts)
+
+    # start downloading raw data in the background, in the order experiments will be imported.
+    # Experiments that are already in the DB are skipped by submit_expt, so their files would
+    # never be used.
+    done = expts_in_db(selected_expts)
+    nwb_files = []
+    for expt_id in selected_expts:
+        if expt_id in done:
+            continue
+        nwb_files.extend(sorted(glob.glob(os.path.join(all_expts[expt_id], '*.nwb'))))
+    cache.prefetch(nwb_files)
     
     if args.local is True:
         errors = []
@@ -16,6 +16,7 @@ backup_paths:
 """
 from __future__ import print_function
 import os, sys, argparse, logging
+from multiprocessing.pool import ThreadPool
 from multipatch_analysis import util
 from multipatch_analysis import config
 
@@ -23,6 +24,10 @@ from multipatch_analysis import config
 parser = argparse.ArgumentParser()
 parser.add_argument('--jobs', type=str, default="*", help="The name of the backup job(s) to run (default is all jobs listed in config.backup_paths)")
 parser.add_argument('--test', action='store_true', default=False, help="Print actions to be taken, do not change any files")
+parser.add_argument('--workers', type=int, default=4, help="Number of threads used to copy each large file")
+parser.add_argument('--threads', type=int, default=4, help="Number of backup jobs to run at the same time")
+parser.add_argument('--max-per-dest', type=int, default=2, help="Maximum number of jobs writing to the same destination drive at once")
+parser.add_argument('--no-manifest', action='store_true', default=False, help="Compare every file with the destination instead of using the sync manifests and folder signatures")
 parser.add_argument('--verbose', action='store_true', default=False, help="Verbose output; show files that are skipped over")
 
 args = parser.parse_args(sys.argv[1:])
@@ -31,13 +36,29 @@ if args.verbose:
     util.stderr_log_handler.setLevel(logging.DEBUG)
 
 if args.jobs == '*':
-    jobs = config.backup_paths.keys()
+    jobs = list(config.backup_paths.keys())
 else:
     jobs = args.jobs.split(',')
 
-for job in jobs:
+limiter = util.DestinationLimiter(args.max_per_dest)
+
+if args.no_manifest:
+    signatures = None
+else:
+    if not os.path.isdir(config.cache_path):
+        os.makedirs(config.cache_path)
+    signatures = util.SyncSignatureStore(os.path.join(config.cache_path, 'sync_signatures.sqlite'))
+
+def run_job(job):
     spec = config.backup_paths[job]
     source_path = spec['source']
     dest_path = spec['dest']
     log_file = os.path.join(dest_path, 'backup.log')
-    util.sync_dir(source_path, dest_path, test=args.test, log_file=log_file)
+    with limiter(dest_path):
+        util.sync_dir(source_path, dest_path, test=args.test, log_file=log_file, workers=args.workers,
+                      use_manifest=not args.no_manifest, signatures=signatures)
+
+pool = ThreadPool(max(1, min(args.threads, len(jobs))))
+pool.map(run_job, jobs)
+pool.close()
+pool.join()
@@ -16,11 +16,22 @@ rsync itself, but in practice this presents a few difficult issues:
   subprocessing, CLI flag generation, and fragile pipe communication.
 """
 
-import os, sys, shutil, glob, traceback, pickle, time
+import os, sys, shutil, glob, traceback, pickle, time, threading
+from multiprocessing.pool import ThreadPool
 from acq4.util.DataManager import getDirHandle
 
 from multipatch_analysis import config
-from multipatch_analysis.util import sync_file
+from multipatch_analysis.util import sync_file, read_sync_manifest, write_sync_manifest, dir_signature, SyncSignatureStore
+
+
+# number of threads used to copy each large file to the server
+copy_workers = 4
+
+# number of experiment sites synchronized at the same time (sites from different rigs are interleaved)
+sync_threads = 8
+
+# source folders whose signature has not changed are rechecked file by file after this many seconds
+max_signature_age = 7 * 24 * 3600
 
 
 def sync_experiment(site_dir):
@@ -69,25 +80,81 @@ def sync_experiment(site_dir):
     return changes
 
 
+_log_lock = threading.Lock()
+
 def log(msg):
-    print(msg)
-    with open(os.path.join(config.synphys_data, 'sync_log'), 'ab') as log_fh:
-        log_fh.write(msg+'\n')
+    with _log_lock:
+        print(msg)
+        with open(os.path.join(config.synphys_data, 'sync_log'), 'ab') as log_fh:
+            log_fh.write(msg+'\n')
+
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+def _path_lock(path):
+    """Return a lock that serializes syncs into *path* (sibling sites share their
+    slice and day folders).
+    """
+    with _path_locks_lock:
+        if path not in _path_locks:
+            _path_locks[path] = threading.Lock()
+        return _path_locks[path]
+
+
+_signatures = None
+_signatures_lock = threading.Lock()
+
+def _signature_store():
+    """Return the SyncSignatureStore kept in config.cache_path on this machine.
+    """
+    global _signatures
+    with _signatures_lock:
+        if _signatures is None:
+            if not os.path.isdir(config.cache_path):
+                os.makedirs(config.cache_path)
+            _signatures = SyncSignatureStore(os.path.join(config.cache_path, 'sync_signatures.sqlite'))
+    return _signatures
 
 
 def _sync_paths(source, target, changes):
     """Non-recursive directory sync.
 
+    Source folders whose signature (see util.dir_signature) has not changed since they were last
+    synchronized are skipped without listing them. Otherwise, a manifest of the source files is
+    kept in *target* (see util.read_sync_manifest), so files that have not changed since the last
+    sync are skipped without accessing the server.
+
     Return the number of skipped files.
     """
+    with _path_lock(target):
+        signatures = _signature_store()
+        signature = dir_signature(source)
+        rec = signatures.get(source)
+        if rec is not None and rec[0] == signature and time.time() - rec[2] < max_signature_age and os.path.isdir(target):
+            return 0
+        n_changes = len(changes)
+        skipped = _sync_paths_locked(source, target, changes)
+        # folders with errors are listed again next time
+        if not any(change[0] == 'error' for change in changes[n_changes:]):
+            signatures.set(source, signature, [])
+        return skipped
+
+
+def _sync_paths_locked(source, target, changes):
     skipped = 0
     if not os.path.isdir(target):
         os.mkdir(target)
         changes.append(('mkdir', source, target))
 
+    manifest = read_sync_manifest(target)
+    recorded = {} if manifest is None else manifest['files']
+
     # Leave a note about the source of this data
-    open(os.path.join(target, 'sync_source'), 'wb').write(source)
+    if manifest is None or manifest.get('source') != source:
+        open(os.path.join(target, 'sync_source'), 'wb').write(source)
 
+    files = {}
     for fname in os.listdir(source):
         src_path = os.path.join(source, fname)
         if os.path.isfile(src_path):
@@ -100,7 +167,8 @@ def _sync_paths(source, target, changes):
             # Skip large files:
             #   - pxp > 20GB
             #   - others > 5GB
-            src_size = os.stat(src_path).st_size
+            src_stat = os.stat(src_path)
+            src_size = src_stat.st_size
             ext = os.path.splitext(src_path)[1]
             max_size = {'.pxp': 20e9, '.nwb': 7e9}.get(ext, 5e9)
 
@@ -108,8 +176,16 @@ def _sync_paths(source, target, changes):
                 log("    err! %s => %s" % (src_path, dst_path))
                 changes.append(('error', src_path, 'file too large'))
                 continue
+
+            entry = [src_size, src_stat.st_mtime, None]
+            rec = recorded.get(fname)
+            if rec is not None and rec[:2] == entry[:2]:
+                files[fname] = rec
+                skipped += 1
+                continue
             
-            status = sync_file(src_path, dst_path)
+            status, entry[2] = sync_file(src_path, dst_path, workers=copy_workers, return_digest=True)
+            files[fname] = entry
             if status == 'skip':
                 skipped += 1
             elif status == 'copy':
@@ -119,6 +195,10 @@ def _sync_paths(source, target, changes):
                 log("    updt %s => %s" % (src_path, dst_path))
                 changes.append(('update', src_path, dst_path))
 
+    new_manifest = {'source': source, 'files': files, 'dirs': []}
+    if new_manifest != manifest:
+        write_sync_manifest(target, new_manifest)
+
     return skipped
 
 
@@ -147,14 +227,17 @@ def find_all_sites(root):
     return sites
 
 
-def sync_all(source='archive'):
+def sync_all(source='archive', threads=None):
     """Synchronize all known rig data paths to the server
 
     *source* should be either 'primary' or 'archive', referring to the paths
     specified in config.rig_data_paths.
+
+    Sites from all rigs are synchronized concurrently by *threads* threads
+    (default is sync_threads).
     """
-    log = []
     synced_paths = []
+    rig_paths = []
     # Loop over all rigs
     for rig_name, data_paths in config.rig_data_paths.items():
         # Each rig may have multiple paths to check
@@ -163,27 +246,52 @@ def sync_all(source='archive'):
 
             # Get a list of all experiments stored in this path
             paths = find_all_sites(data_path)
-
-            # synchronize files for each experiment to the server
-            log.extend(sync_experiments(paths))
+            rig_paths.append(paths)
             synced_paths.append((rig_name, data_path, len(paths)))
+
+    # interleave sites so that all rigs are read from at the same time
+    paths = []
+    for i in range(max([len(p) for p in rig_paths] + [0])):
+        paths.extend([p[i] for p in rig_paths if i < len(p)])
+
+    # synchronize files for each experiment to the server
+    log = sync_experiments(paths, threads=threads)
     
     return log, synced_paths
 
 
-def sync_experiments(paths):
+def _sync_one_experiment(site_dir):
+    try:
+        return site_dir, sync_experiment(site_dir), None
+    except Exception:
+        exc = traceback.format_exc()
+        print(exc)
+        return site_dir, [], exc
+
+
+def sync_experiments(paths, threads=None):
     """Given a list of paths to experiment site folders, synchronize all to the server
+
+    Up to *threads* sites (default is sync_threads) are synchronized concurrently; the
+    returned log is in the same order as *paths*.
     """
-    log = []
-    for site_dir in paths:
+    threads = sync_threads if threads is None else threads
+    if threads > 1 and len(paths) > 1:
+        pool = ThreadPool(min(threads, len(paths)))
         try:
-            changes = sync_experiment(site_dir)
-            if len(changes) > 0:
-                log.append((site_dir, changes))
-        except Exception:
-            exc = traceback.format_exc()
-            print(exc)
+            results = pool.map(_sync_one_experiment, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_sync_one_experiment(site_dir) for site_dir in paths]
+
+    log = []
+    for site_dir, changes, exc in results:
+        if exc is not None:
             log.append((site_dir, [], exc, []))
+        elif len(changes) > 0:
+            log.append((site_dir, changes))
     return log
 
 
@@ -37,6 +37,9 @@ if __name__ == '__main__':
         ('morphology',              ('python util/update_morphology.py', 'update morphology')),
         ('pulse_response_strength', ('python util/analyze_pulse_response_strength.py', 'pulse response strength')),
         ('connection_strength',     ('python util/analyze_connection_strength.py', 'connection strength')),
+        ('pair_classifier',         ('python util/analyze_pair_classifier.py', 'pair classifier')),
+        ('detection_limit',         ('python util/analyze_detection_limits.py', 'detection limits')),
+        ('dynamics',                ('python util/analyze_dynamics.py', 'synaptic dynamics')),
         ('vacuum',                  ('python util/database.py --vacuum', 'vacuum')),
     ])
 